@@ -69,22 +69,32 @@ Example:
 
 """
 
-import distutils.spawn
+import time
+
+# the startup time budget is measured from
+# here, before the other modules are imported
+script_start_time = time.time()
+
+import argparse
+import codecs
+import errno
+import fnmatch
 import io
 import itertools
 import json
 import os
 import platform
+import random
 import re
 import shlex
 import shutil
-import subprocess
 import sys
 import threading
-import time
-import urllib
 import fcntl
+import hashlib
+import mmap
 import socket
+import zlib
 
 # conditional import of
 # required modules
@@ -94,10 +104,24 @@ except ImportError:
     from pipes import quote
 
 try:
-    from urllib import request
-    from urllib import error
-except:
-    pass
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    from urllib.parse import urljoin, urlsplit
+except ImportError:
+    from urlparse import urljoin, urlsplit
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
 
 __author__ = "Kerem Gümrükcü"
 __copyright__ = "Copyright 2017, Kerem Gümrükcü"
@@ -117,6 +141,13 @@ LATEST_UPSTREAM_KERNELS_ARCHIVE_URL = "http://kernel.ubuntu.com/~kernel-ppa/main
 ####################################
 USER_DOWNLOAD_PACKAGES_FOLDER = "StableUpstreamKernels"
 USER_HOME_DOWNLOAD_DIRECTORY = "Downloads"
+USER_CACHE_FOLDER = ".sukd-cache"  # inside the packages folder
+PACKAGE_CACHE_OBJECTS_FOLDER = "objects"
+METADATA_CACHE_FOLDER = "metadata"
+TOOL_DISCOVERY_CACHE_FILE = "tools.json"
+ARCHIVE_MIRROR_RANKING_FILE = "mirrors.json"
+KERNEL_ARCHIVE_INDEX_FILE = "archive-index.json"
+AUDIT_RESULT_CACHE_FILE = "audit.json"
 
 ##########################
 # User defined variables #
@@ -124,6 +155,15 @@ USER_HOME_DOWNLOAD_DIRECTORY = "Downloads"
 # force the script to use this version
 # FORCE_KERNEL_VERSION = "4.9.6"
 FORCE_KERNEL_VERSION = None
+# use the newest release of this series instead of the latest
+# stable one, e.g. a long term series, ignored if a version is forced
+# FORCE_KERNEL_SERIES = "6.1"
+FORCE_KERNEL_SERIES = None
+# more Upstream kernel archives with the same layout, e.g. a
+# host running "--serve", every file is fetched from the best
+# ranked archive and from the next one on errors or stalls
+# UPSTREAM_KERNELS_ARCHIVE_MIRRORS = ["http://kernels.example.lan:8080"]
+UPSTREAM_KERNELS_ARCHIVE_MIRRORS = []
 # force the script to use this absolute location
 # FORCE_DOWNLOAD_LOCATION = "/root/Downloads"
 FORCE_DOWNLOAD_LOCATION = None
@@ -131,16 +171,75 @@ FORCE_DOWNLOAD_LOCATION = None
 # connection availability
 SERVERS_TO_PROBE_FOR_CONNECTION = ["www.ubuntu.com", "www.kernel.org", "www.gnu.org"]  # servers to probe
 SERVER_PORT_TO_PROBE = 80  # ports to probe
-SERVER_TIMEOUT_CYCLES_IN_SEC = [1, 5, 10]  # seconds to timeout
+SERVER_PROBE_DEADLINE_IN_SEC = 10  # overall seconds for all probes
+# skip the probe, the metadata download
+# itself will prove the connection
+SKIP_CONNECTION_PROBE = False
+# start fast for scripted runs: no connection probe, no
+# environment report and no checks for tools the chosen
+# action does not need, warn if the start up to the first
+# online request takes longer than the time budget
+FAST_START = False
+STARTUP_TIME_BUDGET_IN_SEC = 0.25
+# number of concurrent download workers,
+# set to 1 for sequential downloads
+DOWNLOAD_WORKER_COUNT = 4
+# split large files into byte ranges fetched over
+# this many connections, set to 1 for a single stream
+SEGMENTED_DOWNLOAD_CONNECTIONS = 1
+# keep verified DEB files in a local store keyed
+# by their checksum and reuse them on later runs
+USE_PACKAGE_CACHE = True
+# keep releases.json and CHECKSUMS on disk and
+# only revalidate them with a conditional request
+USE_METADATA_CACHE = True
+# number of files the audit hashes in parallel, hashlib
+# releases the GIL while hashing, so the threads use
+# all cores, None means one per CPU
+AUDIT_WORKER_COUNT = None
+# place shared and deduplicated files as reflinks (copy-on-write
+# clones) instead of hardlinks where the file system supports
+# them, every copy then stays a file of its own
+PREFER_REFLINKS = False
+# total bandwidth of all downloads together in
+# bytes per second, None for no limit
+# DOWNLOAD_BANDWIDTH_LIMIT = 2 * 1024 * 1024
+DOWNLOAD_BANDWIDTH_LIMIT = None
+# write phase timings and counters of the run to this
+# file, a ".prom" file is written in the Prometheus text
+# format for the node_exporter textfile collector, any
+# other file as JSON, None for no metrics file
+# METRICS_OUTPUT_FILE = "/var/lib/node_exporter/textfile_collector/sukd.prom"
+METRICS_OUTPUT_FILE = None
+# run the connection probe, the metadata requests and the
+# package downloads as tasks on one asyncio event loop in a
+# single thread instead of a thread pool and download tools,
+# needs Python 3.7 or newer and the "sukd_async.py" module
+USE_ASYNC_ENGINE = False
+# address and port of the LAN cache server started with
+# "--serve", other hosts use "http://<host>:<port>" as
+# their LATEST_UPSTREAM_KERNELS_ARCHIVE_URL
+LAN_CACHE_SERVER_ADDRESS = "0.0.0.0"
+LAN_CACHE_SERVER_PORT = 8080
 
 ########################
 # Application binaries #
 ########################
-SHA1SUM_BIN_FILE = "sha1sum"
 DPKG_BIN_FILE = "dpkg"
 DPKG_LOCK_FILE = "/var/lib/dpkg/lock"
 DPKG_BIN_FILE_PARAMS = "-i"
-DOWNLOAD_TOOLS = {"wget": '-O "{0}" "{1}"', "curl": '-o "{0}" "{1}"'}  # {0} = destination, {1} = online source
+# used without a terminal, where no dpkg or debconf prompt could
+# be answered, changed conffiles keep the installed version
+DPKG_NONINTERACTIVE_PARAMS = ["--force-confdef", "--force-confold"]
+# install all selected packages with one dpkg call, so the
+# triggers like initramfs and grub updates run only once,
+# set to False for one dpkg call per package
+DPKG_INSTALL_IN_ONE_TRANSACTION = True
+DOWNLOAD_TOOLS = {"wget": '-c -O "{0}" "{1}"', "curl": '--fail -C - -o "{0}" "{1}"'}  # {0} = destination, {1} = online source
+DOWNLOAD_TOOLS_LIMIT_RATE_PARAMS = {"wget": '--limit-rate={0}', "curl": '--limit-rate {0}'}  # {0} = bytes per second
+DOWNLOAD_TOOLS_STALL_PARAMS = {"wget": '--read-timeout={0} --tries=1', "curl": '--speed-limit 1 --speed-time {0}'}  # {0} = seconds
+DOWNLOAD_TOOLS_RETRY_EXIT_CODES = {"wget": [4], "curl": [7, 18, 28, 52, 55, 56]}  # network failures, retried
+DOWNLOAD_TOOLS_HTTP_ERRORS = {"wget": [8, r"ERROR (\d{3})"], "curl": [22, r"returned error: (\d{3})"]}  # exit code, status in the output
 
 ####################
 # Global constants #
@@ -172,11 +271,117 @@ IS_PYTHON3 = (PYTHON_MAJOR_VERSION == 3)
 # Fixed file names #
 ####################
 CHECKSUMS_FILE = "CHECKSUMS"
+DOWNLOAD_JOURNAL_FILE = ".sukd-journal.json"
+PARTIAL_DOWNLOAD_FILE_SUFFIX = ".part"
+SEGMENTED_DOWNLOAD_STATE_SUFFIX = ".segments"
+
+#################################
+# Checksum validation constants #
+#################################
+CHECKSUM_ALGORITHMS_BY_HASH_LENGTH = {40: "sha1", 64: "sha256"}  # hex digest length -> hashlib name
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes read and hashed per step
+DOWNLOAD_BUFFER_SIZE = 256 * 1024  # receive buffer a built-in transfer reuses for the whole file
+FALLOCATE_KEEP_SIZE = 0x01  # FALLOC_FL_KEEP_SIZE, reserves blocks without growing the file
+FICLONE_IOCTL = 0x40049409  # FICLONE, clones a file with shared blocks on btrfs, xfs and the like
+SEGMENTED_DOWNLOAD_MIN_FILE_SIZE = 8 * 1024 * 1024  # smaller files use a single stream
+DOWNLOAD_BANDWIDTH_BURST_IN_SEC = 1  # seconds of unused bandwidth a transfer may catch up on
+
+############################
+# Kernel package constants #
+############################
+# <name>_<package version>_<arch>.deb, the name is
+# linux-<kind>-<release>-<abi>[-<flavor>]
+KERNEL_PACKAGE_FILE_PATTERN = re.compile(
+    r"^(?P<name>[^_]+)_(?P<package_version>[^_]+)_(?P<arch>[^_.]+)\.deb$", re.IGNORECASE | re.UNICODE)
+KERNEL_PACKAGE_NAME_PATTERN = re.compile(
+    r"^linux-(?P<kind>[a-z][a-z-]*?)-(?P<release>\d[^-]*(?:-rc\d+)?)-(?P<abi>\d[0-9a-z]*)(?:-(?P<flavor>[a-z][a-z0-9-]*))?$",
+    re.IGNORECASE | re.UNICODE)
+KERNEL_PACKAGE_ARCH_INDEPENDENT = "all"
+# dpkg install order, the headers-all package first
+KERNEL_PACKAGE_INSTALL_ORDER = ["headers", "modules", "modules-extra", "image", "image-unsigned"]
+
+#############################
+# HTTP connection constants #
+#############################
+HTTP_USER_AGENT = "sukd (Stable Upstream Kernel Downloader)"
+HTTP_MAX_IDLE_CONNECTIONS_PER_HOST = 8  # keep-alive connections kept per host
+HTTP_MAX_REDIRECTS = 5
+HTTP_REDIRECT_STATUS_CODES = [301, 302, 303, 307, 308]
+HTTP_CONNECT_TIMEOUT_IN_SEC = 10  # seconds to establish a connection, the proxy tunnel included
+HTTP_STALL_TIMEOUT_IN_SEC = 30  # seconds without a byte before a transfer counts as stalled
+
+###########################
+# Request retry constants #
+###########################
+RETRY_MAX_ATTEMPTS = 4  # attempts per request and mirror, the first one included
+RETRY_BACKOFF_BASE_IN_SEC = 0.5  # the n-th retry waits a random time up to base * 2^n
+RETRY_BACKOFF_MAX_IN_SEC = 15
+RETRY_HTTP_STATUS_CODES = [408, 425, 429, 500, 502, 503, 504]
+RETRY_SOCKET_ERROR_NUMBERS = [errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED, errno.ETIMEDOUT,
+                              errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ENETDOWN, errno.EPIPE]
+METADATA_REQUEST_DEADLINE_IN_SEC = 60  # all attempts of one releases.json, index or CHECKSUMS request
+FILE_DOWNLOAD_DEADLINE_IN_SEC = 1800  # all attempts of one file on all mirrors
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5  # failed requests in a row before a host gets a rest
+CIRCUIT_BREAKER_OPEN_IN_SEC = 30  # seconds of rest before one trial request may go to the host
+
+############################
+# Archive mirror constants #
+############################
+ARCHIVE_MIRROR_PROBE_DEADLINE_IN_SEC = 5  # overall seconds for all mirror probes
+ARCHIVE_MIRROR_PROBE_BYTES = 256 * 1024  # bytes of the archive index read for the throughput
+ARCHIVE_MIRROR_RANKING_MAX_AGE_IN_SEC = 3600  # probe results are reused for this long
+ARCHIVE_MIRROR_REFERENCE_FILE_SIZE = 32 * 1024 * 1024  # mirrors are ranked by the time for a file this large
+
+##################################
+# Kernel archive index constants #
+##################################
+KERNEL_ARCHIVE_INDEX_MAX_AGE_IN_SEC = 600  # the directory listing is not requested again for this long
+# one "v<version>/" entry of the HTML listing up to the next
+# link, the rest of it may hold the modification date
+KERNEL_ARCHIVE_INDEX_ENTRY_PATTERN = re.compile(
+    r"href=\"v(\d[^/\"]*)/\"((?:(?!href=)[^\n])*)", re.IGNORECASE | re.UNICODE)
+KERNEL_ARCHIVE_INDEX_DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}|\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}")
+
+#############################
+# Integrity audit constants #
+#############################
+# a file that rots on disk keeps its size and modification time,
+# so a cached hash is only trusted for this long and every file
+# is read again once in this interval
+AUDIT_RESULT_MAX_AGE_IN_SEC = 7 * 24 * 3600
+
+######################
+# Progress constants #
+######################
+PROGRESS_FRAMES_PER_SEC = 10  # redraws per second on a terminal
+PROGRESS_LOG_INTERVAL_IN_SEC = 10  # seconds between progress lines if stdout is no terminal
+PROGRESS_TERMINAL_WIDTH = 80  # fallback if the width is unknown
+
+#####################
+# Metrics constants #
+#####################
+METRICS_PROMETHEUS_FILE_EXTENSION = ".prom"
+METRICS_PROMETHEUS_PREFIX = "sukd_"
+
+###########################
+# dpkg progress constants #
+###########################
+DPKG_OUTPUT_PHASES = [  # dpkg output line prefix -> phase of the run metrics
+    ["Selecting previously unselected package", "dpkg_unpack"],
+    ["Preparing to unpack", "dpkg_unpack"],
+    ["Unpacking", "dpkg_unpack"],
+    ["Setting up", "dpkg_configure"],
+    ["Processing triggers for", "dpkg_triggers"]]
+
+##############################
+# LAN cache server constants #
+##############################
+LAN_CACHE_INCOMING_FOLDER = "incoming"  # inside the cache folder, unverified fetches
+LAN_CACHE_METADATA_MAX_AGE_IN_SEC = 300  # seconds before the index and CHECKSUMS are revalidated
 
 ####################
 # Global bin paths #
 ####################
-sha1sum_bin_file_full_path = None
 dpkg_bin_file_full_path = None
 downloader_bin_full_path_and_param = None
 
@@ -187,12 +392,20 @@ user_home_directory = os.path.expanduser("~")
 user_home_download_directory = os.path.join(user_home_directory, USER_HOME_DOWNLOAD_DIRECTORY)
 user_kernel_package_download_dir = os.path.join(user_home_download_directory, USER_DOWNLOAD_PACKAGES_FOLDER)
 user_downloaded_kernel_deb_files = list()
+kernel_package_cache = None
+user_batch_targets = None  # [[arch, flavor], ...] in batch mode
+user_mirror_settings = None  # mirror mode version range and target filters
+user_serve_settings = None  # [address, port] in serve mode
+user_list_settings = None  # version query of the list mode
+user_audit_settings = None  # worker count of the audit mode
+user_dedup_mode = False  # link the duplicate files of the download tree
+script_exit_code = 0
+kernel_metadata_cache = None
 
 ##########################################
 # Global OS/Kernel environment variables #
 ##########################################
 os_linux_architecture = platform.machine()
-os_linux_platform = platform.platform()
 os_python_version = sys.version.split()[0]
 
 ###############################
@@ -200,9 +413,7 @@ os_python_version = sys.version.split()[0]
 ###############################
 latest_stable_kernel_version = None
 latest_stable_kernel_checksums_file = None
-kernel_hashes_and_files = dict()
-kernel_available_architectures = list()
-kernel_available_flavors = list()
+kernel_package_index = None  # KernelPackageIndex of the selected version
 
 
 ##################
@@ -219,6 +430,9 @@ class SpinningProgress:
         self.progress_indicator = itertools.cycle(self.progress_states)
 
     def start(self):
+        # a spinner in a log file is just noise
+        if not sys.stdout.isatty():
+            return
         if not self.abort_progress_sentinel:
             self.abort_progress_sentinel = False
             self.spinner_thread = threading.Thread(target=self.run_progress_indicator)
@@ -242,16 +456,1521 @@ class SpinningProgress:
         self.spinner_thread_running = False
 
 
+class TransferProgress:
+    is_terminal = None
+    frame_interval = None
+    transfers = None
+    progress_lock = None
+
+    def __init__(self, is_terminal):
+        self.is_terminal = is_terminal
+        # a terminal is redrawn in place a few times per
+        # second, a log gets a single line now and then
+        self.frame_interval = 1.0 / PROGRESS_FRAMES_PER_SEC if is_terminal else PROGRESS_LOG_INTERVAL_IN_SEC
+        self.transfers = dict()
+        self.progress_lock = threading.Lock()
+        self.begin(0)
+
+    def begin(self, transfer_count):
+        with self.progress_lock:
+            self.transfer_count = transfer_count
+            self.transfers.clear()  # name -> [done bytes, total bytes or None, bytes done before]
+            self.finished_transfers = list()
+            self.begin_time = time.time()
+            self.last_render_time = self.begin_time
+            self.rendered_line_count = 0
+
+    def start_transfer(self, transfer_name):
+        with self.progress_lock:
+            self.transfers[transfer_name] = [0, None, 0]
+
+    def set_transfer_size(self, transfer_name, total_bytes, done_bytes=0):
+        # resumed bytes count as done, but
+        # not into the rate of this session
+        with self.progress_lock:
+            self.transfers[transfer_name] = [done_bytes, total_bytes, done_bytes]
+            self.render()
+
+    def add_transfer_bytes(self, transfer_name, byte_count):
+        with self.progress_lock:
+            self.transfers[transfer_name][0] += byte_count
+            self.render()
+
+    def set_transfer_bytes(self, transfer_name, done_bytes):
+        with self.progress_lock:
+            transfer = self.transfers[transfer_name]
+            # a file that shrinks was started over
+            if done_bytes < transfer[2]:
+                transfer[2] = 0
+            transfer[0] = done_bytes
+            self.render()
+
+    def finish_transfer(self, transfer_name, succeeded):
+        with self.progress_lock:
+            transfer = self.transfers.pop(transfer_name, [0, None, 0])
+            self.finished_transfers.append([transfer[0] - transfer[2], succeeded])
+            self.render(True)
+
+    def end(self):
+        # the progress lines are removed, the summary
+        # line is what stays in the output
+        with self.progress_lock:
+            self.clear_rendered_lines()
+            elapsed_time = max(time.time() - self.begin_time, 0.001)
+            session_bytes = sum(finished_transfer[0] for finished_transfer in self.finished_transfers)
+            print_lb("Transferred {0} of {1} files, {2} in {3:.1f} seconds ({4}/s).".format(
+                len([finished_transfer for finished_transfer in self.finished_transfers if finished_transfer[1]]),
+                self.transfer_count, format_byte_size(session_bytes), elapsed_time,
+                format_byte_size(session_bytes / elapsed_time)))
+
+    def get_total_line(self):
+        elapsed_time = max(time.time() - self.begin_time, 0.001)
+        session_bytes = sum(finished_transfer[0] for finished_transfer in self.finished_transfers) + \
+            sum(transfer[0] - transfer[2] for transfer in self.transfers.values())
+        byte_rate = session_bytes / elapsed_time
+        total_line = "Total: {0} of {1} files, {2}, {3}/s".format(
+            len(self.finished_transfers), self.transfer_count, format_byte_size(session_bytes),
+            format_byte_size(byte_rate))
+
+        # the ETA is only known if all running transfers know their size
+        if self.transfers and byte_rate > 0 and \
+                all(transfer[1] is not None for transfer in self.transfers.values()):
+            remaining_bytes = sum(max(0, transfer[1] - transfer[0]) for transfer in self.transfers.values())
+            total_line += ", ETA {0}".format(format_duration(remaining_bytes / byte_rate))
+        return total_line
+
+    def get_transfer_line(self, transfer_name, transfer):
+        if transfer[1]:
+            transfer_state = "{0} / {1} {2:>3}%".format(
+                format_byte_size(transfer[0]), format_byte_size(transfer[1]), 100 * transfer[0] // transfer[1])
+        else:
+            transfer_state = format_byte_size(transfer[0])
+        # the state goes first, a long name
+        # is cut at the end of the line
+        return "  {0:<28} {1}".format(transfer_state, transfer_name)
+
+    def render(self, force=False):
+        # a finished transfer is redrawn at once on a
+        # terminal, the log only gets its periodic line
+        now = time.time()
+        if now - self.last_render_time < self.frame_interval and not (force and self.is_terminal):
+            return
+        self.last_render_time = now
+
+        if not self.is_terminal:
+            print_lb(self.get_total_line())
+            return
+
+        terminal_width = get_terminal_width()
+        progress_lines = [self.get_transfer_line(transfer_name, transfer)
+                          for transfer_name, transfer in sorted(self.transfers.items())]
+        progress_lines.append(self.get_total_line())
+
+        # long lines are cut, a wrapped line would
+        # break moving the cursor back up
+        frame = self.get_cursor_up_sequence() + "".join(
+            "\033[2K" + get_trimmed_line(progress_line, terminal_width - 1) + "\n"
+            for progress_line in progress_lines) + "\033[J"
+        self.rendered_line_count = len(progress_lines)
+        print_nlb(frame)
+
+    def get_cursor_up_sequence(self):
+        if self.rendered_line_count == 0:
+            return ""
+        return "\033[{0}F".format(self.rendered_line_count)
+
+    def clear_rendered_lines(self):
+        if self.is_terminal and self.rendered_line_count:
+            print_nlb(self.get_cursor_up_sequence() + "\033[J")
+        self.rendered_line_count = 0
+
+
+class TokenBucket:
+    rate = None
+    capacity = None
+    tokens = None
+    last_refill_time = None
+    bucket_lock = None
+
+    def __init__(self, rate, burst_in_sec=1):
+        self.rate = float(rate)  # tokens (bytes) per second
+        self.capacity = self.rate * burst_in_sec
+        self.tokens = self.capacity
+        self.last_refill_time = time.time()
+        self.bucket_lock = threading.Lock()
+
+    def reserve(self, token_count):
+        # every caller takes its tokens at once and may run
+        # into debt, it then has to wait until the debt is paid
+        # off, so concurrent transfers are served in arrival order
+        with self.bucket_lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill_time) * self.rate)
+            self.last_refill_time = now
+            self.tokens -= token_count
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def consume(self, token_count):
+        wait_time = self.reserve(token_count)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def get_rate_share(self, share_count):
+        # external tools can not take tokens from
+        # the bucket, they get a fixed share instead
+        return max(1, int(self.rate // max(1, share_count)))
+
+
+class RunMetrics:
+    run_start_time = None
+    phases = None
+    counters = None
+    file_transfers = None
+    running_phase_timers = None
+    metrics_lock = None
+
+    def __init__(self, run_start_time=None):
+        # the run is measured from the same start
+        # as the startup phase, imports included
+        self.run_start_time = time.time() if run_start_time is None else run_start_time
+        self.phases = dict()  # phase -> {"count": n, "seconds": s}
+        self.counters = dict()  # event -> count
+        self.file_transfers = list()
+        self.running_phase_timers = list()
+        self.metrics_lock = threading.Lock()
+
+    def start_phase(self, phase_name):
+        # the timer is a [phase_name, start_time] list
+        phase_timer = [phase_name, time.time()]
+        with self.metrics_lock:
+            self.running_phase_timers.append(phase_timer)
+        return phase_timer
+
+    def stop_phase(self, phase_timer):
+        # stopping a timer twice is allowed,
+        # only the first stop is counted
+        with self.metrics_lock:
+            if not any(running_phase_timer is phase_timer for running_phase_timer in self.running_phase_timers):
+                return 0
+            self.running_phase_timers = [running_phase_timer for running_phase_timer in self.running_phase_timers
+                                         if running_phase_timer is not phase_timer]
+        phase_seconds = time.time() - phase_timer[1]
+        self.add_phase_time(phase_timer[0], phase_seconds)
+        return phase_seconds
+
+    def add_phase_time(self, phase_name, phase_seconds):
+        with self.metrics_lock:
+            phase = self.phases.setdefault(phase_name, {"count": 0, "seconds": 0.0})
+            phase["count"] += 1
+            phase["seconds"] += phase_seconds
+
+    def add_counter(self, counter_name, counter_value=1):
+        with self.metrics_lock:
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + counter_value
+
+    def add_file_transfer(self, file_name, byte_count, transfer_seconds, transfer_succeeded):
+        with self.metrics_lock:
+            self.file_transfers.append({
+                "file": file_name,
+                "bytes": byte_count,
+                "seconds": round(transfer_seconds, 6),
+                "bytes_per_second": int(byte_count / transfer_seconds) if transfer_seconds > 0 else 0,
+                "succeeded": transfer_succeeded})
+
+    def get_file_totals(self):
+        # retries and mirror failovers add one transfer per
+        # attempt, a file is reported once with all of them
+        file_totals = list()
+        file_totals_by_name = dict()
+        for file_transfer in self.file_transfers:
+            file_total = file_totals_by_name.get(file_transfer["file"])
+            if file_total is None:
+                file_total = {"file": file_transfer["file"], "bytes": 0, "seconds": 0.0, "attempts": 0,
+                              "succeeded": False}
+                file_totals_by_name[file_transfer["file"]] = file_total
+                file_totals.append(file_total)
+            file_total["bytes"] += file_transfer["bytes"]
+            file_total["seconds"] = round(file_total["seconds"] + file_transfer["seconds"], 6)
+            file_total["attempts"] += 1
+            file_total["succeeded"] = file_total["succeeded"] or file_transfer["succeeded"]
+        for file_total in file_totals:
+            file_total["bytes_per_second"] = int(file_total["bytes"] / file_total["seconds"]) \
+                if file_total["seconds"] > 0 else 0
+        return file_totals
+
+    def get_report(self, exit_code):
+        # unfinished phases of an aborted
+        # run are counted up to now
+        for phase_timer in list(self.running_phase_timers):
+            self.stop_phase(phase_timer)
+
+        with self.metrics_lock:
+            file_totals = self.get_file_totals()
+            downloaded_bytes = sum(file_total["bytes"] for file_total in file_totals if file_total["succeeded"])
+            downloads_seconds = self.phases.get("downloads", {"seconds": 0.0})["seconds"]
+            return {
+                "run": {"start_time": self.run_start_time,
+                        "seconds": round(time.time() - self.run_start_time, 6),
+                        "exit_code": exit_code},
+                "phases": dict((phase_name, {"count": phase["count"], "seconds": round(phase["seconds"], 6)})
+                               for phase_name, phase in self.phases.items()),
+                "counters": dict(self.counters),
+                "downloads": {"files": len([file_total for file_total in file_totals if file_total["succeeded"]]),
+                              "failed_files": len([file_total for file_total in file_totals
+                                                   if not file_total["succeeded"]]),
+                              "bytes": downloaded_bytes,
+                              "bytes_per_second": int(downloaded_bytes / downloads_seconds)
+                              if downloads_seconds > 0 else 0},
+                "files": file_totals}
+
+    def format_prometheus_text(self, metrics_report):
+        metrics_lines = list()
+
+        def add_metric(metric_name, metric_help, metric_samples):
+            # all values describe the last run, so they are gauges
+            metrics_lines.append("# HELP {0}{1} {2}".format(METRICS_PROMETHEUS_PREFIX, metric_name, metric_help))
+            metrics_lines.append("# TYPE {0}{1} gauge".format(METRICS_PROMETHEUS_PREFIX, metric_name))
+            for metric_labels, metric_value in metric_samples:
+                metric_labels_text = ",".join("{0}=\"{1}\"".format(label_name, escape_prometheus_label_value(label_value))
+                                              for label_name, label_value in metric_labels)
+                metrics_lines.append("{0}{1}{2} {3}".format(
+                    METRICS_PROMETHEUS_PREFIX, metric_name,
+                    "{" + metric_labels_text + "}" if metric_labels_text else "", metric_value))
+
+        add_metric("run_start_time_seconds", "Start time of the last run.",
+                   [[[], metrics_report["run"]["start_time"]]])
+        add_metric("run_duration_seconds", "Duration of the last run.",
+                   [[[], metrics_report["run"]["seconds"]]])
+        add_metric("run_exit_code", "Exit code of the last run.",
+                   [[[], metrics_report["run"]["exit_code"]]])
+        add_metric("phase_duration_seconds", "Time spent in each phase of the last run.",
+                   [[[["phase", phase_name]], phase["seconds"]]
+                    for phase_name, phase in sorted(metrics_report["phases"].items())])
+        add_metric("phase_runs", "Number of times each phase ran in the last run.",
+                   [[[["phase", phase_name]], phase["count"]]
+                    for phase_name, phase in sorted(metrics_report["phases"].items())])
+        add_metric("events", "Retries, resumes and other counted events of the last run.",
+                   [[[["event", counter_name]], counter_value]
+                    for counter_name, counter_value in sorted(metrics_report["counters"].items())])
+        add_metric("download_files", "Number of downloaded files of the last run.",
+                   [[[["result", "succeeded"]], metrics_report["downloads"]["files"]],
+                    [[["result", "failed"]], metrics_report["downloads"]["failed_files"]]])
+        add_metric("download_bytes", "Downloaded bytes of the last run.",
+                   [[[], metrics_report["downloads"]["bytes"]]])
+        add_metric("download_throughput_bytes_per_second", "Overall download throughput of the last run.",
+                   [[[], metrics_report["downloads"]["bytes_per_second"]]])
+        add_metric("file_download_seconds", "Transfer time of each file of the last run.",
+                   [[[["file", file_transfer["file"]]], file_transfer["seconds"]]
+                    for file_transfer in metrics_report["files"]])
+        add_metric("file_download_bytes", "Size of each downloaded file of the last run.",
+                   [[[["file", file_transfer["file"]]], file_transfer["bytes"]]
+                    for file_transfer in metrics_report["files"]])
+        add_metric("file_download_attempts", "Transfer attempts of each file of the last run, failovers included.",
+                   [[[["file", file_transfer["file"]]], file_transfer["attempts"]]
+                    for file_transfer in metrics_report["files"]])
+
+        return "\n".join(metrics_lines) + "\n"
+
+    def export(self, output_file, exit_code):
+        # written atomically, so a collector
+        # never reads a half written file
+        metrics_report = self.get_report(exit_code)
+        if output_file.endswith(METRICS_PROMETHEUS_FILE_EXTENSION):
+            write_text_file(output_file, string_to_unicode(self.format_prometheus_text(metrics_report)))
+        else:
+            write_text_file(output_file, string_to_unicode(json.dumps(metrics_report, indent=2, sort_keys=True)))
+
+
 class WebFileDownloadError(Exception):
     def __init__(self, arg):
         # Set some exception information
         self.errmsg = arg
 
 
+class RetryableRequestError(WebFileDownloadError):
+    def __init__(self, arg, retry_after=None, host_failed=True):
+        WebFileDownloadError.__init__(self, arg)
+        self.retry_after = retry_after  # seconds the server asked us to wait
+        self.host_failed = host_failed  # False if the host sent data before the error
+
+
+class RequestDeadlineError(WebFileDownloadError):
+    pass
+
+
+class CircuitBreakerOpenError(WebFileDownloadError):
+    def __init__(self, arg, retry_after):
+        WebFileDownloadError.__init__(self, arg)
+        self.retry_after = retry_after  # seconds until the breaker lets a trial request through
+
+
+class RequestDeadline:
+    deadline_time = None
+
+    def __init__(self, deadline_in_sec):
+        self.deadline_time = time.time() + deadline_in_sec
+
+    def get_remaining(self):
+        return self.deadline_time - time.time()
+
+    def get_read_timeout(self):
+        # a read never waits past the deadline
+        remaining_time = self.get_remaining()
+        if remaining_time <= 0:
+            raise RequestDeadlineError("The request deadline has passed.")
+        return min(HTTP_STALL_TIMEOUT_IN_SEC, remaining_time)
+
+
+class HostCircuitBreaker:
+    failure_threshold = None
+    open_in_sec = None
+    breaker_lock = None
+    host_states = None
+
+    def __init__(self, failure_threshold, open_in_sec):
+        self.failure_threshold = failure_threshold
+        self.open_in_sec = open_in_sec
+        self.breaker_lock = threading.Lock()
+        self.host_states = dict()  # host -> [failures in a row, open until, trial running]
+
+    def check_request(self, host):
+        # an open breaker rejects all requests until its rest is
+        # over, then a single trial request decides whether it
+        # closes again or stays open for another rest
+        with self.breaker_lock:
+            host_state = self.host_states.get(host)
+            if host_state is None or host_state[0] < self.failure_threshold:
+                return
+            if time.time() >= host_state[1] and not host_state[2]:
+                host_state[2] = True
+                return
+            # while a trial request runs, ask
+            # again after the shortest backoff
+            retry_after = max(RETRY_BACKOFF_BASE_IN_SEC, host_state[1] - time.time())
+        run_metrics.add_counter("circuit_breaker_rejections")
+        raise CircuitBreakerOpenError(
+            "The host \"{0}\" failed {1} requests in a row and gets a rest.".format(host, host_state[0]), retry_after)
+
+    def is_open(self, host):
+        with self.breaker_lock:
+            host_state = self.host_states.get(host)
+            return host_state is not None and host_state[0] >= self.failure_threshold
+
+    def record_answer(self, host):
+        # any answer, even an error status,
+        # proves that the host is up again
+        with self.breaker_lock:
+            self.host_states.pop(host, None)
+
+    def record_failure(self, host):
+        with self.breaker_lock:
+            host_state = self.host_states.setdefault(host, [0, 0, False])
+            host_state[0] += 1
+            host_state[2] = False
+            if host_state[0] < self.failure_threshold:
+                return
+            host_state[1] = time.time() + self.open_in_sec
+        run_metrics.add_counter("circuit_breaker_openings")
+
+
+class DownloadJournal:
+    journal_file = None
+    journal_lock = None
+    journal_entries = None
+
+    def __init__(self, download_directory):
+        self.journal_file = os.path.join(download_directory, DOWNLOAD_JOURNAL_FILE)
+        self.journal_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with io.open(self.journal_file, "r", encoding="utf-8") as fp:
+                self.journal_entries = json.load(fp)
+        except:
+            self.journal_entries = dict()
+
+    def save(self):
+        # write to a temp file and rename it, so an
+        # abort never leaves a half written journal
+        journal_temp_file = self.journal_file + ".tmp"
+        with io.open(journal_temp_file, "w", encoding="utf-8") as fp:
+            fp.write(string_to_unicode(json.dumps(self.journal_entries, indent=1, sort_keys=True)))
+        os.rename(journal_temp_file, self.journal_file)
+
+    def is_verified(self, file_name, file_path, file_hashes):
+        with self.journal_lock:
+            journal_entry = self.journal_entries.get(file_name)
+            if journal_entry is None or journal_entry["state"] != "verified" or journal_entry["hashes"] != file_hashes:
+                return False
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                return False
+            # the file must be untouched since it was verified
+            return file_stat.st_size == journal_entry["size"] and int(file_stat.st_mtime) == journal_entry["mtime"]
+
+    def start(self, file_name, file_path, fromurl, file_hashes):
+        with self.journal_lock:
+            journal_entry = self.journal_entries.get(file_name)
+            # a partial file of another upload or a corrupted
+            # file must never be resumed, start from zero
+            if journal_entry is not None and \
+                    (journal_entry["hashes"] != file_hashes or journal_entry["state"] == "corrupted"):
+                for stale_file in [file_path + PARTIAL_DOWNLOAD_FILE_SUFFIX, file_path]:
+                    if os.path.isfile(stale_file):
+                        os.unlink(stale_file)
+            self.journal_entries[file_name] = {"state": "partial", "url": fromurl, "hashes": file_hashes}
+            self.save()
+
+    def finish(self, file_name, file_path, file_is_valid):
+        with self.journal_lock:
+            journal_entry = self.journal_entries[file_name]
+            if file_is_valid:
+                file_stat = os.stat(file_path)
+                journal_entry["state"] = "verified"
+                journal_entry["size"] = file_stat.st_size
+                journal_entry["mtime"] = int(file_stat.st_mtime)
+            elif os.path.isfile(file_path):
+                journal_entry["state"] = "corrupted"
+            self.save()
+
+    def mark_verified(self, file_name, file_path, file_hashes):
+        # a file replaced by a link to a verified copy
+        with self.journal_lock:
+            journal_entry = self.journal_entries.setdefault(file_name, {"url": None})
+            file_stat = os.stat(file_path)
+            journal_entry["state"] = "verified"
+            journal_entry["hashes"] = file_hashes
+            journal_entry["size"] = file_stat.st_size
+            journal_entry["mtime"] = int(file_stat.st_mtime)
+            self.save()
+
+    def mark_corrupted(self, file_name):
+        # a file that rotted after its verification looks
+        # unchanged, the next download must replace it
+        with self.journal_lock:
+            journal_entry = self.journal_entries.get(file_name)
+            if journal_entry is not None and journal_entry["state"] != "corrupted":
+                journal_entry["state"] = "corrupted"
+                self.save()
+
+
+class PooledHttpResponse:
+    connection_pool = None
+    connection_key = None
+    connection = None
+    response = None
+    content_decoder = None
+    request_deadline = None
+
+    def __init__(self, connection_pool, connection_key, connection, response, decode_content, request_deadline):
+        self.connection_pool = connection_pool
+        self.connection_key = connection_key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.request_deadline = request_deadline
+        # gzip bodies are inflated chunk by
+        # chunk while they are being read
+        if decode_content and (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            self.content_decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def apply_read_timeout(self):
+        # near the deadline a stalled read ends
+        # with it instead of the stall timeout
+        if self.request_deadline is not None:
+            read_timeout = self.request_deadline.get_read_timeout()
+            if read_timeout < HTTP_STALL_TIMEOUT_IN_SEC and self.connection is not None and \
+                    self.connection.sock is not None:
+                self.connection.sock.settimeout(read_timeout)
+
+    def read(self, size):
+        self.apply_read_timeout()
+        while True:
+            data_chunk = self.response.read(size)
+            if self.content_decoder is None:
+                break
+            if not data_chunk:
+                data_chunk = self.content_decoder.flush()
+                break
+            data_chunk = self.content_decoder.decompress(data_chunk)
+            # the decoder may buffer a small chunk
+            # completely, read on in that case
+            if data_chunk:
+                break
+        if not data_chunk:
+            self.close()
+        return data_chunk
+
+    def readinto(self, receive_buffer):
+        # a plain body is received straight into the buffer,
+        # python 2 and gzip bodies take the copying way
+        if self.content_decoder is not None or not hasattr(self.response, "readinto"):
+            data_chunk = self.read(len(receive_buffer))
+            receive_buffer[:len(data_chunk)] = data_chunk
+            return len(data_chunk)
+        self.apply_read_timeout()
+        received_byte_count = self.response.readinto(receive_buffer)
+        if not received_byte_count:
+            self.close()
+        return received_byte_count
+
+    def read_all(self):
+        data_chunks = list()
+        while True:
+            data_chunk = self.read(DOWNLOAD_CHUNK_SIZE)
+            if not data_chunk:
+                break
+            data_chunks.append(data_chunk)
+        return b"".join(data_chunks)
+
+    def close(self):
+        if self.connection is None:
+            return
+        # only a fully read response leaves the
+        # connection in a state we can reuse
+        if self.response.isclosed() and not self.response.will_close:
+            self.connection_pool.release_connection(self.connection_key, self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+
+
+class HttpConnectionPool:
+    pool_lock = None
+    idle_connections = None
+
+    def __init__(self, max_idle_connections_per_host):
+        self.max_idle_connections_per_host = max_idle_connections_per_host
+        self.pool_lock = threading.Lock()
+        self.idle_connections = dict()  # (scheme, host, port, proxy) -> [connection, ...]
+
+    def get_connection(self, connection_key):
+        with self.pool_lock:
+            idle_connections = self.idle_connections.get(connection_key)
+            if idle_connections:
+                return [idle_connections.pop(), True]
+
+        return [self.create_connection(connection_key), False]
+
+    def create_connection(self, connection_key):
+        scheme, host, port, proxy = connection_key
+
+        # plain http goes to the proxy directly, https
+        # is tunneled through the proxy with CONNECT
+        if proxy is not None:
+            proxy_url = urlsplit(proxy)
+            proxy_port = proxy_url.port or (443 if proxy_url.scheme == "https" else 80)
+            if scheme == "https":
+                connection = httplib.HTTPSConnection(proxy_url.hostname, proxy_port)
+                connection.set_tunnel(host, port)
+            else:
+                connection = httplib.HTTPConnection(proxy_url.hostname, proxy_port)
+        elif scheme == "https":
+            connection = httplib.HTTPSConnection(host, port)
+        else:
+            connection = httplib.HTTPConnection(host, port)
+
+        # the read timeout is set once connected
+        connection.timeout = HTTP_CONNECT_TIMEOUT_IN_SEC
+
+        return connection
+
+    def send_request(self, connection, request_path, headers, request_deadline):
+        # a new connection gets the connect timeout, then every read
+        # waits at most the stall timeout and never past the deadline,
+        # a stalled server raises a socket timeout instead of blocking
+        read_timeout = request_deadline.get_read_timeout() \
+            if request_deadline is not None else HTTP_STALL_TIMEOUT_IN_SEC
+        if connection.sock is None:
+            connection.timeout = min(HTTP_CONNECT_TIMEOUT_IN_SEC, read_timeout)
+            connection.connect()
+        connection.sock.settimeout(read_timeout)
+        connection.request("GET", request_path, headers=headers)
+        return connection.getresponse()
+
+    def release_connection(self, connection_key, connection):
+        with self.pool_lock:
+            idle_connections = self.idle_connections.setdefault(connection_key, list())
+            if len(idle_connections) < self.max_idle_connections_per_host:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def close_all(self):
+        with self.pool_lock:
+            for idle_connections in self.idle_connections.values():
+                for connection in idle_connections:
+                    connection.close()
+            self.idle_connections.clear()
+
+    def open_url(self, url, request_headers=None, decode_content=False, request_deadline=None):
+        for i in range(0, HTTP_MAX_REDIRECTS + 1):
+            source_url = urlsplit(url)
+            scheme = source_url.scheme.lower()
+            port = source_url.port or (443 if scheme == "https" else 80)
+            proxy = get_proxy_for_url(url)
+            connection_key = (scheme, source_url.hostname, port, proxy)
+
+            request_path = source_url.path or "/"
+            if source_url.query:
+                request_path += "?" + source_url.query
+            if proxy is not None and scheme != "https":
+                request_path = url
+
+            headers = {"User-Agent": HTTP_USER_AGENT}
+            if decode_content:
+                headers["Accept-Encoding"] = "gzip"
+            if request_headers:
+                headers.update(request_headers)
+
+            connection, connection_reused = self.get_connection(connection_key)
+            try:
+                response = self.send_request(connection, request_path, headers, request_deadline)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # the server may have dropped an idle
+                # keep-alive connection, retry on a new one
+                if not connection_reused:
+                    raise
+                run_metrics.add_counter("http_connection_retries")
+                connection = self.create_connection(connection_key)
+                response = self.send_request(connection, request_path, headers, request_deadline)
+
+            pooled_response = PooledHttpResponse(
+                self, connection_key, connection, response, decode_content, request_deadline)
+
+            # an overloaded or failing server is worth
+            # another attempt, the caller decides on it
+            if response.status in RETRY_HTTP_STATUS_CODES:
+                pooled_response.close()
+                raise RetryableRequestError(
+                    "The server answered \"{0}\" with status {1}.".format(url, response.status),
+                    parse_retry_after(response.getheader("Retry-After")))
+
+            if response.status not in HTTP_REDIRECT_STATUS_CODES:
+                return pooled_response
+
+            # drain the redirect body to keep the
+            # connection usable and follow it
+            pooled_response.read_all()
+            url = urljoin(url, response.getheader("Location"))
+
+        raise WebFileDownloadError("Too many redirects for \"{0}\".".format(url))
+
+
+class PackageCache:
+    cache_directory = None
+
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+
+    def get_object_path(self, file_hashes):
+        # objects are keyed by the strongest hash we know
+        for algorithm in ["sha256", "sha1"]:
+            if algorithm in file_hashes:
+                file_hash = file_hashes[algorithm]
+                return os.path.join(self.cache_directory, PACKAGE_CACHE_OBJECTS_FOLDER,
+                                    algorithm, file_hash[:2], file_hash)
+        return None
+
+    def contains(self, file_hashes):
+        object_path = self.get_object_path(file_hashes)
+        return object_path is not None and os.path.isfile(object_path)
+
+    def fetch(self, file_hashes, tofile):
+        if not self.contains(file_hashes):
+            return False
+        link_or_copy_file(self.get_object_path(file_hashes), tofile)
+        return True
+
+    def store(self, file_hashes, fromfile):
+        object_path = self.get_object_path(file_hashes)
+        if object_path is None or os.path.isfile(object_path):
+            return
+        object_directory = os.path.dirname(object_path)
+        if not os.path.isdir(object_directory):
+            try:
+                os.makedirs(object_directory)
+            except OSError:
+                pass  # created by another worker meanwhile
+        link_or_copy_file(fromfile, object_path)
+
+
+class MetadataCache:
+    cache_directory = None
+    memo_lock = None
+    memo_entries = None
+
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        self.memo_lock = threading.Lock()
+        self.memo_entries = dict()  # url -> text, valid for this session
+
+    def get_entry_path(self, url):
+        return os.path.join(self.cache_directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def load_entry(self, url):
+        try:
+            with io.open(self.get_entry_path(url), "r", encoding="utf-8") as fp:
+                cache_entry = json.load(fp)
+            return cache_entry if cache_entry["url"] == url else None
+        except:
+            return None
+
+    def save_entry(self, url, etag, last_modified, text):
+        if not os.path.isdir(self.cache_directory):
+            os.makedirs(self.cache_directory)
+        cache_entry = {"url": url, "etag": etag, "last_modified": last_modified, "text": text}
+        entry_path = self.get_entry_path(url)
+        entry_temp_path = entry_path + ".tmp-{0}".format(threading.current_thread().ident)
+        with io.open(entry_temp_path, "w", encoding="utf-8") as fp:
+            fp.write(string_to_unicode(json.dumps(cache_entry)))
+        os.rename(entry_temp_path, entry_path)
+
+    def forget(self, url):
+        # the next request revalidates the stored copy
+        with self.memo_lock:
+            self.memo_entries.pop(url, None)
+
+    def prepare_request(self, url):
+        # returns [text, cache_entry, request_headers], the text
+        # is set if the url was fetched once in this session already
+        with self.memo_lock:
+            if url in self.memo_entries:
+                return [self.memo_entries[url], None, None]
+
+        # revalidate the stored copy, a 304 means
+        # the cached text is still the current one
+        cache_entry = self.load_entry(url)
+        request_headers = dict()
+        if cache_entry is not None:
+            if cache_entry["etag"]:
+                request_headers["If-None-Match"] = cache_entry["etag"]
+            if cache_entry["last_modified"]:
+                request_headers["If-Modified-Since"] = cache_entry["last_modified"]
+        return [None, cache_entry, request_headers]
+
+    def complete_request(self, url, cache_entry, status, etag, last_modified, web_response_text):
+        if status == 304 and cache_entry is not None:
+            run_metrics.add_counter("metadata_cache_revalidations")
+            web_response_text = cache_entry["text"]
+        elif status == 200:
+            web_response_text = web_response_text.decode("utf-8")
+            try:
+                self.save_entry(url, etag, last_modified, web_response_text)
+            except (IOError, OSError):
+                pass  # a read-only cache is no reason to fail
+        else:
+            return [status, None]
+
+        with self.memo_lock:
+            self.memo_entries[url] = web_response_text
+        return [200, web_response_text]
+
+    def get(self, url, request_deadline=None):
+        web_response_text, cache_entry, request_headers = self.prepare_request(url)
+        if web_response_text is not None:
+            return [200, web_response_text]
+
+        web_response = http_connection_pool.open_url(url, request_headers, True, request_deadline)
+        return self.complete_request(url, cache_entry, web_response.status, web_response.getheader("ETag"),
+                                     web_response.getheader("Last-Modified"), web_response.read_all())
+
+
+class KernelPackageRecord:
+    def __init__(self, name, kind, version, arch, flavor, size=None, sha1=None, sha256=None):
+        self.name = name  # the DEB file name
+        self.kind = kind  # headers, image, image-unsigned, modules, ...
+        self.version = version
+        self.arch = arch
+        self.flavor = flavor  # None for arch independent packages
+        self.size = size  # unknown until downloaded
+        self.sha1 = sha1
+        self.sha256 = sha256
+
+    def get_hashes(self):
+        return dict((algorithm, getattr(self, algorithm)) for algorithm in ["sha1", "sha256"]
+                    if getattr(self, algorithm) is not None)
+
+    def get_install_order_key(self):
+        kind_rank = KERNEL_PACKAGE_INSTALL_ORDER.index(self.kind) \
+            if self.kind in KERNEL_PACKAGE_INSTALL_ORDER else len(KERNEL_PACKAGE_INSTALL_ORDER)
+        return [kind_rank, self.arch != KERNEL_PACKAGE_ARCH_INDEPENDENT, self.name]
+
+
+class KernelPackageIndex:
+    kernel_version = None
+    records = None
+    records_by_name = None
+    records_by_target = None
+    records_by_kind = None
+    architectures = None
+    flavors_by_arch = None
+
+    def __init__(self, kernel_version):
+        self.kernel_version = kernel_version
+        self.records = list()  # CHECKSUMS order
+        self.records_by_name = dict()
+        self.records_by_target = dict()  # (arch, flavor) -> [record, ...]
+        self.records_by_kind = dict()  # kind -> [record, ...]
+        self.architectures = list()
+        self.flavors_by_arch = dict()  # arch -> [flavor, ...]
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_record(self, name):
+        return self.records_by_name.get(name)
+
+    def get_records_by_kind(self, kind):
+        return self.records_by_kind.get(kind, list())
+
+    def get_flavors(self, arch):
+        return self.flavors_by_arch.get(arch, list())
+
+    def has_target(self, arch, flavor):
+        return (arch, flavor) in self.records_by_target
+
+    def get_target_records(self, arch, flavor):
+        # the arch independent packages belong to every target
+        if not self.has_target(arch, flavor):
+            return list()
+        return self.records_by_target.get((KERNEL_PACKAGE_ARCH_INDEPENDENT, None), list()) + \
+            self.records_by_target[(arch, flavor)]
+
+    def add_checksum(self, name, algorithm, checksum):
+        record = self.records_by_name.get(name)
+
+        if record is None:
+            record = self.create_record(name)
+            self.records.append(record)
+            self.records_by_name[name] = record
+            self.records_by_target.setdefault((record.arch, record.flavor), list()).append(record)
+            self.records_by_kind.setdefault(record.kind, list()).append(record)
+            if record.arch != KERNEL_PACKAGE_ARCH_INDEPENDENT and record.flavor is not None:
+                if record.arch not in self.architectures:
+                    self.architectures.append(record.arch)
+                arch_flavors = self.flavors_by_arch.setdefault(record.arch, list())
+                if record.flavor not in arch_flavors:
+                    arch_flavors.append(record.flavor)
+
+        setattr(record, algorithm, checksum.lower())
+
+    def create_record(self, name):
+        file_match = KERNEL_PACKAGE_FILE_PATTERN.match(name)
+        if file_match is None:
+            return KernelPackageRecord(name, None, self.kernel_version, None, None)
+        name_match = KERNEL_PACKAGE_NAME_PATTERN.match(file_match.group("name"))
+        if name_match is None:
+            return KernelPackageRecord(name, None, self.kernel_version, file_match.group("arch"), None)
+        return KernelPackageRecord(name, name_match.group("kind"), self.kernel_version,
+                                   file_match.group("arch"), name_match.group("flavor"))
+
+
+class ArchiveMirrorRanking:
+    archive_urls = None
+    ranking_file = None
+    mirror_probes = None
+    ranked_urls = None
+    ranking_lock = None
+
+    def __init__(self, archive_urls, ranking_file):
+        self.archive_urls = archive_urls
+        self.ranking_file = ranking_file
+        self.mirror_probes = dict()  # url -> {"latency": s, "bytes_per_second": n, "time": t}
+        self.ranked_urls = list(archive_urls)
+        self.ranking_lock = threading.Lock()
+        try:
+            with io.open(ranking_file, "r", encoding="utf-8") as fp:
+                self.mirror_probes = json.load(fp)
+        except:
+            pass
+
+    def is_probe_fresh(self, archive_url):
+        return archive_url in self.mirror_probes and \
+            time.time() - self.mirror_probes[archive_url]["time"] < ARCHIVE_MIRROR_RANKING_MAX_AGE_IN_SEC
+
+    def get_expected_seconds(self, archive_url):
+        # unreachable mirrors go last, the others by the
+        # time they would need for a typical kernel package
+        mirror_probe = self.mirror_probes.get(archive_url)
+        if mirror_probe is None or mirror_probe["latency"] is None:
+            return float("inf")
+        return mirror_probe["latency"] + \
+            ARCHIVE_MIRROR_REFERENCE_FILE_SIZE / float(max(1, mirror_probe["bytes_per_second"]))
+
+    def rank(self):
+        # only mirrors without a recent result are probed,
+        # returns the urls probed in this run
+        probe_urls = [archive_url for archive_url in self.archive_urls if not self.is_probe_fresh(archive_url)]
+        if len(probe_urls) > 0:
+            probe_results = probe_archive_mirrors(probe_urls)
+            for archive_url in probe_urls:
+                probe_result = probe_results.get(archive_url)
+                self.mirror_probes[archive_url] = {"latency": probe_result[0] if probe_result else None,
+                                                   "bytes_per_second": probe_result[1] if probe_result else 0,
+                                                   "time": time.time()}
+            self.save()
+        with self.ranking_lock:
+            self.ranked_urls = sorted(self.archive_urls, key=self.get_expected_seconds)
+        return probe_urls
+
+    def save(self):
+        try:
+            if not os.path.isdir(os.path.dirname(self.ranking_file)):
+                os.makedirs(os.path.dirname(self.ranking_file))
+            write_text_file(self.ranking_file, string_to_unicode(json.dumps(self.mirror_probes)))
+        except (IOError, OSError):
+            pass  # probed again on the next run
+
+    def get_ranked_urls(self):
+        with self.ranking_lock:
+            return list(self.ranked_urls)
+
+    def demote(self, fromurl):
+        # the mirror that failed a transfer is asked
+        # last for the rest of this run
+        with self.ranking_lock:
+            for archive_url in self.ranked_urls:
+                if fromurl.startswith(archive_url + "/"):
+                    self.ranked_urls.remove(archive_url)
+                    self.ranked_urls.append(archive_url)
+                    return
+
+
+class KernelArchiveIndex:
+    archive_url = None
+    index_file = None
+    refresh_time = 0
+    kernel_versions = None
+    is_changed = False
+
+    def __init__(self, archive_url, index_file):
+        self.archive_url = archive_url
+        self.index_file = index_file
+        self.kernel_versions = dict()  # version -> {"modified": date or None, "architectures": [...] or None}
+        try:
+            with io.open(index_file, "r", encoding="utf-8") as fp:
+                index_entry = json.load(fp)
+            if index_entry["archive_url"] == archive_url:
+                self.refresh_time = index_entry["refresh_time"]
+                self.kernel_versions = index_entry["kernel_versions"]
+        except:
+            pass
+
+    def is_fresh(self):
+        return time.time() - self.refresh_time < KERNEL_ARCHIVE_INDEX_MAX_AGE_IN_SEC
+
+    def update(self, archive_index_text):
+        # only new versions and versions with another modification
+        # date are reset, the others keep their known architectures,
+        # returns the number of added, changed and removed versions
+        listed_versions = dict()
+        for kernel_version, listing_text in KERNEL_ARCHIVE_INDEX_ENTRY_PATTERN.findall(archive_index_text):
+            modified_match = KERNEL_ARCHIVE_INDEX_DATE_PATTERN.search(listing_text)
+            listed_versions[kernel_version] = modified_match.group(0) if modified_match else None
+
+        changed_version_count = 0
+        for kernel_version, modified in listed_versions.items():
+            kernel_version_entry = self.kernel_versions.get(kernel_version)
+            if kernel_version_entry is None or kernel_version_entry["modified"] != modified:
+                self.kernel_versions[kernel_version] = {"modified": modified, "architectures": None}
+                changed_version_count += 1
+        for kernel_version in list(self.kernel_versions.keys()):
+            if kernel_version not in listed_versions:
+                del self.kernel_versions[kernel_version]
+                changed_version_count += 1
+
+        self.refresh_time = time.time()
+        self.is_changed = True
+        return changed_version_count
+
+    def get_architectures(self, kernel_version):
+        return self.kernel_versions[kernel_version]["architectures"]
+
+    def set_architectures(self, kernel_version, architectures):
+        kernel_version_entry = self.kernel_versions.get(kernel_version)
+        if kernel_version_entry is not None and kernel_version_entry["architectures"] != sorted(architectures):
+            kernel_version_entry["architectures"] = sorted(architectures)
+            self.is_changed = True
+
+    def get_unknown_architecture_versions(self, kernel_versions):
+        return [kernel_version for kernel_version in kernel_versions
+                if self.kernel_versions[kernel_version]["architectures"] is None]
+
+    def find_versions(self, series=None, since=None, architectures=None, include_rc=False):
+        # oldest first, versions with unknown architectures
+        # never match an architecture query
+        kernel_versions = list()
+        for kernel_version, kernel_version_entry in self.kernel_versions.items():
+            if not include_rc and not is_kernel_release_version(kernel_version):
+                continue
+            if series is not None and not is_kernel_version_in_series(kernel_version, series):
+                continue
+            if since is not None and \
+                    get_kernel_version_sort_key(kernel_version) < get_kernel_version_sort_key(since):
+                continue
+            if architectures and (kernel_version_entry["architectures"] is None or not all(
+                    architecture in kernel_version_entry["architectures"] for architecture in architectures)):
+                continue
+            kernel_versions.append(kernel_version)
+        return sorted(kernel_versions, key=get_kernel_version_sort_key)
+
+    def save(self):
+        if not self.is_changed:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.index_file)):
+                os.makedirs(os.path.dirname(self.index_file))
+            write_text_file(self.index_file, string_to_unicode(json.dumps(
+                {"archive_url": self.archive_url, "refresh_time": self.refresh_time,
+                 "kernel_versions": self.kernel_versions})))
+            self.is_changed = False
+        except (IOError, OSError):
+            pass  # requested again on the next run
+
+
+class ToolDiscoveryCache:
+    cache_file = None
+    search_path_key = None
+    tool_paths = None
+    is_changed = False
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.search_path_key = self.get_search_path_key()
+        self.tool_paths = dict()  # tool name -> full path, None if missing
+        try:
+            with io.open(cache_file, "r", encoding="utf-8") as fp:
+                cache_entry = json.load(fp)
+            if cache_entry["search_path_key"] == self.search_path_key:
+                self.tool_paths = cache_entry["tool_paths"]
+        except:
+            pass
+
+    def get_search_path_key(self):
+        # installing or removing a tool changes the modification
+        # time of its directory, so one stat per PATH entry
+        # tells whether the cached results are still true
+        search_path_key = list()
+        for search_directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+            try:
+                search_path_key.append([search_directory, os.stat(search_directory).st_mtime])
+            except OSError:
+                search_path_key.append([search_directory, None])
+        return search_path_key
+
+    def find(self, tool_name):
+        if tool_name not in self.tool_paths:
+            self.tool_paths[tool_name] = find_executable_in_path(tool_name)
+            self.is_changed = True
+        return self.tool_paths[tool_name]
+
+    def save(self):
+        if not self.is_changed:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.cache_file)):
+                os.makedirs(os.path.dirname(self.cache_file))
+            write_text_file(self.cache_file, string_to_unicode(json.dumps(
+                {"search_path_key": self.search_path_key, "tool_paths": self.tool_paths})))
+            self.is_changed = False
+        except (IOError, OSError):
+            pass  # found again on the next start
+
+
+class AuditResultCache:
+    cache_file = None
+    cache_lock = None
+    file_entries = None
+    is_changed = False
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.cache_lock = threading.Lock()
+        self.file_entries = dict()  # file path -> {"size", "mtime", "inode", "audited", "hashes"}
+        try:
+            with io.open(cache_file, "r", encoding="utf-8") as fp:
+                self.file_entries = json.load(fp)["files"]
+        except:
+            pass
+
+    def get(self, file_path, file_stat, algorithm):
+        # the hash of the last audit is still true as
+        # long as the file was neither written nor replaced
+        with self.cache_lock:
+            file_entry = self.file_entries.get(file_path)
+            if file_entry is None or file_entry["size"] != file_stat.st_size or \
+                    file_entry["mtime"] != file_stat.st_mtime or file_entry["inode"] != file_stat.st_ino or \
+                    time.time() - file_entry["audited"] > AUDIT_RESULT_MAX_AGE_IN_SEC:
+                return None
+            return file_entry["hashes"].get(algorithm)
+
+    def set(self, file_path, file_stat, algorithm, file_hash):
+        with self.cache_lock:
+            self.file_entries[file_path] = {"size": file_stat.st_size, "mtime": file_stat.st_mtime,
+                                            "inode": file_stat.st_ino, "audited": time.time(),
+                                            "hashes": {algorithm: file_hash}}
+            self.is_changed = True
+
+    def prune(self, file_paths):
+        # forget the files that are gone from the tree
+        with self.cache_lock:
+            for file_path in set(self.file_entries) - set(file_paths):
+                del self.file_entries[file_path]
+                self.is_changed = True
+
+    def save(self):
+        if not self.is_changed:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.cache_file)):
+                os.makedirs(os.path.dirname(self.cache_file))
+            write_text_file(self.cache_file, string_to_unicode(json.dumps({"files": self.file_entries})))
+            self.is_changed = False
+        except (IOError, OSError):
+            pass  # hashed again on the next audit
+
+
+class SingleFlight:
+    flights_lock = None
+    flights = None
+
+    def __init__(self):
+        self.flights_lock = threading.Lock()
+        self.flights = dict()  # key -> [threading.Event, result]
+
+    def run(self, key, task_function, *task_arguments):
+        # the first caller runs the task, callers with the same
+        # key arriving meanwhile wait and share its result
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            is_flight_leader = flight is None
+            if is_flight_leader:
+                flight = [threading.Event(), None]
+                self.flights[key] = flight
+
+        if not is_flight_leader:
+            run_metrics.add_counter("single_flight_joins")
+            flight[0].wait()
+            return flight[1]
+
+        try:
+            flight[1] = task_function(*task_arguments)
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight[0].set()
+        return flight[1]
+
+
+class LanCache:
+    download_directory = None
+    package_cache = None
+    metadata_lock = None
+    metadata_fetch_times = None
+    package_indexes = None
+    single_flight = None
+
+    def __init__(self, download_directory, package_cache):
+        self.download_directory = download_directory
+        self.package_cache = package_cache
+        self.metadata_lock = threading.Lock()
+        self.metadata_fetch_times = dict()  # url -> time of the last upstream request
+        self.package_indexes = dict()  # version directory -> [CHECKSUMS text, KernelPackageIndex]
+        self.single_flight = SingleFlight()
+
+    def get_metadata(self, urls):
+        # the same file from every ranked mirror in turn
+        for url in urls:
+            metadata_text = self.get_mirror_metadata(url)
+            if metadata_text is not None:
+                return metadata_text
+        return None
+
+    def get_mirror_metadata(self, url):
+        # the metadata cache answers from memory, after the max age
+        # it revalidates once with upstream, concurrent requests
+        # for the same url share that one request
+        with self.metadata_lock:
+            if time.time() - self.metadata_fetch_times.get(url, 0) > LAN_CACHE_METADATA_MAX_AGE_IN_SEC:
+                self.metadata_fetch_times[url] = time.time()
+                if kernel_metadata_cache is not None:
+                    kernel_metadata_cache.forget(url)
+        web_response = self.single_flight.run(url, open_webfile_get_response, url)
+        if web_response[1] is None or web_response[0] != 200:
+            with self.metadata_lock:
+                self.metadata_fetch_times.pop(url, None)
+            return None
+        return web_response[1]
+
+    def get_local_kernel_locations(self, kernel_version_directory_string):
+        kernel_locations = list()
+        kernel_version_directory = os.path.join(self.download_directory, kernel_version_directory_string)
+        if os.path.isdir(kernel_version_directory):
+            for kernel_arch in sorted(os.listdir(kernel_version_directory)):
+                kernel_arch_directory = os.path.join(kernel_version_directory, kernel_arch)
+                if os.path.isdir(kernel_arch_directory):
+                    for kernel_flavor in sorted(os.listdir(kernel_arch_directory)):
+                        if os.path.isdir(os.path.join(kernel_arch_directory, kernel_flavor)):
+                            kernel_locations.append(os.path.join(kernel_arch_directory, kernel_flavor))
+        return kernel_locations
+
+    def get_archive_index(self):
+        # the upstream index lists all versions, without
+        # upstream only the locally downloaded ones are known
+        archive_index_text = self.get_metadata([archive_url + "/" for archive_url in get_upstream_kernel_archive_urls()])
+        if archive_index_text is not None:
+            return archive_index_text
+        kernel_version_directories = [kernel_version_directory_string
+                                      for kernel_version_directory_string in sorted(os.listdir(self.download_directory))
+                                      if kernel_version_directory_string.startswith("v") and
+                                      len(self.get_local_kernel_locations(kernel_version_directory_string)) > 0]
+        return self.format_directory_index("/", kernel_version_directories, True)
+
+    def get_checksums(self, kernel_version_directory_string):
+        kernel_checksums_text = self.get_metadata(
+            get_upstream_kernel_file_urls(kernel_version_directory_string, CHECKSUMS_FILE))
+        if kernel_checksums_text is not None:
+            return kernel_checksums_text
+        # offline, every downloaded target keeps a copy
+        for kernel_location in self.get_local_kernel_locations(kernel_version_directory_string):
+            checksums_full_path = os.path.join(kernel_location, CHECKSUMS_FILE)
+            if os.path.isfile(checksums_full_path):
+                with io.open(checksums_full_path, "r", encoding="utf-8") as fp:
+                    return fp.read()
+        return None
+
+    def get_package_index(self, kernel_version_directory_string):
+        kernel_checksums_text = self.get_checksums(kernel_version_directory_string)
+        if kernel_checksums_text is None:
+            return None
+        with self.metadata_lock:
+            package_index_entry = self.package_indexes.get(kernel_version_directory_string)
+            if package_index_entry is None or package_index_entry[0] != kernel_checksums_text:
+                package_index_entry = [kernel_checksums_text, parse_kernel_checksums(
+                    kernel_checksums_text, kernel_version_directory_string[1:])]
+                self.package_indexes[kernel_version_directory_string] = package_index_entry
+        return package_index_entry[1]
+
+    def get_package_file(self, kernel_version_directory_string, kernel_deb_file):
+        # returns the path of a verified copy, cache misses are
+        # fetched from upstream once, no matter how many hosts
+        # ask for the same file at the same time
+        kernel_package_index = self.get_package_index(kernel_version_directory_string)
+        if kernel_package_index is None:
+            return None
+        kernel_package_record = kernel_package_index.get_record(kernel_deb_file)
+        if kernel_package_record is None:
+            return None
+        kernel_file_hashes = kernel_package_record.get_hashes()
+
+        if self.package_cache.contains(kernel_file_hashes):
+            run_metrics.add_counter("lan_cache_hits")
+            return self.package_cache.get_object_path(kernel_file_hashes)
+
+        # files downloaded into the tree before
+        # the package cache was used
+        for kernel_location in self.get_local_kernel_locations(kernel_version_directory_string):
+            kernel_file_full_path = os.path.join(kernel_location, kernel_deb_file)
+            if DownloadJournal(kernel_location).is_verified(kernel_deb_file, kernel_file_full_path, kernel_file_hashes):
+                run_metrics.add_counter("lan_cache_hits")
+                self.package_cache.store(kernel_file_hashes, kernel_file_full_path)
+                return kernel_file_full_path
+
+        return self.single_flight.run(self.package_cache.get_object_path(kernel_file_hashes),
+                                      self.fetch_package_file, kernel_version_directory_string, kernel_package_record)
+
+    def fetch_package_file(self, kernel_version_directory_string, kernel_package_record):
+        kernel_file_hashes = kernel_package_record.get_hashes()
+        object_path = self.package_cache.get_object_path(kernel_file_hashes)
+        # a flight that just landed
+        if os.path.isfile(object_path):
+            return object_path
+
+        run_metrics.add_counter("lan_cache_misses")
+        incoming_directory = os.path.join(self.package_cache.cache_directory, LAN_CACHE_INCOMING_FOLDER)
+        if not os.path.isdir(incoming_directory):
+            try:
+                os.makedirs(incoming_directory)
+            except OSError:
+                pass  # created by another request meanwhile
+        incoming_full_path = os.path.join(incoming_directory, os.path.basename(object_path))
+
+        kernel_file_hashers = create_file_hashers(kernel_file_hashes.keys())
+        if not download_file_from_mirrors(
+                get_upstream_kernel_file_urls(kernel_version_directory_string, kernel_package_record.name),
+                incoming_full_path, True, kernel_file_hashers):
+            return None
+
+        try:
+            if all(kernel_file_hashers[kernel_checksum_algorithm].hexdigest() == kernel_remote_hash
+                   for kernel_checksum_algorithm, kernel_remote_hash in kernel_file_hashes.items()):
+                self.package_cache.store(kernel_file_hashes, incoming_full_path)
+                return object_path
+            run_metrics.add_counter("corrupted_files")
+            return None
+        finally:
+            os.unlink(incoming_full_path)
+
+    def format_directory_index(self, directory_path, entry_names, entries_are_directories):
+        # the same href layout the upstream
+        # archive index pages use
+        return "<html><head><title>Index of {0}</title></head><body>\n".format(directory_path) + "".join(
+            "<a href=\"{0}\">{0}</a>\n".format(entry_name + ("/" if entries_are_directories else ""))
+            for entry_name in entry_names) + "</body></html>\n"
+
+
+class LanCacheRequestHandler:
+    # mixed into BaseHTTPRequestHandler by create_lan_cache_http_server
+    protocol_version = "HTTP/1.1"  # keep-alive for the clients connection pool
+    disable_nagle_algorithm = True
+    server_version = "sukd"
+
+    def do_HEAD(self):
+        self.handle_kernel_archive_request(False)
+
+    def do_GET(self):
+        self.handle_kernel_archive_request(True)
+
+    def handle_kernel_archive_request(self, send_body):
+        lan_cache = self.server.lan_cache
+        run_metrics.add_counter("lan_cache_requests")
+        request_path = unquote(urlsplit(self.path).path)
+        request_path_parts = request_path.lstrip("/").split("/", 1)
+
+        if request_path == "/":
+            self.send_text(lan_cache.get_archive_index(), "text/html", send_body)
+            return
+        if not request_path_parts[0].startswith("v") or ".." in request_path.split("/"):
+            self.send_error_status(404)
+            return
+
+        kernel_version_directory_string = request_path_parts[0]
+        kernel_file_name = request_path_parts[1] if len(request_path_parts) > 1 else ""
+
+        if kernel_file_name == "":
+            kernel_package_index = lan_cache.get_package_index(kernel_version_directory_string)
+            if kernel_package_index is None:
+                self.send_error_status(404)
+                return
+            self.send_text(lan_cache.format_directory_index(request_path, [CHECKSUMS_FILE] + [
+                kernel_package_record.name for kernel_package_record in kernel_package_index.records], False),
+                "text/html", send_body)
+        elif kernel_file_name == CHECKSUMS_FILE:
+            kernel_checksums_text = lan_cache.get_checksums(kernel_version_directory_string)
+            if kernel_checksums_text is None:
+                self.send_error_status(404)
+                return
+            self.send_text(kernel_checksums_text, "text/plain", send_body)
+        else:
+            kernel_file_full_path = lan_cache.get_package_file(kernel_version_directory_string, kernel_file_name)
+            if kernel_file_full_path is None:
+                self.send_error_status(404)
+                return
+            self.send_file(kernel_file_full_path, send_body)
+
+    def send_error_status(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_text(self, text, content_type, send_body):
+        # the ETag lets the clients metadata
+        # cache revalidate with a 304
+        text_bytes = text.encode("utf-8")
+        text_etag = "\"{0}\"".format(hashlib.sha1(text_bytes).hexdigest())
+        if self.headers.get("If-None-Match") == text_etag:
+            self.send_response(304)
+            self.send_header("ETag", text_etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(text_bytes)))
+        self.send_header("ETag", text_etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(text_bytes)
+
+    def send_file(self, file_path, send_body):
+        file_size = get_file_size(file_path)
+        range_start, range_end = 0, file_size - 1
+
+        # clients resume and segment their
+        # downloads with single byte ranges
+        range_match = re.match(r"^bytes=(\d*)-(\d*)$", (self.headers.get("Range") or "").strip())
+        if range_match is not None and (range_match.group(1) or range_match.group(2)):
+            if range_match.group(1):
+                range_start = int(range_match.group(1))
+                if range_match.group(2):
+                    range_end = min(int(range_match.group(2)), file_size - 1)
+            else:
+                range_start = max(0, file_size - int(range_match.group(2)))
+            if range_start >= file_size or range_start > range_end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{0}".format(file_size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(range_start, range_end, file_size))
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Type", "application/vnd.debian.binary-package")
+        self.send_header("Content-Length", str(range_end - range_start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not send_body:
+            return
+
+        remaining_byte_count = range_end - range_start + 1
+        with open(file_path, "rb") as fp:
+            fp.seek(range_start)
+            while remaining_byte_count > 0:
+                data_chunk = fp.read(min(DOWNLOAD_CHUNK_SIZE, remaining_byte_count))
+                if not data_chunk:
+                    break
+                self.wfile.write(data_chunk)
+                remaining_byte_count -= len(data_chunk)
+        run_metrics.add_counter("lan_cache_sent_bytes", range_end - range_start + 1 - remaining_byte_count)
+
+    def log_message(self, format, *args):
+        print_lb("{0} - {1}".format(self.client_address[0], format % args))
+
+
+class LanCacheHttpServer:
+    # mixed into a threading HTTPServer by create_lan_cache_http_server
+    daemon_threads = True
+    allow_reuse_address = True
+    lan_cache = None
+
+    def handle_error(self, request, client_address):
+        # mostly clients closing the connection
+        # in the middle of a download
+        print_lb("{0} - request failed: {1}".format(client_address[0], sys.exc_info()[1]))
+
+
 ###########################
 # Global object instances #
 ###########################
 progress_spinner = SpinningProgress()
+http_connection_pool = HttpConnectionPool(HTTP_MAX_IDLE_CONNECTIONS_PER_HOST)
+download_bandwidth_limiter = None  # TokenBucket shared by all downloads
+run_metrics = RunMetrics(script_start_time)
+transfer_progress = None  # TransferProgress while files are downloaded
+async_transfer_engine = None  # sukd_async.AsyncTransferEngine if enabled
+archive_mirror_ranking = None  # ArchiveMirrorRanking if there are mirrors
+host_circuit_breaker = HostCircuitBreaker(CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_OPEN_IN_SEC)
+kernel_archive_index = None  # KernelArchiveIndex, loaded on first use
+libc_fallocate = None  # ctypes fallocate, False where it is missing
 
 
 ###################
@@ -301,6 +2020,36 @@ def stop_progress_spinner():
         progress_spinner.spinner_thread.join()
 
 
+def get_terminal_width():
+    try:
+        return shutil.get_terminal_size().columns
+    except AttributeError:
+        # python 2 has no terminal size query
+        return PROGRESS_TERMINAL_WIDTH
+
+
+def get_cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def get_trimmed_line(line, width):
+    if len(line) <= width:
+        return line
+    return line[:max(0, width - 3)] + "..."
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+    return "{0}:{1:02d}".format(minutes, seconds)
+
+
 def strlen_unicode(s):
     return len(s.encode('utf-8'))
 
@@ -313,21 +2062,57 @@ def string_to_unicode(string):
 
 
 def exit_script(n):
+    if async_transfer_engine is not None:
+        async_transfer_engine.close()
+    if METRICS_OUTPUT_FILE:
+        try:
+            run_metrics.export(METRICS_OUTPUT_FILE, n)
+        except (IOError, OSError):
+            print_lb("Could not write the metrics file \"{0}\".".format(METRICS_OUTPUT_FILE))
     sys.exit(n)
 
 
+def escape_prometheus_label_value(label_value):
+    return string_to_unicode(label_value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
 def is_internet_available():
+    if async_transfer_engine is not None:
+        return async_transfer_engine.run(async_transfer_engine.probe_servers(
+            SERVERS_TO_PROBE_FOR_CONNECTION, SERVER_PORT_TO_PROBE, SERVER_PROBE_DEADLINE_IN_SEC))
+
+    # all servers are probed at once, the first
+    # successful connect wins, all share one deadline
+    probe_results = queue.Queue()
+    probe_deadline = time.time() + SERVER_PROBE_DEADLINE_IN_SEC
+
+    def probe_server(server_address):
+        try:
+            # the timeout is set on this socket only, never
+            # process wide, so later downloads are unaffected
+            s = socket.create_connection((server_address, SERVER_PORT_TO_PROBE),
+                                         max(0.1, probe_deadline - time.time()))
+            s.close()
+            probe_results.put(server_address)
+        except:
+            probe_results.put(None)
+
     try:
         for server_address in SERVERS_TO_PROBE_FOR_CONNECTION:
-            for connection_timeout in SERVER_TIMEOUT_CYCLES_IN_SEC:
-                try:
-                    socket.setdefaulttimeout(connection_timeout)
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.connect((socket.gethostbyname(server_address), SERVER_PORT_TO_PROBE))
-                    s.close()
-                    return [server_address, SERVER_PORT_TO_PROBE]
-                except:
-                    pass
+            probe_thread = threading.Thread(target=probe_server, args=(server_address,))
+            probe_thread.daemon = True  # a hanging name lookup must not block the exit
+            probe_thread.start()
+
+        for i in range(0, len(SERVERS_TO_PROBE_FOR_CONNECTION)):
+            probe_remaining_time = probe_deadline - time.time()
+            if probe_remaining_time <= 0:
+                break
+            try:
+                server_address = probe_results.get(timeout=probe_remaining_time)
+            except queue.Empty:
+                break
+            if server_address is not None:
+                return [server_address, SERVER_PORT_TO_PROBE]
 
         return None
 
@@ -335,50 +2120,725 @@ def is_internet_available():
         return None
 
 
+def probe_archive_mirrors(archive_urls):
+    # returns url -> [latency, bytes_per_second] of the mirrors that
+    # answered within the deadline, the latency is the time up to
+    # the response headers, the throughput is measured on the index
+    if async_transfer_engine is not None:
+        return async_transfer_engine.run(async_transfer_engine.probe_archive_mirrors(
+            archive_urls, ARCHIVE_MIRROR_PROBE_BYTES, ARCHIVE_MIRROR_PROBE_DEADLINE_IN_SEC))
+
+    probe_results = queue.Queue()
+    probe_deadline = time.time() + ARCHIVE_MIRROR_PROBE_DEADLINE_IN_SEC
+
+    def probe_archive_mirror(archive_url):
+        try:
+            request_start_time = time.time()
+            source_response = http_connection_pool.open_url(archive_url + "/")
+            response_start_time = time.time()
+            if source_response.status != 200:
+                source_response.close()
+                probe_results.put([archive_url, None])
+                return
+            probe_byte_count = 0
+            while probe_byte_count < ARCHIVE_MIRROR_PROBE_BYTES and time.time() < probe_deadline:
+                data_chunk = source_response.read(DOWNLOAD_CHUNK_SIZE)
+                if not data_chunk:
+                    break
+                probe_byte_count += len(data_chunk)
+            source_response.close()
+            probe_results.put([archive_url, [response_start_time - request_start_time,
+                                             int(probe_byte_count / max(0.001, time.time() - response_start_time))]])
+        except:
+            probe_results.put([archive_url, None])
+
+    for archive_url in archive_urls:
+        probe_thread = threading.Thread(target=probe_archive_mirror, args=(archive_url,))
+        probe_thread.daemon = True  # a hanging mirror must not block the exit
+        probe_thread.start()
+
+    mirror_probe_results = dict()
+    for i in range(0, len(archive_urls)):
+        probe_remaining_time = probe_deadline - time.time()
+        if probe_remaining_time <= 0:
+            break
+        try:
+            archive_url, probe_result = probe_results.get(timeout=probe_remaining_time)
+        except queue.Empty:
+            break
+        if probe_result is not None:
+            mirror_probe_results[archive_url] = probe_result
+
+    return mirror_probe_results
+
+
+def create_file_hashers(algorithms):
+    return dict((algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+
+
+def update_file_hashers_from_file(
+        filename,
+        file_hashers):
+    # hash an already written file in-process,
+    # no need to spawn an external checksum tool
+    hash_timer = run_metrics.start_phase("hash")
+    receive_buffer = memoryview(bytearray(DOWNLOAD_BUFFER_SIZE))
+    with io.open(filename, "rb", buffering=0) as fp:
+        while True:
+            received_byte_count = fp.readinto(receive_buffer)
+            if not received_byte_count:
+                break
+            for file_hasher in file_hashers.values():
+                file_hasher.update(receive_buffer[:received_byte_count])
+    run_metrics.stop_phase(hash_timer)
+
+
+def hash_file_mapped(filename, algorithm):
+    # the mapped file is hashed in one call without
+    # copying it, hashlib holds no GIL while it runs
+    file_hasher = hashlib.new(algorithm)
+    with io.open(filename, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size > 0:  # an empty file can not be mapped
+            file_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                file_hasher.update(file_map)
+            finally:
+                file_map.close()
+    return file_hasher.hexdigest()
+
+
+def get_checksum_algorithm(checksum):
+    return CHECKSUM_ALGORITHMS_BY_HASH_LENGTH.get(strlen_unicode(checksum))
+
+
+def get_strongest_checksum_algorithm(file_hashes):
+    return "sha256" if "sha256" in file_hashes else "sha1"
+
+
+def reset_file_hashers(file_hashers):
+    for algorithm in list(file_hashers.keys()):
+        file_hashers[algorithm] = hashlib.new(algorithm)
+
+
+def preallocate_file(fd, file_size):
+    # reserve the blocks up front where supported,
+    # a sparse file of the right size otherwise
+    try:
+        os.posix_fallocate(fd, 0, file_size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, file_size)
+
+
+def reserve_file_space(fd, offset, length):
+    # the blocks are reserved without changing the file size,
+    # which stays the resume offset of a part file, where
+    # fallocate is missing the file simply grows on write
+    global libc_fallocate
+    if libc_fallocate is None:
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc_fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+            libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (ImportError, OSError, AttributeError):
+            libc_fallocate = False
+    if libc_fallocate and length > 0:
+        libc_fallocate(fd, FALLOCATE_KEEP_SIZE, offset, length)
+
+
+def stream_response_to_file(
+        source_response,
+        fd,
+        file_offset,
+        file_hashers,
+        transfer_name,
+        write_lock):
+    # the body passes one reused buffer on its way to the
+    # file and the hashers, memory use does not depend on
+    # the file size, returns the number of bytes written
+    receive_buffer = memoryview(bytearray(DOWNLOAD_BUFFER_SIZE))
+    transfer_byte_count = 0
+    while True:
+        received_byte_count = source_response.readinto(receive_buffer)
+        if not received_byte_count:
+            break
+        data_view = receive_buffer[:received_byte_count]
+        if download_bandwidth_limiter is not None:
+            download_bandwidth_limiter.consume(received_byte_count)
+        write_file_at_offset(fd, data_view, file_offset + transfer_byte_count, write_lock)
+        transfer_byte_count += received_byte_count
+        if transfer_progress is not None:
+            transfer_progress.add_transfer_bytes(transfer_name, received_byte_count)
+        if file_hashers:
+            for file_hasher in file_hashers.values():
+                file_hasher.update(data_view)
+    return transfer_byte_count
+
+
+def write_file_at_offset(fd, data, offset, write_lock):
+    data = memoryview(data)
+    while len(data):
+        if hasattr(os, "pwrite"):
+            written_bytes = os.pwrite(fd, data, offset)
+        else:
+            with write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written_bytes = os.write(fd, data)
+        data = data[written_bytes:]
+        offset += written_bytes
+
+
+def parse_retry_after(retry_after):
+    # only the seconds form, an HTTP date
+    # falls back to the own backoff
+    if retry_after is None or not retry_after.strip().isdigit():
+        return None
+    return int(retry_after.strip())
+
+
+def is_retryable_error(request_error):
+    # transient network errors and overloaded servers are
+    # retried, anything else would only fail again
+    if isinstance(request_error, (RetryableRequestError, CircuitBreakerOpenError)):
+        return True
+    if isinstance(request_error, WebFileDownloadError):
+        return False
+    if isinstance(request_error, (socket.timeout, httplib.HTTPException)):
+        return True
+    # loaded by httplib already, a certificate
+    # that does not verify stays unverifiable
+    import ssl
+    if isinstance(request_error, getattr(ssl, "CertificateError", ())) or \
+            getattr(request_error, "reason", None) == "CERTIFICATE_VERIFY_FAILED":
+        return False
+    if isinstance(request_error, ssl.SSLError):
+        return True
+    if isinstance(request_error, socket.gaierror):
+        return request_error.args[0] == socket.EAI_AGAIN
+    if isinstance(request_error, (socket.error, IOError)):
+        return getattr(request_error, "errno", None) in RETRY_SOCKET_ERROR_NUMBERS
+    return False
+
+
+def get_request_retry_backoff(request_deadline, host, attempt_index, request_error):
+    # counts the error against the host and returns the
+    # seconds to wait before the next attempt, None if the
+    # error is final, there are no attempts or no time left
+    if isinstance(request_error, CircuitBreakerOpenError):
+        # no request went out, a short outage is
+        # waited out as long as the deadline allows
+        if request_error.retry_after >= request_deadline.get_remaining():
+            return None
+        run_metrics.add_counter("circuit_breaker_waits")
+        return request_error.retry_after
+
+    request_error_is_retryable = is_retryable_error(request_error)
+    if isinstance(request_error, RequestDeadlineError) or \
+            (request_error_is_retryable and getattr(request_error, "host_failed", True)):
+        host_circuit_breaker.record_failure(host)
+    else:
+        host_circuit_breaker.record_answer(host)
+
+    if not request_error_is_retryable or attempt_index + 1 >= RETRY_MAX_ATTEMPTS:
+        return None
+
+    # full jitter keeps a fleet of hosts from
+    # retrying against the archive in lockstep
+    retry_backoff = random.uniform(0, min(RETRY_BACKOFF_MAX_IN_SEC, RETRY_BACKOFF_BASE_IN_SEC * 2 ** attempt_index))
+    if getattr(request_error, "retry_after", None) is not None:
+        retry_backoff = max(retry_backoff, request_error.retry_after)
+    if retry_backoff >= request_deadline.get_remaining():
+        return None
+
+    run_metrics.add_counter("request_retries")
+    return retry_backoff
+
+
+def call_with_retries(request_deadline, url, request_function, *request_arguments):
+    # request_function raises on errors, the retryable ones are
+    # tried again after a backoff, waiting for an open circuit
+    # breaker costs time but none of the attempts
+    host = urlsplit(url).netloc
+    attempt_index = 0
+    while True:
+        try:
+            host_circuit_breaker.check_request(host)
+            request_result = request_function(*request_arguments)
+        except Exception as request_error:
+            retry_backoff = get_request_retry_backoff(request_deadline, host, attempt_index, request_error)
+            if retry_backoff is None:
+                raise
+            time.sleep(retry_backoff)
+            if not isinstance(request_error, CircuitBreakerOpenError):
+                attempt_index += 1
+            continue
+        host_circuit_breaker.record_answer(host)
+        return request_result
+
+
+def get_remote_file_size_if_ranges_supported(fromurl, request_deadline=None):
+    # a one byte range request tells us the size and
+    # whether the server answers range requests at all
+    source_response = http_connection_pool.open_url(fromurl, {"Range": "bytes=0-0"}, False, request_deadline)
+    content_range = source_response.getheader("Content-Range") or ""
+    content_range_match = re.match(r"^bytes 0-0/(\d+)$", content_range.strip())
+    if source_response.status != 206 or content_range_match is None:
+        # the server may send the whole file instead,
+        # drop the connection rather than reading it
+        source_response.close()
+        return None
+    source_response.read_all()
+    return int(content_range_match.group(1))
+
+
+def download_file_segmented(
+        fromurl,
+        partfile,
+        file_hashers,
+        transfer_name,
+        request_deadline=None):
+    # returns None if the file should rather be
+    # fetched with a single stream, True/False otherwise
+    statefile = partfile + SEGMENTED_DOWNLOAD_STATE_SUFFIX
+
+    # an unfinished single stream download is resumed as is
+    if os.path.isfile(partfile) and not os.path.isfile(statefile):
+        return None
+
+    remote_file_size = get_remote_file_size_if_ranges_supported(fromurl, request_deadline)
+    if remote_file_size is None or remote_file_size < SEGMENTED_DOWNLOAD_MIN_FILE_SIZE:
+        return None
+
+    segment_state = None
+    try:
+        with io.open(statefile, "r", encoding="utf-8") as fp:
+            segment_state = json.load(fp)
+        if segment_state["size"] != remote_file_size or \
+                get_file_size(partfile) != remote_file_size:
+            segment_state = None
+    except:
+        segment_state = None
+
+    # split the file into equal byte ranges and
+    # preallocate the part file for all of them
+    if segment_state is None:
+        segment_size = -(-remote_file_size // SEGMENTED_DOWNLOAD_CONNECTIONS)
+        segment_state = {"size": remote_file_size,
+                         "segments": [[segment_start, min(segment_start + segment_size, remote_file_size) - 1]
+                                      for segment_start in range(0, remote_file_size, segment_size)],
+                         "done": list()}
+        fd = os.open(partfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            preallocate_file(fd, remote_file_size)
+        finally:
+            os.close(fd)
+
+    segment_state_lock = threading.Lock()
+    write_lock = threading.Lock()
+
+    if transfer_progress is not None:
+        transfer_progress.set_transfer_size(transfer_name, remote_file_size, sum(
+            segment_state["segments"][segment_index][1] - segment_state["segments"][segment_index][0] + 1
+            for segment_index in segment_state["done"]))
+
+    def save_segment_state():
+        with io.open(statefile, "w", encoding="utf-8") as fp:
+            fp.write(string_to_unicode(json.dumps(segment_state)))
+
+    save_segment_state()
+
+    def download_segment(segment_index):
+        segment_start, segment_end = segment_state["segments"][segment_index]
+        source_response = http_connection_pool.open_url(
+            fromurl, {"Range": "bytes={0}-{1}".format(segment_start, segment_end)}, False, request_deadline)
+        content_range = source_response.getheader("Content-Range") or ""
+        if source_response.status != 206 or not content_range.startswith("bytes {0}-".format(segment_start)):
+            # not read, it may be the whole file
+            source_response.close()
+            run_metrics.add_counter("segment_failures")
+            return False
+        fd = os.open(partfile, os.O_WRONLY)
+        try:
+            segment_offset = segment_start + stream_response_to_file(
+                source_response, fd, segment_start, None, transfer_name, write_lock)
+        finally:
+            os.close(fd)
+        if segment_offset != segment_end + 1:
+            run_metrics.add_counter("segment_failures")
+            return False
+        with segment_state_lock:
+            segment_state["done"].append(segment_index)
+            save_segment_state()
+        return True
+
+    segment_results = run_tasks_concurrently(
+        download_segment,
+        [[segment_index] for segment_index in range(0, len(segment_state["segments"]))
+         if segment_index not in segment_state["done"]],
+        SEGMENTED_DOWNLOAD_CONNECTIONS)
+
+    # the state file stays for the next attempt
+    # to resume the missing segments only
+    if not all(segment_results):
+        raise RetryableRequestError("{0} of {1} segments of \"{2}\" failed.".format(
+            len([segment_result for segment_result in segment_results if not segment_result]),
+            len(segment_results), fromurl))
+
+    os.unlink(statefile)
+
+    # the segments arrived out of order, so the file
+    # is hashed once as a whole after the download
+    if file_hashers:
+        reset_file_hashers(file_hashers)
+        update_file_hashers_from_file(partfile, file_hashers)
+
+    return True
+
+
+def order_urls_by_circuit_breaker(urls):
+    # hosts with an open circuit breaker go last, their
+    # rest is only waited for if no other host is left
+    return sorted(urls, key=lambda url: host_circuit_breaker.is_open(urlsplit(url).netloc))
+
+
+def download_file_from_mirrors(
+        fromurls,
+        tofile,
+        quiet=False,
+        file_hashers=None,
+        resume=True,
+        bandwidth_share_count=1):
+    # the same file from every ranked mirror in turn, a mirror
+    # is left after its retries and its part file is continued
+    # from the next one, the CHECKSUMS hashes prove the bytes
+    # whichever mirror sent them
+    request_deadline = RequestDeadline(FILE_DOWNLOAD_DEADLINE_IN_SEC)
+    fromurls = order_urls_by_circuit_breaker(fromurls)
+    for mirror_index, fromurl in enumerate(fromurls):
+        if mirror_index > 0:
+            run_metrics.add_counter("mirror_failovers")
+        try:
+            if call_with_retries(request_deadline, fromurl, download_file,
+                                 fromurl, tofile, quiet, file_hashers, resume, bandwidth_share_count, request_deadline):
+                return True
+        except RequestDeadlineError:
+            run_metrics.add_counter("request_deadline_misses")
+            return False
+        except Exception:
+            pass
+        if archive_mirror_ranking is not None:
+            archive_mirror_ranking.demote(fromurl)
+    return False
+
+
 def download_file(
         fromurl,
-        tofile):
-    try:  # use the system available download tools
-        # if its not none
-        if downloader_bin_full_path_and_param is not None:
+        tofile,
+        quiet=False,
+        file_hashers=None,
+        resume=True,
+        bandwidth_share_count=1,
+        request_deadline=None):
+    # every attempt is timed for the run metrics and shown in the
+    # progress while it runs, errors are raised for the retries
+    if transfer_progress is not None:
+        transfer_progress.start_transfer(os.path.basename(tofile))
+    # the part file is hashed again on resume
+    if file_hashers:
+        reset_file_hashers(file_hashers)
+    download_timer = run_metrics.start_phase("file_download")
+    file_downloaded = False
+    try:
+        file_downloaded = transfer_file(
+            fromurl, tofile, quiet, file_hashers, resume, bandwidth_share_count, request_deadline)
+    finally:
+        download_seconds = run_metrics.stop_phase(download_timer)
+        if transfer_progress is not None:
+            transfer_progress.finish_transfer(os.path.basename(tofile), file_downloaded)
+        run_metrics.add_file_transfer(
+            os.path.basename(tofile), get_file_size(tofile) if file_downloaded else 0, download_seconds, file_downloaded)
+    return file_downloaded
+
+
+def transfer_file(
+        fromurl,
+        tofile,
+        quiet,
+        file_hashers,
+        resume,
+        bandwidth_share_count,
+        request_deadline):
+    # all downloads go to a ".part" file first, which
+    # is renamed only after the transfer is complete,
+    # bandwidth_share_count is the number of transfers
+    # running next to this one
+    partfile = tofile + PARTIAL_DOWNLOAD_FILE_SUFFIX
+
+    if not resume:
+        for stale_file in [partfile, partfile + SEGMENTED_DOWNLOAD_STATE_SUFFIX]:
+            if os.path.isfile(stale_file):
+                os.unlink(stale_file)
+
+    # large files are fetched in byte ranges over
+    # several connections if the server allows it
+    if SEGMENTED_DOWNLOAD_CONNECTIONS > 1:
+        segmented_download_result = download_file_segmented(
+            fromurl, partfile, file_hashers, os.path.basename(tofile), request_deadline)
+        if segmented_download_result is not None:
+            if segmented_download_result:
+                os.rename(partfile, tofile)
+            return segmented_download_result
+
+    # the preallocated part file of an earlier segmented
+    # attempt has gaps, a single stream starts it over
+    statefile = partfile + SEGMENTED_DOWNLOAD_STATE_SUFFIX
+    if os.path.isfile(statefile):
+        for stale_file in [partfile, statefile]:
+            if os.path.isfile(stale_file):
+                os.unlink(stale_file)
+
+    # use the system available download tools
+    # if its not none
+    if downloader_bin_full_path_and_param is not None:
+        if not quiet:
             print_elb()
-            # get the bin and command line params
-            download_tool = [downloader_bin_full_path_and_param[0]]
-            download_tool = download_tool + shlex.split(downloader_bin_full_path_and_param[1].format(tofile, fromurl))
+        # get the bin and command line params, the
+        # tools continue an existing part file on their own
+        download_tool = [downloader_bin_full_path_and_param[0]]
+        download_tool = download_tool + shlex.split(downloader_bin_full_path_and_param[1].format(partfile, fromurl))
+        if download_bandwidth_limiter is not None:
+            download_tool = download_tool + shlex.split(downloader_bin_full_path_and_param[2].format(
+                download_bandwidth_limiter.get_rate_share(bandwidth_share_count)))
+        download_tool = download_tool + shlex.split(downloader_bin_full_path_and_param[3].format(
+            HTTP_STALL_TIMEOUT_IN_SEC))
+        if not quiet:
             print_elb()
-            ret = execute_process_wait_get_returncode(download_tool)
+        partfile_size = get_file_size(partfile) if os.path.isfile(partfile) else 0
+        ret, http_status = execute_download_tool_wait_get_returncode(
+            download_tool, partfile, os.path.basename(tofile))
+        if not quiet:
             print_elb()
-            return not ret
-        else:
-            if IS_PYTHON3:
-                source_url = urllib.request.URLopener()
-            else:
-                source_url = urllib.URLopener()
+        # network failures and overloaded servers are retried,
+        # the tool continues its part file on the next attempt,
+        # a host that sent data before the failure is no dead one
+        if ret in DOWNLOAD_TOOLS_RETRY_EXIT_CODES.get(os.path.basename(downloader_bin_full_path_and_param[0]), []):
+            raise RetryableRequestError(
+                "The download tool failed on \"{0}\" with exit code {1}.".format(fromurl, ret),
+                host_failed=(get_file_size(partfile) if os.path.isfile(partfile) else 0) <= partfile_size)
+        if http_status in RETRY_HTTP_STATUS_CODES:
+            raise RetryableRequestError("The server answered \"{0}\" with status {1}.".format(fromurl, http_status))
+        # the part file already holds all bytes
+        if http_status == 416 and os.path.isfile(partfile) and get_file_size(partfile) > 0:
+            ret = 0
+        if ret:
+            return False
+        # the tool wrote the file, hash it once
+        # here while it is still in the page cache
+        if file_hashers:
+            update_file_hashers_from_file(partfile, file_hashers)
+    else:
+        resume_offset = get_file_size(partfile) if os.path.isfile(partfile) else 0
+
+        # the bytes we already have are part of
+        # the checksum, hash them before continuing
+        if resume_offset:
+            run_metrics.add_counter("download_resumes")
+            if file_hashers:
+                update_file_hashers_from_file(partfile, file_hashers)
+
+        request_headers = {"Range": "bytes={0}-".format(resume_offset)} if resume_offset else {}
+
+        source_response = http_connection_pool.open_url(fromurl, request_headers, False, request_deadline)
+
+        if source_response.status not in [200, 206]:
+            source_response.read_all()
+            # the part file already holds all bytes
+            if source_response.status == 416 and resume_offset:
+                os.rename(partfile, tofile)
+                return True
+            return False
+
+        # the server ignored the range request,
+        # so the whole file is coming again
+        if resume_offset and source_response.status != 206:
+            resume_offset = 0
+            if file_hashers:
+                reset_file_hashers(file_hashers)
+
+        content_length = source_response.getheader("Content-Length")
+        if transfer_progress is not None:
+            transfer_progress.set_transfer_size(
+                os.path.basename(tofile),
+                resume_offset + int(content_length) if content_length else None,
+                resume_offset)
+
+        # reserve the rest of the file, then stream the
+        # body to disk and feed the hashers with it
+        fd = os.open(partfile, os.O_WRONLY | os.O_CREAT | (0 if resume_offset else os.O_TRUNC), 0o644)
+        try:
+            if content_length:
+                reserve_file_space(fd, resume_offset, int(content_length))
+            transfer_byte_count = stream_response_to_file(
+                source_response, fd, resume_offset, file_hashers, os.path.basename(tofile), threading.Lock())
+        finally:
+            os.close(fd)
+            source_response.close()
+
+        # a connection closed early looks like the end of
+        # the body, the next attempt resumes the rest
+        if content_length and transfer_byte_count < int(content_length):
+            raise RetryableRequestError("The transfer of \"{0}\" ended after {1} of {2} bytes.".format(
+                fromurl, transfer_byte_count, content_length), host_failed=transfer_byte_count == 0)
+
+    os.rename(partfile, tofile)
+    return True
+
+
+def create_async_transfer_engine():
+    # the engine module uses async/await, which
+    # python 2 can not even parse, so it is optional
+    if sys.version_info < (3, 7):
+        return None
+    try:
+        import sukd_async
+    except ImportError:
+        return None
+    return sukd_async.AsyncTransferEngine(sys.modules[__name__])
 
-            source_url.retrieve(fromurl, tofile)
-        return True
-    except:
-        return False
 
+def run_tasks_concurrently(
+        task_function,
+        task_arguments,
+        worker_count):
+    # runs task_function for every argument list in
+    # task_arguments with a bounded number of worker
+    # threads, results are returned in argument order
+    task_results = [None] * len(task_arguments)
+    task_queue = queue.Queue()
+    abort_tasks_sentinel = threading.Event()
 
-def open_webfile_get_response(fileuri):
-    try:
-        if IS_PYTHON3:
+    for task_index, task_argument in enumerate(task_arguments):
+        task_queue.put([task_index, task_argument])
+
+    def run_task_worker():
+        while not abort_tasks_sentinel.is_set():
             try:
+                task_index, task_argument = task_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                task_results[task_index] = task_function(*task_argument)
+            except:
+                task_results[task_index] = None
 
-                return [200, urllib.request.urlopen(fileuri).read().decode()]
+    task_workers = list()
+    for i in range(0, max(1, min(worker_count, len(task_arguments)))):
+        task_worker = threading.Thread(target=run_task_worker)
+        task_worker.daemon = True
+        task_worker.start()
+        task_workers.append(task_worker)
 
-            except urllib.error.HTTPError as e:
-                return [e.code, None]
-            except urllib.error.URLError as e:
-                return [e.code, None]
-        else:
-            response = urllib.urlopen(fileuri)
-            return [response.getcode(), response.read()]
+    try:
+        # join with timeout, so Ctrl+C still
+        # reaches the main thread
+        for task_worker in task_workers:
+            while task_worker.is_alive():
+                task_worker.join(0.2)
+    except KeyboardInterrupt:
+        abort_tasks_sentinel.set()
+        raise
+
+    return task_results
+
+
+def download_files_concurrently(
+        download_jobs,
+        worker_count):
+    # download_jobs = [[fromurl, tofile, file_hashers], ...], fromurl
+    # may be a list of mirror urls, returns a dict with tofile -> True/False
+    download_jobs = [[fromurl if isinstance(fromurl, list) else [fromurl], tofile, file_hashers]
+                     for fromurl, tofile, file_hashers in download_jobs]
+    if async_transfer_engine is not None:
+        return async_transfer_engine.run(async_transfer_engine.download_files(download_jobs, worker_count))
+
+    bandwidth_share_count = min(worker_count, len(download_jobs))
+    download_results = run_tasks_concurrently(
+        download_file_from_mirrors,
+        [[fromurls, tofile, True, file_hashers, True, bandwidth_share_count]
+         for fromurls, tofile, file_hashers in download_jobs],
+        worker_count)
+
+    return dict((download_job[1], download_result is True)
+                for download_job, download_result in zip(download_jobs, download_results))
+
+
+def get_proxy_for_url(url):
+    # honour the *_proxy and no_proxy environment
+    # variables just like urllib does, imported here,
+    # it is slow to load and only needed to connect
+    if IS_PYTHON3:
+        from urllib.request import getproxies, proxy_bypass as is_proxy_bypassed
+    else:
+        from urllib import getproxies, proxy_bypass as is_proxy_bypassed
+    proxies = getproxies()
+
+    source_url = urlsplit(url)
+    proxy = proxies.get(source_url.scheme.lower())
+
+    if proxy is None or is_proxy_bypassed(source_url.hostname):
+        return None
+
+    return proxy
+
+
+def open_webfile_get_response(fileuri):
+    if async_transfer_engine is not None:
+        return async_transfer_engine.run(async_transfer_engine.fetch_metadata(fileuri))
+
+    # transient errors are retried within the deadline,
+    # whatever still fails is reported as status 0
+    request_deadline = RequestDeadline(METADATA_REQUEST_DEADLINE_IN_SEC)
+    try:
+        return call_with_retries(request_deadline, fileuri, fetch_webfile, fileuri, request_deadline)
     except:
         return [0, None]
 
 
+def fetch_webfile(fileuri, request_deadline):
+    if kernel_metadata_cache is not None:
+        return kernel_metadata_cache.get(fileuri, request_deadline)
+
+    # text metadata is requested gzip compressed
+    # and inflated while it is being read
+    web_response = http_connection_pool.open_url(fileuri, None, True, request_deadline)
+
+    if web_response.status != 200:
+        web_response.read_all()
+        return [web_response.status, None]
+
+    return [200, web_response.read_all().decode("utf-8")]
+
+
+def find_executable_in_path(executable_name):
+    # distutils is slow to import and gone since
+    # python 3.12, python 2 has no shutil.which
+    if hasattr(shutil, "which"):
+        return shutil.which(executable_name)
+    import distutils.spawn
+    return distutils.spawn.find_executable(executable_name)
+
+
+def open_mirrored_webfile_get_response(fileuris):
+    # the same file from every ranked mirror in
+    # turn, the first 200 response is returned
+    web_response = [0, None]
+    for fileuri in fileuris:
+        web_response = open_webfile_get_response(fileuri)
+        if web_response[1] is not None and web_response[0] == 200:
+            break
+    return web_response
+
+
 def get_string_unicode_stream(string):
     try:
         return io.StringIO(string_to_unicode(string))
@@ -386,23 +2846,120 @@ def get_string_unicode_stream(string):
         return None
 
 
-def get_string_index(string, index):
-    if IS_PYTHON3:
-        return str.index(string, index)
-    else:
-        return unicode.index(string, index)
-
-
 def execute_process_wait_get_returncode(
-        params):
+        params,
+        quiet=False):
+    import subprocess  # only needed to run tools, not at startup
     try:
+        if quiet:
+            # discard the tools own progress output,
+            # concurrent runs would garble the console
+            with open(os.devnull, "w") as devnull:
+                return subprocess.check_call(params, stdout=devnull, stderr=devnull)
         return subprocess.check_call(params)
     except subprocess.CalledProcessError as cerr:
         return cerr.returncode
 
 
+def execute_download_tool_wait_get_returncode(
+        params,
+        partfile,
+        transfer_name):
+    # the tools own output is not shown, the growing part
+    # file feeds the aggregated progress instead, the output
+    # is kept in the C locale for the http status of a failure,
+    # returns the exit code and that status or None
+    import subprocess
+    import tempfile
+    # a part file the tool resumes is not
+    # part of the rate of this session
+    if transfer_progress is not None:
+        transfer_progress.set_transfer_size(
+            transfer_name, None, os.path.getsize(partfile) if os.path.isfile(partfile) else 0)
+    download_environment = dict(os.environ)
+    download_environment["LC_ALL"] = "C"
+    download_environment.pop("LANGUAGE", None)
+    with tempfile.TemporaryFile() as download_output:
+        download_process = subprocess.Popen(
+            params, stdout=download_output, stderr=subprocess.STDOUT, env=download_environment)
+        while download_process.poll() is None:
+            time.sleep(1.0 / PROGRESS_FRAMES_PER_SEC)
+            if transfer_progress is not None and os.path.isfile(partfile):
+                transfer_progress.set_transfer_bytes(transfer_name, os.path.getsize(partfile))
+
+        http_error = DOWNLOAD_TOOLS_HTTP_ERRORS.get(os.path.basename(params[0]))
+        if http_error is None or download_process.returncode != http_error[0]:
+            return download_process.returncode, None
+        download_output.seek(0)
+        http_status_match = None
+        for http_status_match in re.finditer(http_error[1], download_output.read().decode("utf-8", "replace")):
+            pass
+        return download_process.returncode, int(http_status_match.group(1)) if http_status_match else None
+
+
+def execute_dpkg_wait_get_returncode(
+        params):
+    # the output is passed through as it arrives, so a
+    # conffile or debconf prompt without a line break is
+    # shown too, the prefixes of its complete lines tell
+    # which phase of the transaction runs, messages are
+    # read in the C locale for that
+    import subprocess
+    dpkg_environment = dict(os.environ)
+    dpkg_environment["LC_ALL"] = "C"
+    dpkg_environment.pop("LANGUAGE", None)
+    if not (sys.stdin.isatty() and sys.stdout.isatty()):
+        dpkg_environment["DEBIAN_FRONTEND"] = "noninteractive"
+        params = params[:1] + DPKG_NONINTERACTIVE_PARAMS + params[1:]
+    dpkg_process = subprocess.Popen(params, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=dpkg_environment)
+
+    dpkg_phase_timer = None
+    dpkg_phase_seconds = dict()
+    dpkg_phase_names = list()
+    output_decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    output_text = ""
+    while True:
+        output_chunk = os.read(dpkg_process.stdout.fileno(), 4096)
+        chunk_text = output_decoder.decode(output_chunk, len(output_chunk) == 0)
+        if IS_PYTHON3:
+            print_nlb(chunk_text)
+        else:
+            # python 2 writes unicode to a pipe as ascii
+            print_nlb(chunk_text.encode(sys.stdout.encoding or "utf-8", "replace"))
+        output_lines = (output_text + chunk_text).split("\n")
+        output_text = output_lines.pop()
+        if len(output_chunk) == 0 and len(output_text) > 0:
+            # the output ended without a line break
+            print_lb("")
+            output_lines.append(output_text)
+        for output_line in output_lines:
+            dpkg_phase = next((phase_name for line_prefix, phase_name in DPKG_OUTPUT_PHASES
+                               if output_line.startswith(line_prefix)), None)
+            if dpkg_phase is None or (dpkg_phase_timer is not None and dpkg_phase_timer[0] == dpkg_phase):
+                continue
+            if dpkg_phase_timer is not None:
+                dpkg_phase_seconds[dpkg_phase_timer[0]] += run_metrics.stop_phase(dpkg_phase_timer)
+            dpkg_phase_timer = run_metrics.start_phase(dpkg_phase)
+            if dpkg_phase not in dpkg_phase_seconds:
+                dpkg_phase_seconds[dpkg_phase] = 0.0
+                dpkg_phase_names.append(dpkg_phase)
+        if len(output_chunk) == 0:
+            break
+
+    dpkg_process.wait()
+    if dpkg_phase_timer is not None:
+        dpkg_phase_seconds[dpkg_phase_timer[0]] += run_metrics.stop_phase(dpkg_phase_timer)
+
+    if len(dpkg_phase_names) > 0:
+        print_lb("The \"{0}\" phases took: ".format(DPKG_BIN_FILE) + ", ".join(
+            "{0} {1:.1f}s".format(dpkg_phase[len("dpkg_"):], dpkg_phase_seconds[dpkg_phase])
+            for dpkg_phase in dpkg_phase_names))
+    return dpkg_process.returncode
+
+
 def execute_process_wait_get_output(
         params):
+    import subprocess
     try:
         return subprocess.Popen(
             params,
@@ -504,6 +3061,59 @@ def get_file_size(filename):
         return "Error: " + err.message
 
 
+def reflink_file(fromfile, tofile):
+    # a clone shares all blocks until one of the
+    # files is written, IOError if not supported
+    try:
+        with open(fromfile, "rb") as source_fp:
+            with open(tofile, "wb") as destination_fp:
+                fcntl.ioctl(destination_fp.fileno(), FICLONE_IOCTL, source_fp.fileno())
+        shutil.copystat(fromfile, tofile)
+    except (IOError, OSError):
+        if os.path.isfile(tofile):
+            os.unlink(tofile)
+        raise
+
+
+def link_file(fromfile, tofile):
+    # hardlink or reflink if both are on the same file
+    # system, returns False if neither works; the
+    # rename keeps it atomic
+    if os.path.isfile(tofile) and os.path.samefile(fromfile, tofile):
+        return True
+    temp_file = tofile + ".tmp-{0}".format(threading.current_thread().ident)
+    if os.path.isfile(temp_file):
+        os.unlink(temp_file)
+    for link_function in ([reflink_file, os.link] if PREFER_REFLINKS else [os.link, reflink_file]):
+        try:
+            link_function(fromfile, temp_file)
+        except (IOError, OSError):
+            continue
+        os.rename(temp_file, tofile)
+        # renaming a hardlink onto another link of the
+        # same inode does nothing and keeps the temp file
+        if os.path.isfile(temp_file):
+            os.unlink(temp_file)
+        return True
+    return False
+
+
+def link_or_copy_file(fromfile, tofile):
+    # copy if the file can not be linked
+    if link_file(fromfile, tofile):
+        return
+    temp_file = tofile + ".tmp-{0}".format(threading.current_thread().ident)
+    shutil.copy2(fromfile, temp_file)
+    os.rename(temp_file, tofile)
+
+
+def write_text_file(filename, text):
+    temp_file = filename + ".tmp-{0}".format(threading.current_thread().ident)
+    with io.open(temp_file, "w", encoding="utf-8", newline="") as fp:
+        fp.write(text)
+    os.rename(temp_file, filename)
+
+
 def is_directory_empty(dir_path):
     return os.listdir(dir_path) == []
 
@@ -536,29 +3146,1161 @@ def delete_files_in_directory(dirpath, delete_subdirs):
             pass
 
 
-def find_position_of_nth_string_occurence(targetstr, char, nthpos):
-    count = int(0)
-    if IS_PYTHON3:
-        if strlen_unicode(str(targetstr)) == 0:
-            return 0
+def parse_kernel_checksums(kernel_checksums_text, kernel_version):
+    # build the package index with the hashed files,
+    # a new index for every version
+    kernel_index = KernelPackageIndex(kernel_version)
+
+    for read_line in get_string_unicode_stream(kernel_checksums_text):
+        read_line = read_line.strip()
+        if re.search(r".*\.deb$", read_line, re.IGNORECASE | re.UNICODE) is not None:
+            kernel_hash_and_file = read_line.split()  # [0]=hash, [1]=filename
+            # we keep every known hash (sha1 and sha256)
+            kernel_checksum_algorithm = get_checksum_algorithm(kernel_hash_and_file[0])
+            if kernel_checksum_algorithm is not None:
+                kernel_index.add_checksum(kernel_hash_and_file[1], kernel_checksum_algorithm, kernel_hash_and_file[0])
+
+    # every parsed CHECKSUMS file answers later
+    # architecture queries of the archive index
+    if kernel_archive_index is not None:
+        kernel_archive_index.set_architectures(kernel_version, kernel_index.architectures)
+
+    return kernel_index
+
+
+def get_upstream_kernel_archive_urls():
+    # best ranked first
+    if archive_mirror_ranking is not None:
+        return archive_mirror_ranking.get_ranked_urls()
+    return [LATEST_UPSTREAM_KERNELS_ARCHIVE_URL]
+
+
+def get_upstream_kernel_file_urls(kernel_version_directory_string, file_name):
+    return [archive_url + os.path.sep + kernel_version_directory_string + os.path.sep + file_name
+            for archive_url in get_upstream_kernel_archive_urls()]
+
+
+def get_upstream_kernel_file_url(kernel_version_directory_string, file_name):
+    return get_upstream_kernel_file_urls(kernel_version_directory_string, file_name)[0]
+
+
+def get_kernel_version_sort_key(kernel_version):
+    # "6.1.10" > "6.1.9" > "6.1" > "6.1-rc8" > "6.1-rc7"
+    kernel_version_match = re.match(r"^(\d+(?:\.\d+)*)(?:-rc(\d+))?(.*)$", kernel_version)
+    if kernel_version_match is None:
+        return [[], 0, 0, kernel_version]
+    kernel_version_numbers = [int(n) for n in kernel_version_match.group(1).split(".")]
+    # "6.1" and "6.1.0" are the same release
+    while len(kernel_version_numbers) > 1 and kernel_version_numbers[-1] == 0:
+        kernel_version_numbers.pop()
+    if kernel_version_match.group(2) is not None:
+        return [kernel_version_numbers, 0, int(kernel_version_match.group(2)), kernel_version_match.group(3)]
+    return [kernel_version_numbers, 1, 0, kernel_version_match.group(3)]
+
+
+def is_kernel_release_version(kernel_version):
+    # plain releases only, no "-rc" or other suffixed builds
+    return re.match(r"^\d+(?:\.\d+)*$", kernel_version) is not None
+
+
+def is_kernel_version_in_series(kernel_version, kernel_series):
+    # "6.1" holds "6.1", "6.1.9" and "6.1-rc3", but not "6.10"
+    kernel_version_match = re.match(r"^\d+(?:\.\d+)*", kernel_version)
+    if kernel_version_match is None:
+        return False
+    kernel_series_numbers = kernel_series.split(".")
+    return kernel_version_match.group(0).split(".")[:len(kernel_series_numbers)] == kernel_series_numbers
+
+
+def get_kernel_archive_index():
+    # the HTML index of the upstream kernels archive is requested
+    # at most once per max age, with the metadata cache an
+    # unchanged listing costs one conditional request
+    global kernel_archive_index
+
+    if kernel_archive_index is None:
+        kernel_archive_index = KernelArchiveIndex(LATEST_UPSTREAM_KERNELS_ARCHIVE_URL, os.path.join(
+            user_kernel_package_download_dir, USER_CACHE_FOLDER, KERNEL_ARCHIVE_INDEX_FILE))
+
+    if kernel_archive_index.is_fresh():
+        run_metrics.add_counter("archive_index_cache_hits")
+        return kernel_archive_index
+
+    web_response = open_mirrored_webfile_get_response(
+        [archive_url + "/" for archive_url in get_upstream_kernel_archive_urls()])
+
+    if web_response[1] is None or web_response[0] != 200:
+        raise WebFileDownloadError(
+            "Could not open \"{0}\" for downloading. Please check your internet connection or online location for availability.".format(
+                get_upstream_kernel_archive_urls()[0]) + " The response code for the file was \"{0}\".".format(
+                web_response[0]))
+
+    run_metrics.add_counter("archive_index_changed_versions", kernel_archive_index.update(web_response[1]))
+    kernel_archive_index.save()
+    return kernel_archive_index
+
+
+def fetch_upstream_kernel_versions():
+    # all "v<version>/" sub-directories, oldest first
+    return get_kernel_archive_index().find_versions(include_rc=True)
+
+
+def fetch_kernel_checksums_concurrently(kernel_versions):
+    # returns [file urls, responses], one
+    # mirrored url list per version
+    kernel_checksums_file_urls = [get_upstream_kernel_file_urls("v" + kernel_version, CHECKSUMS_FILE)
+                                  for kernel_version in kernel_versions]
+    if async_transfer_engine is not None:
+        kernel_checksums_responses = async_transfer_engine.run(async_transfer_engine.fetch_metadata_concurrently(
+            kernel_checksums_file_urls, DOWNLOAD_WORKER_COUNT))
     else:
-        if strlen_unicode(unicode(targetstr)) == 0:
-            return 0
-    for index, c in enumerate(targetstr):
-        if c == char:
-            count += 1
-            if count == nthpos:
-                return index
-    return 0
+        kernel_checksums_responses = run_tasks_concurrently(
+            open_mirrored_webfile_get_response,
+            [[kernel_checksums_file_url] for kernel_checksums_file_url in kernel_checksums_file_urls],
+            DOWNLOAD_WORKER_COUNT)
+    return [kernel_checksums_file_urls, kernel_checksums_responses]
+
+
+def complete_kernel_archive_index_architectures(kernel_versions):
+    # the architectures of a version come from its CHECKSUMS,
+    # fetched once and then answered from the index,
+    # returns the number of versions that were fetched
+    unknown_architecture_versions = kernel_archive_index.get_unknown_architecture_versions(kernel_versions)
+    if len(unknown_architecture_versions) == 0:
+        return 0
+
+    kernel_checksums_responses = fetch_kernel_checksums_concurrently(unknown_architecture_versions)[1]
+    for kernel_version, web_response in zip(unknown_architecture_versions, kernel_checksums_responses):
+        if web_response is not None and web_response[1] is not None and web_response[0] == 200:
+            parse_kernel_checksums(web_response[1], kernel_version)
+
+    kernel_archive_index.save()
+    return len(unknown_architecture_versions)
+
+
+def find_newest_kernel_series_version(kernel_series, kernel_architectures):
+    # newest release first, the architectures of a version
+    # are only fetched if the index does not know them yet
+    kernel_archive_index_versions = get_kernel_archive_index().find_versions(series=kernel_series)
+    for kernel_version in reversed(kernel_archive_index_versions):
+        if kernel_architectures:
+            complete_kernel_archive_index_architectures([kernel_version])
+            kernel_version_architectures = kernel_archive_index.get_architectures(kernel_version)
+            if kernel_version_architectures is None or not all(
+                    kernel_arch in kernel_version_architectures for kernel_arch in kernel_architectures):
+                continue
+        return kernel_version
+    return None
+
+
+def get_kernel_file_install_order_key(kernel_file_path):
+    kernel_package_record = kernel_package_index.get_record(os.path.basename(kernel_file_path))
+    if kernel_package_record is None:
+        return [0, list()]  # the CHECKSUMS file
+    return [1, kernel_package_record.get_install_order_key()]
+
+
+def get_kernel_download_location(kernel_version_directory_string, kernel_arch, kernel_flavor):
+    return user_kernel_package_download_dir + os.path.sep + \
+           kernel_version_directory_string + os.path.sep + \
+           kernel_arch + os.path.sep + \
+           kernel_flavor
+
+
+def find_kernel_version_download_locations(kernel_version_directory_string):
+    # all <arch>/<flavor> directories of a version
+    kernel_version_directory = user_kernel_package_download_dir + os.path.sep + kernel_version_directory_string
+    download_locations = list()
+    for kernel_arch in sorted(os.listdir(kernel_version_directory)) if os.path.isdir(kernel_version_directory) else []:
+        kernel_arch_directory = kernel_version_directory + os.path.sep + kernel_arch
+        if os.path.isdir(kernel_arch_directory):
+            download_locations.extend(kernel_arch_directory + os.path.sep + kernel_flavor
+                                      for kernel_flavor in sorted(os.listdir(kernel_arch_directory))
+                                      if os.path.isdir(kernel_arch_directory + os.path.sep + kernel_flavor))
+    return download_locations
+
+
+def download_kernel_files(
+        kernel_version_directory_string,
+        kernel_checksums_file_url,
+        kernel_checksums_text,
+        kernel_download_locations,
+        download_statistics=None):
+    # kernel_download_locations = [[download_location, [KernelPackageRecord, ...]], ...]
+    # every file is fetched only once, other locations that need
+    # the same file get the verified copy linked or copied
+    if download_statistics is None:
+        download_statistics = dict()
+    for download_statistic in ["downloaded", "placed", "skipped", "failed", "corrupted", "bytes"]:
+        download_statistics.setdefault(download_statistic, 0)
+
+    downloaded_kernel_files = list()
+    kernel_download_journals = dict()
+    kernel_file_sources = dict()  # kernel_deb_file -> path of a verified local copy
+    kernel_download_jobs = list()
+    download_counter = 0
+
+    # first save the CHECKSUMS file, we already
+    # fetched it, no need to download it again
+    for download_location, kernel_deb_files in kernel_download_locations:
+        checksums_full_path = download_location + os.path.sep + CHECKSUMS_FILE
+
+        print_nlb("[{0}]: Saving file \"".format(download_counter) + CHECKSUMS_FILE + "\" from \"" +
+                  kernel_checksums_file_url +
+                  "\" to \"" +
+                  checksums_full_path + "\" ...")
+
+        try:
+            write_text_file(checksums_full_path, kernel_checksums_text)
+            downloaded_kernel_files.append(checksums_full_path)
+            print_lb(SUCCESS_STRING)
+        except (IOError, OSError):
+            print_lb(FAILED_STRING)
 
+        print_lb("File size: " + str(get_file_size(checksums_full_path)) + " bytes")
+        print_elb()
 
-def dispatch_command_line_arguments(args):
-    if len(args) == 0:
-        return True
+    # the journals remember unfinished and
+    # verified files of earlier runs
+    verified_destinations = set()
+    for download_location, kernel_package_records in kernel_download_locations:
+        kernel_download_journals[download_location] = DownloadJournal(download_location)
+        for kernel_package_record in kernel_package_records:
+            kernel_deb_file = kernel_package_record.name
+            destination_full_path = download_location + os.path.sep + kernel_deb_file
+            if kernel_download_journals[download_location].is_verified(
+                    kernel_deb_file, destination_full_path, kernel_package_record.get_hashes()):
+                kernel_file_sources.setdefault(kernel_deb_file, destination_full_path)
+                verified_destinations.add(destination_full_path)
+
+    # packages other arch and flavor directories of this version
+    # hold verified from earlier runs, the arch independent
+    # headers, are linked instead of downloaded again
+    kernel_package_records_by_name = dict((kernel_package_record.name, kernel_package_record)
+                                          for download_location, kernel_package_records in kernel_download_locations
+                                          for kernel_package_record in kernel_package_records)
+    for download_location in find_kernel_version_download_locations(kernel_version_directory_string):
+        if download_location in kernel_download_journals:
+            continue
+        download_location_journal = DownloadJournal(download_location)
+        for kernel_deb_file, kernel_package_record in kernel_package_records_by_name.items():
+            if kernel_deb_file not in kernel_file_sources and download_location_journal.is_verified(
+                    kernel_deb_file, download_location + os.path.sep + kernel_deb_file,
+                    kernel_package_record.get_hashes()):
+                kernel_file_sources[kernel_deb_file] = download_location + os.path.sep + kernel_deb_file
+
+    # already verified files are skipped, cached files are placed
+    # from the package cache, files already verified or downloaded
+    # for another location are shared and all others are
+    # (re-)started or resumed
+    for download_location, kernel_package_records in kernel_download_locations:
+        kernel_download_journal = kernel_download_journals[download_location]
+        for kernel_package_record in kernel_package_records:
+            kernel_deb_file = kernel_package_record.name
+            destination_full_path = download_location + os.path.sep + kernel_deb_file
+            source_full_urls = get_upstream_kernel_file_urls(kernel_version_directory_string, kernel_deb_file)
+            kernel_file_hashes = kernel_package_record.get_hashes()
+            kernel_file_hashers = None
+
+            if destination_full_path in verified_destinations:
+                kernel_file_state = "verified"
+            else:
+                kernel_download_journal.start(kernel_deb_file, destination_full_path, source_full_urls[0], kernel_file_hashes)
+                if kernel_deb_file in kernel_file_sources:
+                    kernel_file_state = "shared"
+                elif kernel_package_cache is not None and \
+                        kernel_package_cache.fetch(kernel_file_hashes, destination_full_path):
+                    kernel_download_journal.finish(kernel_deb_file, destination_full_path, True)
+                    kernel_file_sources[kernel_deb_file] = destination_full_path
+                    kernel_file_state = "cached"
+                elif any(kernel_download_job[0] is kernel_package_record and kernel_download_job[5] is None
+                         for kernel_download_job in kernel_download_jobs):
+                    kernel_file_state = "shared"
+                else:
+                    # hashers are fed while the file streams to disk
+                    kernel_file_hashers = create_file_hashers(kernel_file_hashes.keys())
+                    kernel_file_state = None
+
+            kernel_download_jobs.append([kernel_package_record, source_full_urls, destination_full_path,
+                                         download_location, kernel_file_hashers, kernel_file_state])
+
+    kernel_pending_download_jobs = [kernel_download_job for kernel_download_job in kernel_download_jobs
+                                    if kernel_download_job[5] is None]
+
+    # the wall time of all transfers together
+    # gives the overall throughput
+    downloads_timer = run_metrics.start_phase("downloads")
+
+    # download all files with the worker pool, a single
+    # worker downloads them one after the other, the
+    # progress of all transfers is shown together
+    if len(kernel_pending_download_jobs) > 0:
+        print_lb("Downloading {0} files with {1} concurrent download workers ...".format(
+            len(kernel_pending_download_jobs), min(DOWNLOAD_WORKER_COUNT, len(kernel_pending_download_jobs))))
+
+        transfer_progress.begin(len(kernel_pending_download_jobs))
+        try:
+            kernel_download_results = download_files_concurrently(
+                [[kernel_download_job[1], kernel_download_job[2], kernel_download_job[4]]
+                 for kernel_download_job in kernel_pending_download_jobs],
+                DOWNLOAD_WORKER_COUNT)
+        finally:
+            transfer_progress.end()
+        print_elb()
+
+    for kernel_package_record, source_full_urls, destination_full_path, download_location, kernel_file_hashers, kernel_file_state \
+            in kernel_download_jobs:
+
+        kernel_deb_file = kernel_package_record.name
+        kernel_download_journal = kernel_download_journals[download_location]
+        download_counter += 1
+
+        if kernel_file_state is not None:
+            if kernel_file_state == "verified":
+                print_nlb("[{0}]: File \"".format(download_counter) + kernel_deb_file +
+                          "\" was already downloaded and verified in \"" + destination_full_path + "\" ...")
+                print_lb(SKIPPED_STRING)
+                download_statistics["skipped"] += 1
+            elif kernel_file_state == "cached":
+                print_nlb("[{0}]: Placing file \"".format(download_counter) + kernel_deb_file +
+                          "\" from the package cache in \"" + destination_full_path + "\" ...")
+                print_lb(SUCCESS_STRING)
+                download_statistics["placed"] += 1
+            else:
+                print_nlb("[{0}]: Placing already downloaded file \"".format(download_counter) + kernel_deb_file +
+                          "\" in \"" + destination_full_path + "\" ...")
+                # the shared file failed to download
+                if kernel_deb_file not in kernel_file_sources:
+                    print_lb(FAILED_STRING)
+                    print_lb("The unfinished download will be resumed on the next run.")
+                    print_elb()
+                    download_statistics["failed"] += 1
+                    continue
+                link_or_copy_file(kernel_file_sources[kernel_deb_file], destination_full_path)
+                kernel_download_journal.finish(kernel_deb_file, destination_full_path, True)
+                print_lb(SUCCESS_STRING)
+                download_statistics["placed"] += 1
+
+            downloaded_kernel_files.append(destination_full_path)
+            print_lb("File size: " + str(get_file_size(destination_full_path)) + " bytes")
+            print_elb()
+            continue
+
+        print_nlb("[{0}]: Downloading file \"".format(download_counter) + kernel_deb_file
+                  + "\" from \"" +
+                  source_full_urls[0] +
+                  "\" to \"" +
+                  destination_full_path + "\" ...")
+
+        kernel_file_downloaded = kernel_download_results[destination_full_path]
+        if kernel_file_downloaded:
+            downloaded_kernel_files.append(destination_full_path)
+            print_lb(SUCCESS_STRING)
+        else:
+            print_lb(FAILED_STRING)
+
+        if not kernel_file_downloaded:
+            print_lb("The unfinished download will be resumed on the next run.")
+            print_elb()
+            download_statistics["failed"] += 1
+            continue
+
+        kernel_package_record.size = get_file_size(destination_full_path)
+        download_statistics["downloaded"] += 1
+        download_statistics["bytes"] += kernel_package_record.size
+
+        print_lb("File size: " + str(get_file_size(destination_full_path)) + " bytes")
+
+        print_nlb("Validating checksum from online kernel archive to downloaded local file ...")
+        verify_timer = run_metrics.start_phase("verify")
+
+        # the hashes were computed while downloading,
+        # so validating is just comparing them
+        kernel_file_is_valid = True
+        kernel_file_hash_report = list()
+        for kernel_checksum_algorithm, kernel_remote_hash in sorted(kernel_package_record.get_hashes().items()):
+            kernel_local_hash = kernel_file_hashers[kernel_checksum_algorithm].hexdigest()
+            kernel_file_hash_report.append(
+                "Local file {0} hash: ".format(kernel_checksum_algorithm) + kernel_local_hash + os.linesep +
+                "Remote file {0} hash: ".format(kernel_checksum_algorithm) + kernel_remote_hash)
+            if kernel_local_hash != kernel_remote_hash:
+                kernel_file_is_valid = False
+
+        run_metrics.stop_phase(verify_timer)
+        print_lb(FINISHED_STRING)
+
+        if kernel_file_is_valid:
+            print_lb(os.linesep.join(kernel_file_hash_report) + os.linesep + "OK. File is valid.")
+        else:
+            print_lb(os.linesep.join(kernel_file_hash_report) + os.linesep + "WARNING! File is possibly corrupted.")
+            download_statistics["corrupted"] += 1
+            run_metrics.add_counter("corrupted_files")
+
+        kernel_download_journal.finish(kernel_deb_file, destination_full_path, kernel_file_is_valid)
+
+        if kernel_file_is_valid:
+            kernel_file_sources[kernel_deb_file] = destination_full_path
+            if kernel_package_cache is not None:
+                kernel_package_cache.store(kernel_package_record.get_hashes(), destination_full_path)
+
+        print_elb()
+
+    run_metrics.stop_phase(downloads_timer)
+
+    return downloaded_kernel_files
+
+
+def create_download_location(download_location):
+    # Check whether the download directory exists or not
+    # and create on missing
+    print_nlb("Checking for download arch and flavor sub-directory availability ...")
+
+    if not os.path.isdir(download_location):
+        print_lb(MISSING_STRING)
+        print_nlb(
+            "Creating new arch and flavor download sub-directory in \"" + quote(
+                download_location) + "\" ...")
+        os.makedirs(download_location)
+        print_lb(SUCCESS_STRING)
     else:
+        print_lb(SUCCESS_STRING)
+        print_lb("Download sub-directory for arch and flavor already exists in: \"" + quote(
+            download_location) + "\"")
+
+
+def run_batch_download(
+        kernel_version_directory_string,
+        kernel_checksums_file_url,
+        kernel_checksums_text):
+    global script_exit_code
+
+    print_lb("[Batch downloading kernel targets]:" + os.linesep +
+             "----------------------------------")
+
+    kernel_download_locations = list()
+    kernel_batch_target_locations = list()
+
+    for kernel_arch, kernel_flavor in user_batch_targets:
+        print_nlb("Checking for target \"{0}/{1}\" availability ...".format(kernel_arch, kernel_flavor))
+
+        if not kernel_package_index.has_target(kernel_arch, kernel_flavor):
+            print_lb(MISSING_STRING)
+            print_lb("The target \"{0}/{1}\" is not available for this kernel version and will be skipped.".format(
+                kernel_arch, kernel_flavor))
+            script_exit_code = 1
+            continue
+
+        print_lb(AVAILABLE_STRING)
+
+        download_location = get_kernel_download_location(kernel_version_directory_string, kernel_arch, kernel_flavor)
+        create_download_location(download_location)
+
+        kernel_package_records = kernel_package_index.get_target_records(kernel_arch, kernel_flavor)
+        kernel_download_locations.append([download_location, kernel_package_records])
+        kernel_batch_target_locations.append([kernel_arch, kernel_flavor, download_location, kernel_package_records])
+
+    print_elb()
+
+    if len(kernel_download_locations) == 0:
+        print_lb("None of the batch targets is available. No files have been downloaded.")
+        script_exit_code = 1
+        return
+
+    kernel_unique_files_count = len(set(kernel_package_record.name for kernel_package_record in itertools.chain.from_iterable(
+        kernel_package_records for download_location, kernel_package_records in kernel_download_locations)))
+
+    print_lb("Starting download of {0} unique files for {1} targets (press Ctrl+C to abort running download task) ...".format(
+        kernel_unique_files_count, len(kernel_download_locations)))
+    print_elb()
+
+    del user_downloaded_kernel_deb_files[:]  # delete already downloaded files list
+    user_downloaded_kernel_deb_files.extend(download_kernel_files(
+        kernel_version_directory_string,
+        kernel_checksums_file_url,
+        kernel_checksums_text,
+        kernel_download_locations))
+
+    print_lb("[Batch download summary]:" + os.linesep +
+             "------------------------")
+
+    for kernel_arch, kernel_flavor, download_location, kernel_package_records in kernel_batch_target_locations:
+        kernel_target_downloaded_files_count = len(
+            [kernel_package_record for kernel_package_record in kernel_package_records
+             if download_location + os.path.sep + kernel_package_record.name in user_downloaded_kernel_deb_files])
+        print_lb("{0}/{1}: {2} of {3} files in \"{4}\"".format(
+            kernel_arch, kernel_flavor, kernel_target_downloaded_files_count, len(kernel_package_records),
+            download_location))
+        if kernel_target_downloaded_files_count != len(kernel_package_records):
+            script_exit_code = 1
+
+    print_elb()
+
+
+def format_byte_size(byte_count):
+    for byte_unit in ["B", "KiB", "MiB", "GiB"]:
+        if byte_count < 1024 or byte_unit == "GiB":
+            return "{0:.1f} {1}".format(byte_count, byte_unit)
+        byte_count /= 1024.0
+
+
+def parse_byte_rate(byte_rate_string):
+    byte_rate_match = re.match(r"^(\d+(?:\.\d+)?)([km]?)$", byte_rate_string.strip().lower())
+    if byte_rate_match is None:
+        return None
+    byte_rate = int(float(byte_rate_match.group(1)) * {"": 1, "k": 1024, "m": 1024 * 1024}[byte_rate_match.group(2)])
+    return byte_rate if byte_rate > 0 else None
+
+
+def select_mirror_kernel_versions(kernel_versions):
+    if not user_mirror_settings["include_rc"]:
+        kernel_versions = [kernel_version for kernel_version in kernel_versions
+                           if is_kernel_release_version(kernel_version)]
+    if user_mirror_settings["from"] is not None:
+        kernel_versions = [kernel_version for kernel_version in kernel_versions
+                           if get_kernel_version_sort_key(kernel_version) >=
+                           get_kernel_version_sort_key(user_mirror_settings["from"])]
+    if user_mirror_settings["to"] is not None:
+        kernel_versions = [kernel_version for kernel_version in kernel_versions
+                           if get_kernel_version_sort_key(kernel_version) <=
+                           get_kernel_version_sort_key(user_mirror_settings["to"])]
+    if user_mirror_settings["last"] is not None:
+        kernel_versions = kernel_versions[-user_mirror_settings["last"]:]
+    return kernel_versions
+
+
+def is_mirror_target_selected(kernel_arch, kernel_flavor):
+    for arch_pattern, flavor_pattern in user_mirror_settings["filters"]:
+        if fnmatch.fnmatchcase(kernel_arch, arch_pattern) and fnmatch.fnmatchcase(kernel_flavor, flavor_pattern):
+            return True
+    return False
+
+
+def run_archive_mirror():
+    global script_exit_code
+
+    print_lb("[Mirroring Upstream kernel archive]:" + os.linesep +
+             "------------------------------------")
+
+    print_nlb("Trying to download the Upstream kernel archive directory index ...")
+    start_progress_spinner()
+    archive_index_timer = run_metrics.start_phase("archive_index")
+    kernel_versions = fetch_upstream_kernel_versions()
+    run_metrics.stop_phase(archive_index_timer)
+    stop_progress_spinner()
+    print_lb(SUCCESS_STRING)
+
+    kernel_versions = select_mirror_kernel_versions(kernel_versions)
+
+    if len(kernel_versions) == 0:
+        print_lb("No kernel versions in the Upstream kernel archive match the requested version range.")
         print_elb()
-        print_lb("Command line args are currently not supported.")
+        script_exit_code = 1
+        return
+
+    print_lb("Selected kernel versions to mirror: " + ", ".join(kernel_versions))
+
+    # fetch all CHECKSUMS files at once
+    print_nlb("Trying to download {0} kernel \"CHECKSUMS\" files concurrently ...".format(len(kernel_versions)))
+    start_progress_spinner()
+    checksums_timer = run_metrics.start_phase("checksums")
+    kernel_checksums_file_urls, kernel_checksums_responses = fetch_kernel_checksums_concurrently(kernel_versions)
+    run_metrics.stop_phase(checksums_timer)
+    stop_progress_spinner()
+    print_lb(FINISHED_STRING)
+    print_elb()
+
+    mirror_summary = list()
+
+    for kernel_version_index, kernel_version in enumerate(kernel_versions):
+        kernel_version_directory_string = "v" + kernel_version
+        web_response = kernel_checksums_responses[kernel_version_index]
+        download_statistics = dict()
+
+        mirror_version_header = "[Mirroring kernel version \"{0}\" ({1} of {2})]:".format(
+            kernel_version, kernel_version_index + 1, len(kernel_versions))
+        print_lb(mirror_version_header + os.linesep + "-" * (len(mirror_version_header) - 1))
+
+        if web_response is None or web_response[1] is None or web_response[0] != 200:
+            print_lb("Could not download \"{0}\", the version will be skipped.".format(
+                kernel_checksums_file_urls[kernel_version_index][0]))
+            print_elb()
+            mirror_summary.append([kernel_version, None])
+            script_exit_code = 1
+            continue
+
+        kernel_version_package_index = parse_kernel_checksums(web_response[1], kernel_version)
+
+        kernel_download_locations = list()
+        for kernel_arch in kernel_version_package_index.architectures:
+            for kernel_flavor in kernel_version_package_index.get_flavors(kernel_arch):
+                if is_mirror_target_selected(kernel_arch, kernel_flavor):
+                    download_location = get_kernel_download_location(
+                        kernel_version_directory_string, kernel_arch, kernel_flavor)
+                    create_download_location(download_location)
+                    kernel_download_locations.append(
+                        [download_location, kernel_version_package_index.get_target_records(kernel_arch, kernel_flavor)])
+
         print_elb()
+
+        if len(kernel_download_locations) == 0:
+            print_lb("No arch/flavor targets of this version match the mirror filter, the version will be skipped.")
+            print_elb()
+        else:
+            download_kernel_files(
+                kernel_version_directory_string,
+                kernel_checksums_file_urls[kernel_version_index][0],
+                web_response[1],
+                kernel_download_locations,
+                download_statistics)
+
+            if download_statistics["failed"] or download_statistics["corrupted"]:
+                script_exit_code = 1
+
+        mirror_summary.append([kernel_version, download_statistics])
+
+    kernel_archive_index.save()
+
+    print_lb("[Mirror summary]:" + os.linesep +
+             "----------------")
+
+    for kernel_version, download_statistics in mirror_summary:
+        if download_statistics is None:
+            print_lb("v{0}: CHECKSUMS not available, skipped".format(kernel_version))
+        elif len(download_statistics) == 0:
+            print_lb("v{0}: no matching targets".format(kernel_version))
+        else:
+            print_lb("v{0}: {1} downloaded ({2}), {3} placed, {4} up to date, {5} failed, {6} corrupted".format(
+                kernel_version,
+                download_statistics["downloaded"],
+                format_byte_size(download_statistics["bytes"]),
+                download_statistics["placed"],
+                download_statistics["skipped"],
+                download_statistics["failed"],
+                download_statistics["corrupted"]))
+
+    print_lb("Total downloaded: " + format_byte_size(
+        sum(download_statistics["bytes"] for kernel_version, download_statistics in mirror_summary
+            if download_statistics)))
+    print_elb()
+
+
+def run_kernel_version_listing():
+    global script_exit_code
+
+    print_lb("[Kernel versions in the Upstream kernel archive]:" + os.linesep +
+             "-------------------------------------------------")
+
+    print_nlb("Trying to refresh the Upstream kernel archive directory index ...")
+    start_progress_spinner()
+    archive_index_timer = run_metrics.start_phase("archive_index")
+    get_kernel_archive_index()
+    run_metrics.stop_phase(archive_index_timer)
+    stop_progress_spinner()
+    print_lb(SUCCESS_STRING)
+
+    kernel_versions = kernel_archive_index.find_versions(
+        user_list_settings["series"], user_list_settings["since"], None, user_list_settings["include_rc"])
+
+    # only the CHECKSUMS of versions the index
+    # has never seen are needed for the query
+    if user_list_settings["architectures"]:
+        unknown_architecture_versions = kernel_archive_index.get_unknown_architecture_versions(kernel_versions)
+        if len(unknown_architecture_versions) > 0:
+            print_nlb("Trying to download {0} kernel \"CHECKSUMS\" files for their architectures ...".format(
+                len(unknown_architecture_versions)))
+            start_progress_spinner()
+            checksums_timer = run_metrics.start_phase("checksums")
+            complete_kernel_archive_index_architectures(unknown_architecture_versions)
+            run_metrics.stop_phase(checksums_timer)
+            stop_progress_spinner()
+            print_lb(FINISHED_STRING)
+        kernel_versions = kernel_archive_index.find_versions(
+            user_list_settings["series"], user_list_settings["since"], user_list_settings["architectures"],
+            user_list_settings["include_rc"])
+
+    print_elb()
+
+    for kernel_version in kernel_versions:
+        kernel_version_architectures = kernel_archive_index.get_architectures(kernel_version)
+        print_lb("v{0}: {1}".format(kernel_version, ", ".join(kernel_version_architectures)
+                                    if kernel_version_architectures is not None else "architectures not known yet"))
+
+    if len(kernel_versions) == 0:
+        print_lb("No kernel versions in the Upstream kernel archive match the query.")
+        script_exit_code = 1
+    else:
+        print_lb("Matching kernel versions: {0}, newest: {1}".format(len(kernel_versions), kernel_versions[-1]))
+    print_elb()
+
+
+def get_audit_file_hash(audit_result_cache, algorithm, file_path, file_stat):
+    # returns [hash, True if it was hashed now], files
+    # unchanged since the last audit are not read at all
+    file_hash = audit_result_cache.get(file_path, file_stat, algorithm)
+    if file_hash is not None:
+        return [file_hash, False]
+    file_hash = hash_file_mapped(file_path, algorithm)
+    audit_result_cache.set(file_path, file_stat, algorithm, file_hash)
+    return [file_hash, True]
+
+
+def collect_kernel_tree_files():
+    # returns [[file path, file hashes, DownloadJournal or None], ...]
+    # and the DEB files no CHECKSUMS file knows, the cached packages
+    # are named after their own hash and have no journal
+    tree_files = list()
+    unknown_files = list()
+
+    for tree_directory, directory_names, file_names in os.walk(user_kernel_package_download_dir):
+        directory_names.sort()
+        if tree_directory == user_kernel_package_download_dir and USER_CACHE_FOLDER in directory_names:
+            directory_names.remove(USER_CACHE_FOLDER)
+        kernel_deb_files = sorted(file_name for file_name in file_names if file_name.endswith(".deb"))
+        if len(kernel_deb_files) == 0:
+            continue
+
+        kernel_package_index = None
+        if CHECKSUMS_FILE in file_names:
+            with io.open(os.path.join(tree_directory, CHECKSUMS_FILE), "r", encoding="utf-8") as fp:
+                kernel_package_index = parse_kernel_checksums(fp.read(), os.path.relpath(
+                    tree_directory, user_kernel_package_download_dir).split(os.path.sep)[0].lstrip("v"))
+        download_journal = DownloadJournal(tree_directory)
+
+        for kernel_deb_file in kernel_deb_files:
+            kernel_package_record = kernel_package_index.get_record(kernel_deb_file) \
+                if kernel_package_index is not None else None
+            if kernel_package_record is None or not kernel_package_record.get_hashes():
+                unknown_files.append(os.path.join(tree_directory, kernel_deb_file))
+                continue
+            tree_files.append([os.path.join(tree_directory, kernel_deb_file),
+                               kernel_package_record.get_hashes(), download_journal])
+
+    for algorithm in ["sha256", "sha1"]:
+        for tree_directory, directory_names, file_names in os.walk(os.path.join(
+                user_kernel_package_download_dir, USER_CACHE_FOLDER, PACKAGE_CACHE_OBJECTS_FOLDER, algorithm)):
+            for file_name in sorted(file_names):
+                # skip the temp files of a running store
+                if get_checksum_algorithm(file_name) == algorithm:
+                    tree_files.append([os.path.join(tree_directory, file_name), {algorithm: file_name}, None])
+
+    return [tree_files, unknown_files]
+
+
+def run_download_tree_audit():
+    global script_exit_code
+
+    print_lb("[Auditing the kernel download tree]:" + os.linesep +
+             "------------------------------------")
+
+    audit_timer = run_metrics.start_phase("audit")
+    audit_result_cache = AuditResultCache(os.path.join(
+        user_kernel_package_download_dir, USER_CACHE_FOLDER, AUDIT_RESULT_CACHE_FILE))
+
+    print_nlb("Collecting the kernel files and their \"CHECKSUMS\" in \"{0}\" ...".format(
+        user_kernel_package_download_dir))
+    audit_files, unknown_files = collect_kernel_tree_files()
+    print_lb(FINISHED_STRING)
+
+    # hardlinked copies share one inode, which is
+    # hashed once for all of its paths
+    audit_jobs = list()  # [algorithm, [[file path, file stat], ...]]
+    audit_jobs_by_inode = dict()
+    unreadable_files = list()
+    audit_byte_count = 0
+    for file_path, expected_hashes, download_journal in audit_files:
+        algorithm = get_strongest_checksum_algorithm(expected_hashes)
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            unreadable_files.append(file_path)
+            continue
+        audit_byte_count += file_stat.st_size
+        audit_job_key = (file_stat.st_dev, file_stat.st_ino, algorithm)
+        if audit_job_key not in audit_jobs_by_inode:
+            audit_jobs_by_inode[audit_job_key] = [algorithm, list()]
+            audit_jobs.append(audit_jobs_by_inode[audit_job_key])
+        audit_jobs_by_inode[audit_job_key][1].append([file_path, file_stat])
+
+    audit_worker_count = user_audit_settings["workers"] or AUDIT_WORKER_COUNT or get_cpu_count()
+    print_lb("Files to audit: {0} ({1}), {2} not in any \"CHECKSUMS\" file".format(
+        len(audit_files), format_byte_size(audit_byte_count), len(unknown_files)))
+    print_nlb("Hashing new and changed files with {0} workers ...".format(audit_worker_count))
+    start_progress_spinner()
+    hash_timer = run_metrics.start_phase("hash")
+    audit_results = run_tasks_concurrently(
+        get_audit_file_hash,
+        [[audit_result_cache, algorithm, audit_job_files[0][0], audit_job_files[0][1]]
+         for algorithm, audit_job_files in audit_jobs],
+        audit_worker_count)
+    run_metrics.stop_phase(hash_timer)
+    stop_progress_spinner()
+    print_lb(FINISHED_STRING)
+
+    file_hashes = dict()  # file path -> hash
+    hashed_file_count = 0
+    for audit_job, audit_result in zip(audit_jobs, audit_results):
+        algorithm, audit_job_files = audit_job
+        if audit_result is None:
+            unreadable_files.extend(file_path for file_path, file_stat in audit_job_files)
+            continue
+        file_hash, file_is_hashed = audit_result
+        for file_path, file_stat in audit_job_files:
+            if file_is_hashed:
+                audit_result_cache.set(file_path, file_stat, algorithm, file_hash)
+                hashed_file_count += 1
+            file_hashes[file_path] = file_hash
+
+    # a corrupted download is replaced by the next run, a
+    # corrupted package cache object is simply dropped
+    corrupted_files = list()
+    for file_path, expected_hashes, download_journal in audit_files:
+        if file_path not in file_hashes or \
+                file_hashes[file_path] == expected_hashes[get_strongest_checksum_algorithm(expected_hashes)]:
+            continue
+        corrupted_files.append(file_path)
+        if download_journal is not None:
+            download_journal.mark_corrupted(os.path.basename(file_path))
+        else:
+            try:
+                os.unlink(file_path)
+            except OSError:
+                pass
+
+    audit_result_cache.prune(file_path for file_path, expected_hashes, download_journal in audit_files)
+    audit_result_cache.save()
+    audit_seconds = run_metrics.stop_phase(audit_timer)
+    run_metrics.add_counter("audit_files", len(audit_files))
+    run_metrics.add_counter("audit_hashed_files", hashed_file_count)
+    run_metrics.add_counter("audit_corrupted_files", len(corrupted_files))
+    print_elb()
+
+    for file_path in corrupted_files:
+        print_lb("CORRUPTED: " + file_path + (" (removed from the package cache)" if os.path.relpath(
+            file_path, user_kernel_package_download_dir).startswith(USER_CACHE_FOLDER + os.path.sep) else ""))
+    for file_path in unreadable_files:
+        print_lb("UNREADABLE: " + file_path)
+    for file_path in unknown_files:
+        print_lb("UNKNOWN: " + file_path)
+
+    print_lb("Audited {0} files in {1:.1f} seconds: {2} hashed, {3} unchanged since the last audit, "
+             "{4} corrupted, {5} unreadable, {6} unknown".format(
+                 len(audit_files), audit_seconds, hashed_file_count, len(file_hashes) - hashed_file_count,
+                 len(corrupted_files), len(unreadable_files), len(unknown_files)))
+    if corrupted_files:
+        print_lb("Corrupted downloads are fetched again by the next download of their kernel version.")
+    if corrupted_files or unreadable_files:
+        script_exit_code = 1
+    print_elb()
+
+
+def run_download_tree_dedup():
+    global script_exit_code
+
+    print_lb("[Deduplicating the kernel download tree]:" + os.linesep +
+             "-----------------------------------------")
+
+    print_nlb("Collecting the kernel files and their \"CHECKSUMS\" in \"{0}\" ...".format(
+        user_kernel_package_download_dir))
+    tree_files, unknown_files = collect_kernel_tree_files()
+    print_lb(FINISHED_STRING)
+
+    # identical files are found by their CHECKSUMS
+    # hash, none of them is read
+    duplicate_groups = list()
+    duplicate_groups_by_hash = dict()
+    for file_path, file_hashes, download_journal in tree_files:
+        algorithm = get_strongest_checksum_algorithm(file_hashes)
+        duplicate_group_key = (algorithm, file_hashes[algorithm])
+        if duplicate_group_key not in duplicate_groups_by_hash:
+            duplicate_groups_by_hash[duplicate_group_key] = list()
+            duplicate_groups.append(duplicate_groups_by_hash[duplicate_group_key])
+        duplicate_groups_by_hash[duplicate_group_key].append([file_path, file_hashes, download_journal])
+
+    linked_file_count = 0
+    freed_byte_count = 0
+    unverified_group_count = 0
+    failed_files = list()
+    for duplicate_group in duplicate_groups:
+        if len(duplicate_group) < 2:
+            continue
+
+        # the copy every other one is linked to must be known good:
+        # a package cache object or a file its journal verified
+        source_file_path = None
+        for file_path, file_hashes, download_journal in duplicate_group:
+            if download_journal is None or download_journal.is_verified(
+                    os.path.basename(file_path), file_path, file_hashes):
+                source_file_path = file_path
+                break
+        if source_file_path is None:
+            unverified_group_count += 1
+            continue
+        source_file_stat = os.stat(source_file_path)
+
+        for file_path, file_hashes, download_journal in duplicate_group:
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                continue
+            # already linked, or on another file system
+            if (file_stat.st_dev, file_stat.st_ino) == (source_file_stat.st_dev, source_file_stat.st_ino) or \
+                    file_stat.st_dev != source_file_stat.st_dev:
+                continue
+            if not link_file(source_file_path, file_path):
+                failed_files.append(file_path)
+                continue
+            if download_journal is not None:
+                download_journal.mark_verified(os.path.basename(file_path), file_path, file_hashes)
+            linked_file_count += 1
+            # the blocks are only freed with the last link
+            if file_stat.st_nlink == 1:
+                freed_byte_count += file_stat.st_size
+
+    run_metrics.add_counter("dedup_linked_files", linked_file_count)
+    run_metrics.add_counter("dedup_freed_bytes", freed_byte_count)
+    print_elb()
+
+    for file_path in failed_files:
+        print_lb("NOT LINKED: " + file_path)
+
+    print_lb("Linked {0} duplicate files as {1}, {2} freed, {3} groups of duplicates without a verified "
+             "copy were left alone".format(linked_file_count, "reflinks or hardlinks" if PREFER_REFLINKS else
+                                           "hardlinks or reflinks", format_byte_size(freed_byte_count),
+                                           unverified_group_count))
+    if failed_files:
+        print_lb("The file system of these files supports neither hardlinks nor reflinks.")
+        script_exit_code = 1
+    print_elb()
+
+
+def parse_serve_address(serve_address_string):
+    # "[ADDRESS:]PORT" -> [address, port]
+    serve_address_match = re.match(r"^(?:(.*):)?(\d+)$", serve_address_string.strip())
+    if serve_address_match is None or not 0 < int(serve_address_match.group(2)) < 65536:
+        return None
+    return [serve_address_match.group(1) or LAN_CACHE_SERVER_ADDRESS, int(serve_address_match.group(2))]
+
+
+def create_lan_cache_http_server(server_address):
+    # the http server modules are only
+    # imported when the serve mode runs
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class LanCacheHttpRequestHandler(LanCacheRequestHandler, BaseHTTPRequestHandler):
+        pass
+
+    class LanCacheThreadingHttpServer(LanCacheHttpServer, ThreadingMixIn, HTTPServer):
+        pass
+
+    return LanCacheThreadingHttpServer(server_address, LanCacheHttpRequestHandler)
+
+
+def run_lan_cache_server():
+    print_lb("[Serving kernel packages in the local network]:" + os.linesep +
+             "-----------------------------------------------")
+
+    # misses are verified against CHECKSUMS and
+    # stored here, with or without USE_PACKAGE_CACHE
+    lan_package_cache = kernel_package_cache
+    if lan_package_cache is None:
+        lan_package_cache = PackageCache(os.path.join(user_kernel_package_download_dir, USER_CACHE_FOLDER))
+
+    lan_cache_server = create_lan_cache_http_server((user_serve_settings[0], user_serve_settings[1]))
+    lan_cache_server.lan_cache = LanCache(user_kernel_package_download_dir, lan_package_cache)
+
+    print_lb("Serving \"{0}\" and the Upstream kernel archive on http://{1}:{2}/".format(
+        user_kernel_package_download_dir, user_serve_settings[0], user_serve_settings[1]))
+    print_lb("Other hosts can use it with: --archive-url http://<this host>:{0}".format(user_serve_settings[1]))
+    print_lb("Press Ctrl+C to stop the server.")
+    print_elb()
+
+    try:
+        lan_cache_server.serve_forever()
+    finally:
+        lan_cache_server.server_close()
+
+
+def dispatch_command_line_arguments(args):
+    global FORCE_KERNEL_VERSION
+    global FORCE_KERNEL_SERIES
+    global FORCE_DOWNLOAD_LOCATION
+    global DOWNLOAD_WORKER_COUNT
+    global SEGMENTED_DOWNLOAD_CONNECTIONS
+    global SKIP_CONNECTION_PROBE
+    global FAST_START
+    global DOWNLOAD_BANDWIDTH_LIMIT
+    global METRICS_OUTPUT_FILE
+    global USE_ASYNC_ENGINE
+    global LATEST_UPSTREAM_KERNELS_ARCHIVE_URL
+    global UPSTREAM_KERNELS_ARCHIVE_MIRRORS
+    global user_batch_targets
+    global user_mirror_settings
+    global user_serve_settings
+    global user_list_settings
+    global user_audit_settings
+    global user_dedup_mode
+
+    argument_parser = argparse.ArgumentParser(
+        prog="sukd",
+        description="Stable Upstream kernel downloader. Without arguments the script runs interactively.")
+    argument_parser.add_argument("--kernel-version", metavar="VERSION",
+                                 help="use this kernel version instead of the latest stable one")
+    argument_parser.add_argument("--kernel-series", metavar="SERIES",
+                                 help="use the newest release of this series instead of the latest stable one, "
+                                      "e.g. 6.1, in batch mode the newest one with all batch architectures")
+    argument_parser.add_argument("--download-dir", metavar="DIRECTORY",
+                                 help="use this absolute download location")
+    argument_parser.add_argument("--workers", metavar="N", type=int,
+                                 help="number of concurrent download workers")
+    argument_parser.add_argument("--segments", metavar="N", type=int,
+                                 help="fetch large files in N byte ranges over parallel connections")
+    argument_parser.add_argument("--limit-rate", metavar="RATE",
+                                 help="limit the total download bandwidth in bytes per second, "
+                                      "the suffixes k and m are allowed, e.g. 500k or 2m")
+    argument_parser.add_argument("--metrics-file", metavar="FILE",
+                                 help="write phase timings and counters to FILE, as Prometheus text "
+                                      "if FILE ends with .prom, as JSON otherwise")
+    argument_parser.add_argument("--async-engine", action="store_true",
+                                 help="run all network I/O on one asyncio event loop (Python 3.7+)")
+    argument_parser.add_argument("--archive-url", metavar="URL",
+                                 help="use this Upstream kernel archive, e.g. another host running --serve")
+    argument_parser.add_argument("--archive-mirror", metavar="URL", action="append",
+                                 help="another archive with the same files, the best ranked archive is used "
+                                      "and the others on errors, can be given several times")
+    argument_parser.add_argument("--serve", metavar="[ADDRESS:]PORT", nargs="?", const="",
+                                 help="serve the downloaded kernels and the Upstream kernel archive to other "
+                                      "hosts, fetching missing files once (default {0}:{1})".format(
+                                     LAN_CACHE_SERVER_ADDRESS, LAN_CACHE_SERVER_PORT))
+    argument_parser.add_argument("--no-probe", action="store_true",
+                                 help="skip the internet connection probe")
+    argument_parser.add_argument("--fast-start", action="store_true",
+                                 help="skip the connection probe, the environment report and "
+                                      "checks for tools the chosen action does not need")
+    argument_parser.add_argument("--batch", metavar="ARCH/FLAVOR", nargs="+",
+                                 help="download all given targets non-interactively in one pass, "
+                                      "e.g. --batch amd64/generic arm64/lowlatency")
+    argument_parser.add_argument("--mirror-last", metavar="N", type=int,
+                                 help="mirror the last N kernel versions of the Upstream kernel archive")
+    argument_parser.add_argument("--mirror-from", metavar="VERSION",
+                                 help="mirror all kernel versions since this version")
+    argument_parser.add_argument("--mirror-to", metavar="VERSION",
+                                 help="mirror all kernel versions up to this version")
+    argument_parser.add_argument("--mirror-filter", metavar="ARCH/FLAVOR", nargs="+", default=["*/*"],
+                                 help="mirror only matching targets, wildcards allowed, e.g. amd64/* */generic")
+    argument_parser.add_argument("--list-versions", metavar="SERIES", nargs="?", const="",
+                                 help="list the kernel versions of the Upstream kernel archive, all or the "
+                                      "ones of a series like 6.1, answered from the cached directory index")
+    argument_parser.add_argument("--list-since", metavar="VERSION",
+                                 help="list only kernel versions since this version")
+    argument_parser.add_argument("--list-arch", metavar="ARCH", action="append",
+                                 help="list only kernel versions with builds for this architecture, "
+                                      "can be given several times")
+    argument_parser.add_argument("--include-rc", action="store_true",
+                                 help="mirror or list release candidates too")
+    argument_parser.add_argument("--audit", action="store_true",
+                                 help="verify all downloaded kernel files against their saved CHECKSUMS, "
+                                      "only new and changed files are hashed, --workers sets the parallel hashes")
+    argument_parser.add_argument("--dedup", action="store_true",
+                                 help="replace identical kernel files of the download tree by hardlinks, "
+                                      "or reflinks where the file system supports them")
+
+    parsed_args = argument_parser.parse_args(args)
+
+    if parsed_args.kernel_version:
+        FORCE_KERNEL_VERSION = parsed_args.kernel_version.lstrip("v")
+    if parsed_args.kernel_series:
+        if parsed_args.kernel_version:
+            argument_parser.error("a kernel version and a kernel series can not be combined")
+        FORCE_KERNEL_SERIES = parsed_args.kernel_series.lstrip("v")
+    if parsed_args.download_dir:
+        FORCE_DOWNLOAD_LOCATION = os.path.abspath(parsed_args.download_dir)
+    if parsed_args.workers is not None:
+        if parsed_args.workers < 1:
+            argument_parser.error("the number of workers must be at least 1")
+        DOWNLOAD_WORKER_COUNT = parsed_args.workers
+    if parsed_args.segments is not None:
+        if parsed_args.segments < 1:
+            argument_parser.error("the number of segments must be at least 1")
+        SEGMENTED_DOWNLOAD_CONNECTIONS = parsed_args.segments
+    if parsed_args.limit_rate:
+        DOWNLOAD_BANDWIDTH_LIMIT = parse_byte_rate(parsed_args.limit_rate)
+        if DOWNLOAD_BANDWIDTH_LIMIT is None:
+            argument_parser.error("invalid rate \"{0}\", use bytes per second like 500k or 2m".format(
+                parsed_args.limit_rate))
+    if parsed_args.metrics_file:
+        METRICS_OUTPUT_FILE = os.path.abspath(parsed_args.metrics_file)
+    if parsed_args.async_engine:
+        USE_ASYNC_ENGINE = True
+    if parsed_args.archive_url:
+        LATEST_UPSTREAM_KERNELS_ARCHIVE_URL = parsed_args.archive_url.rstrip("/")
+    if parsed_args.archive_mirror:
+        UPSTREAM_KERNELS_ARCHIVE_MIRRORS = UPSTREAM_KERNELS_ARCHIVE_MIRRORS + [
+            archive_mirror.rstrip("/") for archive_mirror in parsed_args.archive_mirror]
+    if parsed_args.no_probe:
+        SKIP_CONNECTION_PROBE = True
+    if parsed_args.fast_start:
+        FAST_START = True
+
+    if parsed_args.batch:
+        user_batch_targets = list()
+        for batch_target in parsed_args.batch:
+            batch_target_parts = batch_target.split("/")
+            if len(batch_target_parts) != 2 or not all(batch_target_parts):
+                argument_parser.error("invalid batch target \"{0}\", use ARCH/FLAVOR".format(batch_target))
+            if batch_target_parts not in user_batch_targets:
+                user_batch_targets.append(batch_target_parts)
+
+    if parsed_args.mirror_last is not None or parsed_args.mirror_from or parsed_args.mirror_to:
+        if parsed_args.batch:
+            argument_parser.error("the mirror and batch modes can not be combined")
+        if parsed_args.mirror_last is not None and parsed_args.mirror_last < 1:
+            argument_parser.error("the number of versions to mirror must be at least 1")
+        user_mirror_settings = {"last": parsed_args.mirror_last,
+                                "from": parsed_args.mirror_from.lstrip("v") if parsed_args.mirror_from else None,
+                                "to": parsed_args.mirror_to.lstrip("v") if parsed_args.mirror_to else None,
+                                "include_rc": parsed_args.include_rc,
+                                "filters": list()}
+        for mirror_filter in parsed_args.mirror_filter:
+            mirror_filter_parts = mirror_filter.split("/")
+            if len(mirror_filter_parts) != 2 or not all(mirror_filter_parts):
+                argument_parser.error("invalid mirror filter \"{0}\", use ARCH/FLAVOR".format(mirror_filter))
+            user_mirror_settings["filters"].append(mirror_filter_parts)
+
+    if parsed_args.list_versions is not None:
+        if parsed_args.batch or user_mirror_settings is not None or parsed_args.serve is not None:
+            argument_parser.error("the list mode can not be combined with the batch, mirror or serve mode")
+        user_list_settings = {"series": parsed_args.list_versions.lstrip("v") or None,
+                              "since": parsed_args.list_since.lstrip("v") if parsed_args.list_since else None,
+                              "architectures": parsed_args.list_arch or list(),
+                              "include_rc": parsed_args.include_rc}
+
+    if parsed_args.audit:
+        if parsed_args.batch or user_mirror_settings is not None or user_list_settings is not None or \
+                parsed_args.serve is not None:
+            argument_parser.error("the audit mode can not be combined with the batch, mirror, list or serve mode")
+        user_audit_settings = {"workers": parsed_args.workers}
+
+    if parsed_args.dedup:
+        if parsed_args.batch or user_mirror_settings is not None or user_list_settings is not None or \
+                user_audit_settings is not None or parsed_args.serve is not None:
+            argument_parser.error("the dedup mode can not be combined with the batch, mirror, list, audit "
+                                  "or serve mode")
+        user_dedup_mode = True
+
+    if parsed_args.serve is not None:
+        if parsed_args.batch or user_mirror_settings is not None:
+            argument_parser.error("the serve mode can not be combined with the batch or mirror mode")
+        if parsed_args.async_engine:
+            argument_parser.error("the serve mode runs on threads and can not use the asyncio engine")
+        user_serve_settings = parse_serve_address(parsed_args.serve or str(LAN_CACHE_SERVER_PORT))
+        if user_serve_settings is None:
+            argument_parser.error("invalid serve address \"{0}\", use [ADDRESS:]PORT".format(parsed_args.serve))
+
     return True  # Script info header
 
 
@@ -580,9 +4322,17 @@ script_info_header = """\n#*********************************************#
 
 def main(argv):
     # global import of variables
-    global sha1sum_bin_file_full_path
+    global kernel_package_cache
+    global kernel_metadata_cache
+    global kernel_package_index
+    global download_bandwidth_limiter
+    global transfer_progress
+    global async_transfer_engine
+    global archive_mirror_ranking
     global dpkg_bin_file_full_path
     global latest_stable_kernel_checksums_file
+    global SKIP_CONNECTION_PROBE
+    global script_exit_code
 
     # print application info
     print_lb(script_info_header)
@@ -596,6 +4346,8 @@ def main(argv):
     print_lb("[Checking environment requirements]:" + os.linesep +
              "-----------------------------------")
 
+    environment_timer = run_metrics.start_phase("environment")
+
     print_nlb("Is system linux based ...")
 
     # only linux is allowed to run
@@ -626,46 +4378,91 @@ def main(argv):
         print_lb(AVAILABLE_STRING)
         print_lb("Download directory already exists in: " + quote(user_kernel_package_download_dir))
 
-    # check for sha1sum binary for downloaded
-    # files verfification
-    print_nlb("Checking for \"{0}\" availability ...".format(SHA1SUM_BIN_FILE))
-
-    sha1sum_bin_file_full_path = distutils.spawn.find_executable(SHA1SUM_BIN_FILE)
-
-    if not os.path.isfile(sha1sum_bin_file_full_path):
-        raise IOError(
-            "The \"{0}\" binary is missing for checksum validation. This is mandatory!".format(SHA1SUM_BIN_FILE))
-
+    # verified files are kept in a content-addressed
+    # store and reused instead of downloading them again
+    if USE_PACKAGE_CACHE:
+        kernel_package_cache = PackageCache(os.path.join(user_kernel_package_download_dir, USER_CACHE_FOLDER))
+        print_lb("Verified kernel packages are cached in: " + quote(kernel_package_cache.cache_directory))
+
+    # online metadata is revalidated with conditional
+    # requests and fetched only once per session
+    if USE_METADATA_CACHE:
+        kernel_metadata_cache = MetadataCache(
+            os.path.join(user_kernel_package_download_dir, USER_CACHE_FOLDER, METADATA_CACHE_FOLDER))
+
+    # one bandwidth budget for all
+    # concurrent downloads together
+    if DOWNLOAD_BANDWIDTH_LIMIT:
+        download_bandwidth_limiter = TokenBucket(DOWNLOAD_BANDWIDTH_LIMIT, DOWNLOAD_BANDWIDTH_BURST_IN_SEC)
+
+    # redrawn in place on a terminal, periodic lines in a log
+    # file, the server logs its requests instead
+    if user_serve_settings is None:
+        transfer_progress = TransferProgress(sys.stdout.isatty())
+
+    # the asyncio engine replaces the worker threads
+    # and the download tools for all network I/O
+    if USE_ASYNC_ENGINE and user_serve_settings is None:
+        print_nlb("Checking for asyncio network engine availability ...")
+        async_transfer_engine = create_async_transfer_engine()
+        if async_transfer_engine is None:
+            print_lb(MISSING_STRING)
+            print_lb("The asyncio engine needs Python 3.7 or newer and \"sukd_async.py\", threads will be used.")
+        else:
+            print_lb(AVAILABLE_STRING)
+            print_lb("All network I/O runs on one asyncio event loop, download tools will not be used.")
+            if SEGMENTED_DOWNLOAD_CONNECTIONS > 1:
+                print_lb("The asyncio engine does not split files into segments, "
+                         "every file is fetched with a single stream.")
+
+    # downloaded files are verified in-process
+    # while streaming, no checksum binary needed
+    print_nlb("Checking for in-process checksum algorithms availability ...")
     print_lb(AVAILABLE_STRING)
-    print_lb("The \"{0}\" binary file is located in: {1}".format(SHA1SUM_BIN_FILE, sha1sum_bin_file_full_path))
+    print_lb("Downloaded files will be validated with: " + ", ".join(
+        sorted(CHECKSUM_ALGORITHMS_BY_HASH_LENGTH.values())))
 
-    # check for dpkg binary for
-    # installation
-    print_nlb("Checking for \"{0}\" availability ...".format(DPKG_BIN_FILE))
+    # the tool paths of the last start are reused
+    # as long as no PATH directory has changed
+    tool_discovery_cache = ToolDiscoveryCache(
+        os.path.join(user_kernel_package_download_dir, USER_CACHE_FOLDER, TOOL_DISCOVERY_CACHE_FILE))
 
-    dpkg_bin_file_full_path = distutils.spawn.find_executable(DPKG_BIN_FILE)
+    # check for dpkg binary for installation, only
+    # the interactive mode installs and only as root
+    print_nlb("Checking for \"{0}\" availability ...".format(DPKG_BIN_FILE))
 
-    if not os.path.isfile(dpkg_bin_file_full_path):
-        print_lb(MISSING_STRING)
-        print_lb("The \"{0}\" binary is missing for kernel files installation.".format(DPKG_BIN_FILE))
+    if user_batch_targets is not None or user_mirror_settings is not None or user_serve_settings is not None or \
+            user_list_settings is not None or user_audit_settings is not None or user_dedup_mode or \
+            (FAST_START and os.geteuid() != 0):
+        print_lb(SKIPPED_STRING)
     else:
-        print_lb(AVAILABLE_STRING)
-        print_lb("The \"{0}\" binary file is located in: {1}".format(DPKG_BIN_FILE, dpkg_bin_file_full_path))
+        dpkg_bin_file_full_path = tool_discovery_cache.find(DPKG_BIN_FILE)
+
+        if dpkg_bin_file_full_path is None:
+            print_lb(MISSING_STRING)
+            print_lb("The \"{0}\" binary is missing for kernel files installation.".format(DPKG_BIN_FILE))
+        else:
+            print_lb(AVAILABLE_STRING)
+            print_lb("The \"{0}\" binary file is located in: {1}".format(DPKG_BIN_FILE, dpkg_bin_file_full_path))
 
-    # check for dpkg binary for
-    # grub update
+    # check for download tools, the asyncio engine does
+    # not use them and the list, audit and dedup modes
+    # download no files
     print_lb("Checking for download tools availability:")
 
-    for download_tool in DOWNLOAD_TOOLS.items():
+    download_tools_needed = async_transfer_engine is None and user_list_settings is None and \
+        user_audit_settings is None and not user_dedup_mode
+
+    for download_tool in (DOWNLOAD_TOOLS.items() if download_tools_needed else []):
 
         # reference global variable
         global downloader_bin_full_path_and_param
 
         print_nlb("Probing for \"{0}\" availability ...".format(download_tool[0]))
 
-        downloader_bin_full_path = distutils.spawn.find_executable(string_to_unicode(download_tool[0]))
+        downloader_bin_full_path = tool_discovery_cache.find(string_to_unicode(download_tool[0]))
 
-        if not os.path.isfile(string_to_unicode(downloader_bin_full_path)):
+        if downloader_bin_full_path is None:
             print_lb(MISSING_STRING)
         else:
             print_lb(AVAILABLE_STRING)
@@ -678,23 +4475,46 @@ def main(argv):
             # binary found, insert to array
             downloader_bin_full_path_and_param.append(downloader_bin_full_path)
             downloader_bin_full_path_and_param.append(download_tool[1])
+            downloader_bin_full_path_and_param.append(DOWNLOAD_TOOLS_LIMIT_RATE_PARAMS[download_tool[0]])
+            downloader_bin_full_path_and_param.append(DOWNLOAD_TOOLS_STALL_PARAMS[download_tool[0]])
             break
 
     # check whether we will use the simple
     # build-in downloader as fallback or not
-    if downloader_bin_full_path_and_param is None:
+    if async_transfer_engine is not None:
+        print_lb("Skipped, the asyncio engine downloads all files itself.")
+    elif not download_tools_needed:
+        print_lb("Skipped, this mode downloads no files.")
+    elif downloader_bin_full_path_and_param is None:
         print_lb("Could not find any suitable downloader. The build-in downloader will be used.")
 
-    restart_internet_connection_attempt = True
+    tool_discovery_cache.save()
+
+    run_metrics.stop_phase(environment_timer)
+
+    # the metadata download proves the
+    # connection just as well as a probe
+    if FAST_START or user_audit_settings is not None or user_dedup_mode:
+        SKIP_CONNECTION_PROBE = True
+
+    restart_internet_connection_attempt = not SKIP_CONNECTION_PROBE
+
+    if SKIP_CONNECTION_PROBE:
+        print_nlb("Checking for internet connection availability ...")
+        print_lb(SKIPPED_STRING)
+        print_lb("The audit and dedup modes work offline." if user_audit_settings is not None or user_dedup_mode else
+                 "The online kernel information download will prove the internet connection.")
 
     while restart_internet_connection_attempt:
         # check for internet availability
-        print_nlb("Checking for internet connection availability in {0} seconds timeout cycle, please wait ...".format(
-            SERVER_TIMEOUT_CYCLES_IN_SEC))
+        print_nlb("Checking for internet connection availability within {0} seconds, please wait ...".format(
+            SERVER_PROBE_DEADLINE_IN_SEC))
 
         start_progress_spinner()
 
+        connection_probe_timer = run_metrics.start_phase("connection_probe")
         internet_available = is_internet_available()
+        run_metrics.stop_phase(connection_probe_timer)
 
         restart_internet_connection_attempt = False
 
@@ -709,6 +4529,13 @@ def main(argv):
 
             print_elb()
 
+            # never wait for input in batch, mirror, serve or list mode
+            if user_batch_targets is not None or user_mirror_settings is not None or \
+                    user_serve_settings is not None or user_list_settings is not None:
+                print_lb("Internet connection not available. The download continues without being " +
+                         "aware of a running internet connection.")
+                break
+
             print_lb("Internet connection not available. You need a running internet " +
                      "connection in order to use this script and download the kernel " +
                      "packages. Would you like to restart a connection attempt to the " +
@@ -728,24 +4555,86 @@ def main(argv):
     print_elb()
 
     # collect and print user and os environment data
-    print_lb("[Environment information]:" + os.linesep +
-             "-------------------------")
-    print_lb("Kernel version info JSON url: " + LATEST_KERNEL_VERSION_JSON_URL)
-    print_lb("Upstream kernels archive url: " + LATEST_UPSTREAM_KERNELS_ARCHIVE_URL)
-    print_lb("User home directory is: " + user_home_directory)
-    print_lb("Script base download directory is: " + user_home_download_directory)
-    print_lb("Kernel packages download directory is: " + user_kernel_package_download_dir + "/<ver>/<arch>/<flavor>")
-    print_lb("Running Linux platform: " + os_linux_platform)
-    print_lb("Running Linux architecture is: " + os_linux_architecture)
-    print_lb("Running Python version is: " + os_python_version)
-    print_elb()
+    if not FAST_START:
+        print_lb("[Environment information]:" + os.linesep +
+                 "-------------------------")
+        print_lb("Kernel version info JSON url: " + LATEST_KERNEL_VERSION_JSON_URL)
+        print_lb("Upstream kernels archive url: " + LATEST_UPSTREAM_KERNELS_ARCHIVE_URL)
+        print_lb("User home directory is: " + user_home_directory)
+        print_lb("Script base download directory is: " + user_home_download_directory)
+        print_lb("Kernel packages download directory is: " + user_kernel_package_download_dir + "/<ver>/<arch>/<flavor>")
+        print_lb("Running Linux platform: " + platform.platform())  # slow, read only here
+        print_lb("Running Linux architecture is: " + os_linux_architecture)
+        print_lb("Running Python version is: " + os_python_version)
+        for archive_mirror in UPSTREAM_KERNELS_ARCHIVE_MIRRORS:
+            print_lb("Upstream kernels archive mirror url: " + archive_mirror)
+        if download_bandwidth_limiter is not None:
+            print_lb("Total download bandwidth is limited to: " + format_byte_size(DOWNLOAD_BANDWIDTH_LIMIT) + "/s")
+        print_elb()
+
+    # everything up to the first online request,
+    # the module imports included
+    startup_seconds = time.time() - script_start_time
+    run_metrics.add_phase_time("startup", startup_seconds)
+    if FAST_START:
+        print_lb("Startup took {0} ms.".format(int(startup_seconds * 1000)))
+        if startup_seconds > STARTUP_TIME_BUDGET_IN_SEC:
+            print_lb("WARNING! The startup time budget of {0} ms is exceeded.".format(
+                int(STARTUP_TIME_BUDGET_IN_SEC * 1000)))
+        print_elb()
+
+    # with mirrors every file comes from the archive
+    # with the best measured latency and throughput
+    archive_urls = [LATEST_UPSTREAM_KERNELS_ARCHIVE_URL] + [
+        archive_mirror for archive_mirror in UPSTREAM_KERNELS_ARCHIVE_MIRRORS
+        if archive_mirror != LATEST_UPSTREAM_KERNELS_ARCHIVE_URL]
+    if len(archive_urls) > 1 and user_audit_settings is None and not user_dedup_mode:
+        print_nlb("Ranking {0} Upstream kernel archives by latency and throughput ...".format(len(archive_urls)))
+        start_progress_spinner()
+        archive_mirror_ranking = ArchiveMirrorRanking(archive_urls, os.path.join(
+            user_kernel_package_download_dir, USER_CACHE_FOLDER, ARCHIVE_MIRROR_RANKING_FILE))
+        mirror_ranking_timer = run_metrics.start_phase("mirror_ranking")
+        probed_archive_urls = archive_mirror_ranking.rank()
+        run_metrics.stop_phase(mirror_ranking_timer)
+        stop_progress_spinner()
+        print_lb(FINISHED_STRING)
+        for archive_rank, archive_url in enumerate(archive_mirror_ranking.get_ranked_urls()):
+            mirror_probe = archive_mirror_ranking.mirror_probes[archive_url]
+            print_lb("[{0}]: {1} ".format(archive_rank + 1, archive_url) + (
+                "unreachable" if mirror_probe["latency"] is None else "{0} ms, {1}/s".format(
+                    int(mirror_probe["latency"] * 1000), format_byte_size(mirror_probe["bytes_per_second"]))) +
+                ("" if archive_url in probed_archive_urls else " (measured earlier)"))
+        print_elb()
 
     try:
 
+        # the mirror mode syncs several versions
+        # at once and never enters the loop
+        if user_mirror_settings is not None:
+            run_archive_mirror()
+
+        # the serve mode runs until Ctrl+C
+        if user_serve_settings is not None:
+            run_lan_cache_server()
+
+        # the list mode only queries the archive index
+        if user_list_settings is not None:
+            run_kernel_version_listing()
+
+        # the audit mode only reads the download tree
+        if user_audit_settings is not None:
+            run_download_tree_audit()
+
+        # the dedup mode only links files of the download tree
+        if user_dedup_mode:
+            run_download_tree_dedup()
+
         # loop to repeat_download step if
         # if user wants to download more
         # variants
-        repeat_download = True
+        repeat_download = user_mirror_settings is None and user_serve_settings is None and \
+            user_list_settings is None and user_audit_settings is None and not user_dedup_mode
+        optionally_installing = ""
         while repeat_download:
 
             print_lb("[Collecting online Upstream kernel information]:" + os.linesep +
@@ -761,10 +4650,33 @@ def main(argv):
                     FORCE_KERNEL_VERSION))
                 kernel_info_json_data_stream = True  # fake a valid stream
                 latest_stable_kernel_version_number = FORCE_KERNEL_VERSION
+            elif FORCE_KERNEL_SERIES:
+                print_lb(SKIPPED_STRING)
+                print_nlb("Trying to find the newest \"{0}\" kernel in the Upstream kernel archive directory index ...".format(
+                    FORCE_KERNEL_SERIES))
+                # a batch needs a version that has
+                # builds for all its architectures
+                start_progress_spinner()
+                archive_index_timer = run_metrics.start_phase("archive_index")
+                latest_stable_kernel_version_number = find_newest_kernel_series_version(
+                    FORCE_KERNEL_SERIES, sorted(set(batch_target[0] for batch_target in user_batch_targets or list())))
+                run_metrics.stop_phase(archive_index_timer)
+                stop_progress_spinner()
+
+                if latest_stable_kernel_version_number is None:
+                    print_lb(FAILED_STRING)
+                    print_elb()
+                    raise WebFileDownloadError(
+                        "There is no release of the kernel series \"{0}\" in the Upstream kernel archive{1}.".format(
+                            FORCE_KERNEL_SERIES, " with builds for all batch architectures" if user_batch_targets else ""))
+
+                print_lb(SUCCESS_STRING)
             else:
                 # download the json info data
                 start_progress_spinner()
+                releases_json_timer = run_metrics.start_phase("releases_json")
                 web_response = open_webfile_get_response(LATEST_KERNEL_VERSION_JSON_URL)
+                run_metrics.stop_phase(releases_json_timer)
                 kernel_info_json_data_stream = web_response[1]
 
                 if kernel_info_json_data_stream is None or web_response[0] != 200:
@@ -787,6 +4699,9 @@ def main(argv):
             # print version info data
             if FORCE_KERNEL_VERSION:
                 print_lb("User defined kernel version is: " + latest_stable_kernel_version_number)
+            elif FORCE_KERNEL_SERIES:
+                print_lb("Newest kernel version of the \"{0}\" series is: ".format(
+                    FORCE_KERNEL_SERIES) + latest_stable_kernel_version_number)
             else:
                 print_lb("Latest stable kernel version is: " + latest_stable_kernel_version_number)
 
@@ -795,10 +4710,13 @@ def main(argv):
 
             start_progress_spinner()
             # download the CHECKSUMS info data stream
-            latest_stable_kernel_checksums_file = LATEST_UPSTREAM_KERNELS_ARCHIVE_URL + os.path.sep + latest_stable_kernel_version_directory_string + os.path.sep + CHECKSUMS_FILE
-            web_response = open_webfile_get_response(latest_stable_kernel_checksums_file)
+            latest_stable_kernel_checksums_file = get_upstream_kernel_file_url(latest_stable_kernel_version_directory_string, CHECKSUMS_FILE)
+            checksums_timer = run_metrics.start_phase("checksums")
+            web_response = open_mirrored_webfile_get_response(get_upstream_kernel_file_urls(
+                latest_stable_kernel_version_directory_string, CHECKSUMS_FILE))
+            run_metrics.stop_phase(checksums_timer)
             kernel_checksums_file_stream = web_response[1]
-            if kernel_info_json_data_stream is None or web_response[0] != 200:
+            if kernel_checksums_file_stream is None or web_response[0] != 200:
                 print_lb(FAILED_STRING)
                 print_elb()
                 raise WebFileDownloadError(
@@ -814,25 +4732,10 @@ def main(argv):
 
             start_progress_spinner()
 
-            # build the dictionaries with the hashed files
-            checksums_stream = get_string_unicode_stream(kernel_checksums_file_stream)
-
-            # iterate over elements
-            # and filter
-            # add pseudo cancel arch first, zero is always cancel
-            del kernel_available_architectures[:]  # cleanup lists
-            for read_line in checksums_stream:
-                read_line = read_line.strip()
-                if re.search(r".*\.deb$", read_line, re.IGNORECASE | re.UNICODE) is not None:
-                    kernel_hash_and_file = read_line.split()  # [0]=hash, [1]=filename
-                    # we only want the sha1 40 chars length sized hash
-                    if strlen_unicode(kernel_hash_and_file[0]) == 40:
-                        kernel_hashes_and_files[kernel_hash_and_file[0]] = kernel_hash_and_file[1]
-                        # add available kernel archs to the list
-                        # first get kernel arch
-                        kernel_arch = kernel_hash_and_file[1].split("_")[2].split(".")[0]
-                        if kernel_arch not in kernel_available_architectures and kernel_arch != "all":
-                            kernel_available_architectures.append(kernel_arch)
+            # build the package index with the hashed files
+            kernel_package_index = parse_kernel_checksums(kernel_checksums_file_stream, latest_stable_kernel_version_number)
+            if kernel_archive_index is not None:
+                kernel_archive_index.save()
 
             stop_progress_spinner()
             print_lb(SUCCESS_STRING)
@@ -840,14 +4743,14 @@ def main(argv):
             # print total available
             # packages count
 
-            print_lb("Total available kernel DEB package files: " + string_to_unicode(len(kernel_hashes_and_files)))
+            print_lb("Total available kernel DEB package files: " + string_to_unicode(len(kernel_package_index)))
             print_lb("Total available kernel package architectures: " + string_to_unicode(
-                len(kernel_available_architectures)))
+                len(kernel_package_index.architectures)))
             print_elb()
 
             # there are currently no packages available for that
             # version yet, exit the script
-            if len(kernel_hashes_and_files) == 0 or len(kernel_available_architectures) == 0:
+            if len(kernel_package_index) == 0 or len(kernel_package_index.architectures) == 0:
                 print_lb(
                     "Seems like that there are currently no DEB packages available on the Upstream kernel archive " +
                     "for the kernel version \"{0}\". Please try again later or visit the archive online to check manually.".format(
@@ -857,6 +4760,15 @@ def main(argv):
                 print_nelb(2)
                 exit_script(0)
 
+            # non-interactive batch mode, download the
+            # union of all targets files in one pass
+            if user_batch_targets is not None:
+                run_batch_download(
+                    latest_stable_kernel_version_directory_string,
+                    latest_stable_kernel_checksums_file,
+                    kernel_checksums_file_stream)
+                break
+
             # ask the user for the prefered kernel
             # architecture he wants: amd64, i386, s390x, etc.
             print_lb("Please select your prefered kernel" + os.linesep + "architecture to download: ")
@@ -866,11 +4778,11 @@ def main(argv):
             # invalid data == exit script
             # select target kernel architecture
             user_selection_number = request_user_input_number_exit_on_fail(
-                kernel_available_architectures,
-                len(kernel_available_architectures),
-                len(kernel_available_architectures))
+                kernel_package_index.architectures,
+                len(kernel_package_index.architectures),
+                len(kernel_package_index.architectures))
 
-            kernel_selected_target_arch = kernel_available_architectures[user_selection_number]
+            kernel_selected_target_arch = kernel_package_index.architectures[user_selection_number]
             print_lb("Selected target architecture is: " + kernel_selected_target_arch)
             print_elb()
 
@@ -879,18 +4791,7 @@ def main(argv):
             print_lb("Please select your prefered kernel" + os.linesep + "flavor to download: ")
             print_elb()
 
-            # cut-off the flavor part
-            del kernel_available_flavors[:]  # cleanup lists
-            for kernel_hash, kernel_file in kernel_hashes_and_files.items():
-                # skip the generic header file with no flavor part
-                # and all flavors we dont have for the selected arch
-                if "_all.deb" not in kernel_file and kernel_selected_target_arch in kernel_file:
-                    # the forth "-" is the delimiter for the flavor part
-                    startpos_kernel_flavor = find_position_of_nth_string_occurence(kernel_file, "-", 4) + 1
-                    flavor = kernel_file[startpos_kernel_flavor:]  # cut the string before the flavor
-                    flavor = flavor[:get_string_index(flavor, "_")]  # get the length of the flavor string
-                    if flavor not in kernel_available_flavors:
-                        kernel_available_flavors.append(flavor)
+            kernel_available_flavors = kernel_package_index.get_flavors(kernel_selected_target_arch)
 
             # probe user input for valid number
             # invalid data == exit script
@@ -906,32 +4807,18 @@ def main(argv):
 
             # GO FOR IT
             # dispatch all gathered data
-            full_download_location = user_kernel_package_download_dir + os.path.sep + \
-                                     latest_stable_kernel_version_directory_string + os.path.sep + \
-                                     kernel_selected_target_arch + os.path.sep + \
-                                     kernel_selected_target_flavor
-
-            # Check whether the download directory exists or not
-            # and create on missing
-            print_nlb("Checking for download arch and flavor sub-directory availability ...")
-
-            if not os.path.isdir(full_download_location):
-                print_lb(MISSING_STRING)
-                print_nlb(
-                    "Creating new arch and flavor download sub-directory in \"" + quote(
-                        full_download_location) + "\" ...")
-                os.makedirs(full_download_location)
-                print_lb(SUCCESS_STRING)
-            else:
-                print_lb(SUCCESS_STRING)
-                print_lb("Download sub-directory for arch and flavor already exists in: \"" + quote(
-                    full_download_location) + "\"")
+            full_download_location = get_kernel_download_location(
+                latest_stable_kernel_version_directory_string,
+                kernel_selected_target_arch,
+                kernel_selected_target_flavor)
+
+            create_download_location(full_download_location)
 
             if not is_directory_empty(full_download_location):
                 print_elb()
                 print_lb("The download directory \"{0}\" already contains files. Would you like to fully ".format(
                     quote(
-                        full_download_location)) + "purge its contents, before you start downloading the new files? If you select \"No\", existing files will be overwritten!")
+                        full_download_location)) + "purge its contents, before you start downloading the new files? If you select \"No\", already verified files will be kept and unfinished downloads will be resumed!")
 
                 print_elb()
                 user_selection_number = request_user_yes_no_abort_script()
@@ -939,7 +4826,7 @@ def main(argv):
                 if user_selection_number == YES_PRESSED:
                     print_lb("(Purging - Existing files and folders will be purged)")
                 elif user_selection_number == NO_PRESSED:
-                    print_lb("(Overwriting - Existing files will be overwritten)")
+                    print_lb("(Resuming - Verified files will be kept, unfinished files will be resumed)")
 
                 if user_selection_number == YES_PRESSED:
                     delete_files_in_directory(
@@ -954,89 +4841,14 @@ def main(argv):
             print_lb("Starting files download (press Ctrl+C to abort running download task) ...")
             print_elb()
 
-            download_counter = 0  # our download counter
             del user_downloaded_kernel_deb_files[:]  # delete already downloaded files list
 
-            # first download the CHECKSUMS file
-            print_nlb("[{0}]: Downloading file \"".format(download_counter) + CHECKSUMS_FILE + "\" from \"" +
-                      latest_stable_kernel_checksums_file +
-                      "\" to \"" +
-                      full_download_location + os.path.sep + CHECKSUMS_FILE + "\" ...")
-
-            # only start/stop spinner if there is no download tool
-            if downloader_bin_full_path_and_param is None:
-                start_progress_spinner()
-
-            if download_file(LATEST_UPSTREAM_KERNELS_ARCHIVE_URL + os.path.sep +
-                                     latest_stable_kernel_version_directory_string +
-                                     os.path.sep + CHECKSUMS_FILE,
-                             full_download_location + os.path.sep + CHECKSUMS_FILE):
-                user_downloaded_kernel_deb_files.append(full_download_location + os.path.sep + CHECKSUMS_FILE)
-                if downloader_bin_full_path_and_param is None:
-                    stop_progress_spinner()
-                    print_lb(SUCCESS_STRING)
-            else:
-                if downloader_bin_full_path_and_param is None:
-                    stop_progress_spinner()
-                    print_lb(FAILED_STRING)
-
-            print_lb(
-                "File size: " + str(get_file_size(full_download_location + os.path.sep + CHECKSUMS_FILE)) + " bytes")
-            print_elb()
-
-            # download all DEB files in the dictionary
-            # for the specific arch
-            for kernel_hash_key, kernel_deb_file in kernel_hashes_and_files.items():
-                if kernel_deb_file.endswith("_all.deb") or \
-                        (kernel_deb_file.endswith("_" + kernel_selected_target_arch + ".deb") and
-                                         "-" + kernel_selected_target_flavor + "_" in kernel_deb_file):  # compose the flavor part
-
-                    destination_full_path = full_download_location + os.path.sep + kernel_deb_file
-                    source_full_url = LATEST_UPSTREAM_KERNELS_ARCHIVE_URL + os.path.sep + latest_stable_kernel_version_directory_string + os.path.sep + kernel_deb_file
-
-                    download_counter += 1
-
-                    print_nlb("[{0}]: Downloading file \"".format(download_counter) + kernel_deb_file
-                              + "\" from \"" +
-                              source_full_url +
-                              "\" to \"" +
-                              destination_full_path + "\" ...")
-
-                    # only start spinner if there is no download tool
-                    if downloader_bin_full_path_and_param is None:
-                        start_progress_spinner()
-
-                    if download_file(
-                            source_full_url,
-                            destination_full_path):
-                        user_downloaded_kernel_deb_files.append(destination_full_path)
-                        if downloader_bin_full_path_and_param is None:
-                            stop_progress_spinner()
-                            print_lb(SUCCESS_STRING)
-                    else:
-                        if downloader_bin_full_path_and_param is None:
-                            stop_progress_spinner()
-                            print_lb(FAILED_STRING)
-
-                    print_lb("File size: " + str(get_file_size(destination_full_path)) + " bytes")
-
-                    print_nlb("Validating checksum from online kernel archive to downloaded local file ...")
-
-                    start_progress_spinner()
-                    local_sha1_checksum = execute_process_wait_get_output(
-                        [SHA1SUM_BIN_FILE,
-                         destination_full_path])
-                    stop_progress_spinner()
-                    print_lb(FINISHED_STRING)
-
-                    if local_sha1_checksum.lower() == kernel_hash_key.lower():
-                        print_lb(
-                            "Local file hash: " + local_sha1_checksum + os.linesep + "Remote file hash: " + kernel_hash_key + os.linesep + "OK. File is valid.")
-                    else:
-                        print_lb(
-                            "Local file hash: " + local_sha1_checksum + os.linesep + "Remote file hash: " + kernel_hash_key + os.linesep + "WARNING! File is possibly corrupted.")
-
-                    print_elb()
+            user_downloaded_kernel_deb_files.extend(download_kernel_files(
+                latest_stable_kernel_version_directory_string,
+                latest_stable_kernel_checksums_file,
+                kernel_checksums_file_stream,
+                [[full_download_location, kernel_package_index.get_target_records(
+                    kernel_selected_target_arch, kernel_selected_target_flavor)]]))
 
             print_lb("[Successfully downloaded files]:" + os.linesep +
                      "-------------------------------")
@@ -1065,9 +4877,9 @@ def main(argv):
                 print_lb("[Successfully downloaded kernel files (will be installed in that order)]:" + os.linesep +
                          "--------------------------------------")
 
-                # headers-all file is the shortest string and must be
-                # installed first before all others to avoid dpkg errors
-                user_downloaded_kernel_deb_files.sort(key=len)
+                # headers-all package must be installed first
+                # before all others to avoid dpkg errors
+                user_downloaded_kernel_deb_files.sort(key=get_kernel_file_install_order_key)
                 for deb_file_name in user_downloaded_kernel_deb_files:
                     if ".deb" in deb_file_name:
                         print_lb("\t" + os.path.basename(deb_file_name))
@@ -1085,7 +4897,16 @@ def main(argv):
                     exit_installation = False
                     optionally_installing = " and installing"
 
-                    for deb_file_name in user_downloaded_kernel_deb_files:
+                    # one transaction lets dpkg order the packages
+                    # and run the triggers only once at the end
+                    install_deb_file_names = [deb_file_name for deb_file_name in user_downloaded_kernel_deb_files
+                                              if os.path.basename(deb_file_name) != CHECKSUMS_FILE]
+                    if DPKG_INSTALL_IN_ONE_TRANSACTION:
+                        install_deb_file_groups = [install_deb_file_names]
+                    else:
+                        install_deb_file_groups = [[deb_file_name] for deb_file_name in install_deb_file_names]
+
+                    for install_deb_file_group in install_deb_file_groups:
 
                         dpkg_file_is_locked = True
 
@@ -1124,19 +4945,22 @@ def main(argv):
                         if exit_installation:
                             break
 
-                        file_name = os.path.basename(deb_file_name)
+                        if len(install_deb_file_group) == 1:
+                            print_lb("Installing " + os.path.basename(install_deb_file_group[0]) + " with " +
+                                     DPKG_BIN_FILE + ", please wait ..." + os.linesep)
+                        else:
+                            print_lb("Installing {0} kernel packages with ".format(len(install_deb_file_group)) +
+                                     DPKG_BIN_FILE + " in one transaction, please wait ..." + os.linesep)
 
-                        if file_name != CHECKSUMS_FILE:
-                            print_lb(
-                                "Installing " + file_name + " with " + DPKG_BIN_FILE + ", please wait ..." + os.linesep)
-
-                            error_code = execute_process_wait_get_returncode(
-                                [dpkg_bin_file_full_path,
-                                 DPKG_BIN_FILE_PARAMS, quote(deb_file_name)])
+                        dpkg_timer = run_metrics.start_phase("dpkg")
+                        error_code = execute_dpkg_wait_get_returncode(
+                            [dpkg_bin_file_full_path, DPKG_BIN_FILE_PARAMS] + install_deb_file_group)
+                        run_metrics.stop_phase(dpkg_timer)
 
-                            if error_code != 0:
-                                last_error_code = error_code
-                                error_occurred += 1
+                        if error_code != 0:
+                            run_metrics.add_counter("dpkg_failures")
+                            last_error_code = error_code
+                            error_occurred += 1
 
                     if error_occurred != 0:
                         print_elb()
@@ -1175,8 +4999,17 @@ def main(argv):
             else:
                 print_nelb(2)  # put some spacers before repeating
 
+        # the list, audit and dedup modes download nothing
+        if user_list_settings is not None:
+            finished_work = "Listing kernel versions"
+        elif user_audit_settings is not None:
+            finished_work = "Auditing the download tree"
+        elif user_dedup_mode:
+            finished_work = "Deduplicating the download tree"
+        else:
+            finished_work = "Downloading" + optionally_installing + " files"
         print_elb()
-        print_lb("Downloading" + optionally_installing + " files finished. Have a nice day." + os.linesep)
+        print_lb(finished_work + " finished. Have a nice day." + os.linesep)
 
     except WebFileDownloadError as e:
         # stop spinner if running
@@ -1184,23 +5017,26 @@ def main(argv):
         print_lb("Web file access error: {0}".format(e.errmsg) + os.linesep)
         print_lb("Exiting script.")
         print_nelb(2)
-        exit_script(1)
+        script_exit_code = 1
     except KeyboardInterrupt:
         # stop spinner if running
         stop_progress_spinner()
         print_lb(os.linesep + os.linesep + "Script manually aborted. Good Bye!" + os.linesep)
-        exit_script(1)
+        script_exit_code = 1
     except Exception as e:
         # stop spinner if running
         stop_progress_spinner()
         print_nlb("ERROR: Operation failed! Reason: {0}. Terminating script.".format(
-            "Unknown Error" if len(e.message) == 0 or e.message is None else e.message) + os.linesep)
+            str(e) or "Unknown Error") + os.linesep)
         print_elb()
-        exit_script(1)
+        script_exit_code = 1
     finally:
         # stop spinner if running
         stop_progress_spinner()
-        exit_script(0)
+
+    # an exit_script call inside the try block has
+    # already exited and written the metrics
+    exit_script(script_exit_code)
 
 
 # entry point, strip-off script name in passed args
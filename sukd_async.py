@@ -0,0 +1,585 @@
+# -*- coding: utf-8 -*-
+
+"""
+sukd_async.py: asyncio network engine for sukd.py
+
+With USE_ASYNC_ENGINE = True (or --async-engine) sukd.py runs the
+connection probe, the releases.json and CHECKSUMS requests and the
+package downloads as tasks on one asyncio event loop. The network
+I/O runs in a single thread, without download tools, only the file
+writes and the hashing go to the default executor of the loop, so
+they do not hold up the other transfers.
+The engine talks HTTP/1.1 over the standard library streams itself
+and keeps idle keep-alive connections per host.
+
+The module needs Python 3.7 or newer, sukd.py falls back to its
+threads if it is missing or cannot be loaded.
+
+"""
+
+import asyncio
+import os
+import socket
+import ssl
+import zlib
+from urllib.parse import urljoin, urlsplit
+
+##########################
+# Async engine constants #
+##########################
+ASYNC_HTTP_HEADER_LINE_LIMIT = 100  # header lines accepted per response
+ASYNC_PROXY_CONNECT_TIMEOUT_IN_SEC = 30
+
+
+class AsyncHttpResponse:
+    def __init__(self, engine, connection_key, reader, writer, status, headers, decode_content):
+        self.engine = engine
+        self.connection_key = connection_key
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers  # lower case name -> value
+        self.content_decoder = None
+        self.chunked = "chunked" in self.getheader("Transfer-Encoding", "").lower()
+        self.chunk_remaining = 0
+        content_length = self.getheader("Content-Length")
+        self.remaining = int(content_length) if content_length is not None and not self.chunked else None
+        self.finished = status in [204, 304] or self.remaining == 0
+        # without a length the body ends with the connection
+        self.will_close = self.getheader("Connection", "").lower() == "close" or \
+            (self.remaining is None and not self.chunked and not self.finished)
+        # gzip bodies are inflated chunk by
+        # chunk while they are being read
+        if decode_content and self.getheader("Content-Encoding", "").lower() == "gzip":
+            self.content_decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    async def read_raw(self, size):
+        if self.finished:
+            return b""
+
+        if self.chunked:
+            if self.chunk_remaining == 0:
+                chunk_size_line = await self.reader.readline()
+                chunk_size = int(chunk_size_line.split(b";")[0].strip() or b"0", 16)
+                if chunk_size == 0:
+                    # skip the trailer up to the empty line
+                    while (await self.reader.readline()).strip():
+                        pass
+                    self.finished = True
+                    return b""
+                self.chunk_remaining = chunk_size
+            data_chunk = await self.reader.read(min(size, self.chunk_remaining))
+            if not data_chunk:
+                raise self.engine.host.RetryableRequestError("The connection was closed inside a chunk.", host_failed=False)
+            self.chunk_remaining -= len(data_chunk)
+            if self.chunk_remaining == 0:
+                await self.reader.readexactly(2)  # CRLF after the chunk
+            return data_chunk
+
+        if self.remaining is None:
+            data_chunk = await self.reader.read(size)
+            if not data_chunk:
+                self.finished = True
+            return data_chunk
+
+        data_chunk = await self.reader.read(min(size, self.remaining))
+        if not data_chunk:
+            raise self.engine.host.RetryableRequestError(
+                "The connection was closed {0} bytes before the end.".format(self.remaining), host_failed=False)
+        self.remaining -= len(data_chunk)
+        if self.remaining == 0:
+            self.finished = True
+        return data_chunk
+
+    async def read(self, size):
+        while True:
+            data_chunk = await self.read_raw(size)
+            if self.content_decoder is None:
+                break
+            if not data_chunk:
+                data_chunk = self.content_decoder.flush()
+                break
+            data_chunk = self.content_decoder.decompress(data_chunk)
+            # the decoder may buffer a small chunk
+            # completely, read on in that case
+            if data_chunk:
+                break
+        if not data_chunk:
+            self.close()
+        return data_chunk
+
+    async def read_all(self):
+        data_chunks = list()
+        while True:
+            data_chunk = await self.read(self.engine.host.DOWNLOAD_CHUNK_SIZE)
+            if not data_chunk:
+                break
+            data_chunks.append(data_chunk)
+        return b"".join(data_chunks)
+
+    def close(self):
+        if self.writer is None:
+            return
+        # only a fully read response leaves the
+        # connection in a state we can reuse
+        if self.finished and not self.will_close:
+            self.engine.release_connection(self.connection_key, self.reader, self.writer)
+        else:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class AsyncTransferEngine:
+    host = None
+    event_loop = None
+    idle_connections = None
+
+    def __init__(self, host):
+        # host is the running sukd module, its settings,
+        # caches, limiter, progress and metrics are shared
+        self.host = host
+        self.event_loop = asyncio.new_event_loop()
+        self.idle_connections = dict()  # (scheme, host, port, proxy) -> [[reader, writer], ...]
+
+    def run(self, coroutine):
+        # every call runs on the same event loop, Ctrl+C
+        # cancels the running tasks before it is passed on
+        main_task = self.event_loop.create_task(coroutine)
+        try:
+            return self.event_loop.run_until_complete(main_task)
+        except KeyboardInterrupt:
+            main_task.cancel()
+            try:
+                self.event_loop.run_until_complete(main_task)
+            except (asyncio.CancelledError, Exception):
+                pass
+            raise
+
+    def close(self):
+        if self.event_loop.is_closed():
+            return
+        for idle_connections in self.idle_connections.values():
+            for reader, writer in idle_connections:
+                writer.close()
+        self.idle_connections.clear()
+        # one more loop pass lets the transports
+        # close their sockets before the loop ends
+        self.event_loop.run_until_complete(asyncio.sleep(0))
+        self.event_loop.close()
+
+    async def open_tunnel_socket(self, proxy_host, proxy_port, host, port):
+        # https through a proxy is tunneled with CONNECT,
+        # the socket is handed to the TLS stream afterwards
+        proxy_address = await self.event_loop.getaddrinfo(proxy_host, proxy_port, type=socket.SOCK_STREAM)
+        tunnel_socket = socket.socket(proxy_address[0][0], socket.SOCK_STREAM)
+        tunnel_socket.setblocking(False)
+        try:
+            await self.event_loop.sock_connect(tunnel_socket, proxy_address[0][4])
+            await self.event_loop.sock_sendall(tunnel_socket, "CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n".format(
+                host, port).encode("ascii"))
+            tunnel_response = b""
+            while b"\r\n\r\n" not in tunnel_response:
+                data_chunk = await self.event_loop.sock_recv(tunnel_socket, 4096)
+                if not data_chunk:
+                    break
+                tunnel_response += data_chunk
+            if tunnel_response.split(b" ", 2)[1:2] != [b"200"]:
+                raise self.host.WebFileDownloadError("The proxy refused the tunnel to \"{0}:{1}\".".format(host, port))
+            return tunnel_socket
+        except:
+            tunnel_socket.close()
+            raise
+
+    async def create_connection(self, connection_key):
+        # a host that does not accept the connection in
+        # time fails like a refused one and is retried
+        return await asyncio.wait_for(self.open_connection(connection_key), self.host.HTTP_CONNECT_TIMEOUT_IN_SEC)
+
+    async def open_connection(self, connection_key):
+        scheme, host, port, proxy = connection_key
+        ssl_context = ssl.create_default_context() if scheme == "https" else None
+
+        # plain http goes to the proxy directly, https
+        # is tunneled through the proxy with CONNECT
+        if proxy is not None:
+            proxy_url = urlsplit(proxy)
+            proxy_port = proxy_url.port or 80
+            if scheme == "https":
+                tunnel_socket = await asyncio.wait_for(
+                    self.open_tunnel_socket(proxy_url.hostname, proxy_port, host, port),
+                    ASYNC_PROXY_CONNECT_TIMEOUT_IN_SEC)
+                return await asyncio.open_connection(sock=tunnel_socket, ssl=ssl_context, server_hostname=host)
+            return await asyncio.open_connection(proxy_url.hostname, proxy_port)
+
+        return await asyncio.open_connection(host, port, ssl=ssl_context)
+
+    async def get_connection(self, connection_key):
+        idle_connections = self.idle_connections.get(connection_key)
+        while idle_connections:
+            reader, writer = idle_connections.pop()
+            # the server may have closed it meanwhile
+            if not reader.at_eof() and not writer.is_closing():
+                return [reader, writer, True]
+            writer.close()
+        reader, writer = await self.create_connection(connection_key)
+        return [reader, writer, False]
+
+    def release_connection(self, connection_key, reader, writer):
+        idle_connections = self.idle_connections.setdefault(connection_key, list())
+        if len(idle_connections) < self.host.HTTP_MAX_IDLE_CONNECTIONS_PER_HOST:
+            idle_connections.append([reader, writer])
+        else:
+            writer.close()
+
+    async def send_request(self, reader, writer, request_bytes):
+        writer.write(request_bytes)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("The connection was closed before the response.")
+        status = int(status_line.split(b" ", 2)[1])
+
+        headers = dict()
+        for i in range(0, ASYNC_HTTP_HEADER_LINE_LIMIT):
+            header_line = (await reader.readline()).decode("latin-1").strip()
+            if not header_line:
+                return [status, headers]
+            header_name, header_value = header_line.split(":", 1)
+            headers[header_name.strip().lower()] = header_value.strip()
+
+        raise self.host.WebFileDownloadError("Too many response header lines.")
+
+    async def open_url(self, url, request_headers=None, decode_content=False):
+        for i in range(0, self.host.HTTP_MAX_REDIRECTS + 1):
+            source_url = urlsplit(url)
+            scheme = source_url.scheme.lower()
+            port = source_url.port or (443 if scheme == "https" else 80)
+            proxy = self.host.get_proxy_for_url(url)
+            connection_key = (scheme, source_url.hostname, port, proxy)
+
+            request_path = source_url.path or "/"
+            if source_url.query:
+                request_path += "?" + source_url.query
+            if proxy is not None and scheme != "https":
+                request_path = url
+
+            headers = {"Host": source_url.netloc.rsplit("@", 1)[-1], "User-Agent": self.host.HTTP_USER_AGENT}
+            if decode_content:
+                headers["Accept-Encoding"] = "gzip"
+            if request_headers:
+                headers.update(request_headers)
+            request_bytes = ("GET {0} HTTP/1.1\r\n".format(request_path) + "".join(
+                "{0}: {1}\r\n".format(header_name, header_value) for header_name, header_value in headers.items()) +
+                "\r\n").encode("latin-1")
+
+            reader, writer, connection_reused = await self.get_connection(connection_key)
+            try:
+                status, response_headers = await self.send_request(reader, writer, request_bytes)
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                writer.close()
+                # the server may have dropped an idle
+                # keep-alive connection, retry on a new one
+                if not connection_reused:
+                    raise
+                self.host.run_metrics.add_counter("http_connection_retries")
+                reader, writer = await self.create_connection(connection_key)
+                status, response_headers = await self.send_request(reader, writer, request_bytes)
+
+            response = AsyncHttpResponse(self, connection_key, reader, writer, status, response_headers, decode_content)
+
+            # an overloaded or failing server is worth
+            # another attempt, the caller decides on it
+            if status in self.host.RETRY_HTTP_STATUS_CODES:
+                response.close()
+                raise self.host.RetryableRequestError(
+                    "The server answered \"{0}\" with status {1}.".format(url, status),
+                    self.host.parse_retry_after(response.getheader("Retry-After")))
+
+            if status not in self.host.HTTP_REDIRECT_STATUS_CODES:
+                return response
+
+            # drain the redirect body to keep the
+            # connection usable and follow it
+            await response.read_all()
+            url = urljoin(url, response.getheader("Location"))
+
+        raise self.host.WebFileDownloadError("Too many redirects for \"{0}\".".format(url))
+
+    async def probe_servers(self, server_addresses, server_port, deadline_in_sec):
+        # all servers are probed at once, the first
+        # successful connect wins, all share one deadline
+        async def probe_server(server_address):
+            reader, writer = await asyncio.open_connection(server_address, server_port)
+            writer.close()
+            return [server_address, server_port]
+
+        probe_tasks = [self.event_loop.create_task(probe_server(server_address))
+                       for server_address in server_addresses]
+        try:
+            for probe_task in asyncio.as_completed(probe_tasks, timeout=deadline_in_sec):
+                try:
+                    return await probe_task
+                except (OSError, asyncio.TimeoutError):
+                    continue
+            return None
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            for probe_task in probe_tasks:
+                probe_task.cancel()
+            await asyncio.gather(*probe_tasks, return_exceptions=True)
+
+    async def call_with_retries(self, request_deadline, url, request_function, *request_arguments):
+        # the retry rules of call_with_retries of sukd.py,
+        # the deadline cancels a running attempt at once
+        host = urlsplit(url).netloc
+        attempt_index = 0
+        while True:
+            try:
+                self.host.host_circuit_breaker.check_request(host)
+                try:
+                    request_result = await asyncio.wait_for(
+                        request_function(*request_arguments), max(0, request_deadline.get_remaining()))
+                except asyncio.TimeoutError:
+                    if request_deadline.get_remaining() <= 0:
+                        raise self.host.RequestDeadlineError("The request deadline for \"{0}\" has passed.".format(url))
+                    # a stall or connect timeout inside the attempt
+                    raise self.host.RetryableRequestError("The request for \"{0}\" timed out.".format(url))
+                except asyncio.IncompleteReadError:
+                    raise self.host.RetryableRequestError("The response for \"{0}\" ended early.".format(url))
+            except asyncio.CancelledError:
+                raise
+            except Exception as request_error:
+                retry_backoff = self.host.get_request_retry_backoff(request_deadline, host, attempt_index, request_error)
+                if retry_backoff is None:
+                    raise
+                await asyncio.sleep(retry_backoff)
+                if not isinstance(request_error, self.host.CircuitBreakerOpenError):
+                    attempt_index += 1
+                continue
+            self.host.host_circuit_breaker.record_answer(host)
+            return request_result
+
+    async def fetch_metadata(self, url):
+        # transient errors are retried within the deadline,
+        # whatever still fails is reported as status 0
+        request_deadline = self.host.RequestDeadline(self.host.METADATA_REQUEST_DEADLINE_IN_SEC)
+        try:
+            return await self.call_with_retries(request_deadline, url, self.fetch_metadata_once, url)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return [0, None]
+
+    async def fetch_metadata_once(self, url):
+        metadata_cache = self.host.kernel_metadata_cache
+        cache_entry = None
+        request_headers = None
+        if metadata_cache is not None:
+            web_response_text, cache_entry, request_headers = metadata_cache.prepare_request(url)
+            if web_response_text is not None:
+                return [200, web_response_text]
+
+        # text metadata is requested gzip compressed
+        # and inflated while it is being read, a
+        # stalled server fails the attempt
+        stall_timeout = self.host.HTTP_STALL_TIMEOUT_IN_SEC
+        web_response = await asyncio.wait_for(
+            self.open_url(url, request_headers, decode_content=True), stall_timeout)
+        web_response_body = await asyncio.wait_for(web_response.read_all(), stall_timeout)
+
+        if metadata_cache is not None:
+            return metadata_cache.complete_request(
+                url, cache_entry, web_response.status, web_response.getheader("ETag"),
+                web_response.getheader("Last-Modified"), web_response_body)
+        if web_response.status != 200:
+            return [web_response.status, None]
+        return [200, web_response_body.decode("utf-8")]
+
+    async def probe_archive_mirrors(self, archive_urls, probe_bytes, deadline_in_sec):
+        # returns url -> [latency, bytes_per_second] of the mirrors
+        # that answered within the deadline, like the probe of sukd.py
+        loop_time = self.event_loop.time
+
+        async def probe_archive_mirror(archive_url):
+            request_start_time = loop_time()
+            source_response = await self.open_url(archive_url + "/")
+            response_start_time = loop_time()
+            try:
+                if source_response.status != 200:
+                    return None
+                probe_byte_count = 0
+                while probe_byte_count < probe_bytes:
+                    data_chunk = await source_response.read(self.host.DOWNLOAD_CHUNK_SIZE)
+                    if not data_chunk:
+                        break
+                    probe_byte_count += len(data_chunk)
+            finally:
+                source_response.close()
+            return [response_start_time - request_start_time,
+                    int(probe_byte_count / max(0.001, loop_time() - response_start_time))]
+
+        probe_tasks = [self.event_loop.create_task(probe_archive_mirror(archive_url)) for archive_url in archive_urls]
+        await asyncio.wait(probe_tasks, timeout=deadline_in_sec)
+
+        mirror_probe_results = dict()
+        for archive_url, probe_task in zip(archive_urls, probe_tasks):
+            if probe_task.done() and not probe_task.cancelled() and probe_task.exception() is None and \
+                    probe_task.result() is not None:
+                mirror_probe_results[archive_url] = probe_task.result()
+            probe_task.cancel()
+        await asyncio.gather(*probe_tasks, return_exceptions=True)
+        return mirror_probe_results
+
+    async def fetch_metadata_concurrently(self, url_lists, task_limit):
+        # every entry lists the same file on all ranked mirrors,
+        # the first 200 response wins, results are in list order
+        task_semaphore = asyncio.Semaphore(task_limit)
+
+        async def fetch_limited(urls):
+            async with task_semaphore:
+                web_response = [0, None]
+                for url in urls:
+                    web_response = await self.fetch_metadata(url)
+                    if web_response[1] is not None and web_response[0] == 200:
+                        break
+                return web_response
+
+        return await asyncio.gather(*[fetch_limited(urls) for urls in url_lists])
+
+    async def download_files(self, download_jobs, task_limit):
+        # download_jobs = [[fromurls, tofile, file_hashers], ...]
+        # returns a dict with tofile -> True/False
+        task_semaphore = asyncio.Semaphore(task_limit)
+
+        async def download_limited(fromurls, tofile, file_hashers):
+            async with task_semaphore:
+                return await self.download_file_from_mirrors(fromurls, tofile, file_hashers)
+
+        download_results = await asyncio.gather(
+            *[download_limited(fromurls, tofile, file_hashers) for fromurls, tofile, file_hashers in download_jobs])
+
+        return dict((download_job[1], download_result is True)
+                    for download_job, download_result in zip(download_jobs, download_results))
+
+    async def download_file_from_mirrors(self, fromurls, tofile, file_hashers):
+        # the same retries and failover as
+        # download_file_from_mirrors of sukd.py
+        request_deadline = self.host.RequestDeadline(self.host.FILE_DOWNLOAD_DEADLINE_IN_SEC)
+        fromurls = self.host.order_urls_by_circuit_breaker(fromurls)
+        for mirror_index, fromurl in enumerate(fromurls):
+            if mirror_index > 0:
+                self.host.run_metrics.add_counter("mirror_failovers")
+            try:
+                if await self.call_with_retries(request_deadline, fromurl, self.download_file,
+                                                fromurl, tofile, file_hashers):
+                    return True
+            except asyncio.CancelledError:
+                raise
+            except self.host.RequestDeadlineError:
+                self.host.run_metrics.add_counter("request_deadline_misses")
+                return False
+            except Exception:
+                pass
+            if self.host.archive_mirror_ranking is not None:
+                self.host.archive_mirror_ranking.demote(fromurl)
+        return False
+
+    async def download_file(self, fromurl, tofile, file_hashers):
+        # every attempt is timed for the run metrics and shown in the
+        # progress while it runs, errors are raised for the retries
+        transfer_name = os.path.basename(tofile)
+        if self.host.transfer_progress is not None:
+            self.host.transfer_progress.start_transfer(transfer_name)
+        # the part file is hashed again on resume
+        if file_hashers:
+            self.host.reset_file_hashers(file_hashers)
+        download_timer = self.host.run_metrics.start_phase("file_download")
+        file_downloaded = False
+        try:
+            file_downloaded = await self.transfer_file(fromurl, tofile, file_hashers, transfer_name)
+        finally:
+            download_seconds = self.host.run_metrics.stop_phase(download_timer)
+            self.host.run_metrics.add_file_transfer(
+                transfer_name, self.host.get_file_size(tofile) if file_downloaded else 0, download_seconds,
+                file_downloaded)
+            if self.host.transfer_progress is not None:
+                self.host.transfer_progress.finish_transfer(transfer_name, file_downloaded)
+        return file_downloaded
+
+    async def transfer_file(self, fromurl, tofile, file_hashers, transfer_name):
+        # the same ".part" file and resume rules
+        # as the download_file of sukd.py
+        partfile = tofile + self.host.PARTIAL_DOWNLOAD_FILE_SUFFIX
+        resume_offset = os.path.getsize(partfile) if os.path.isfile(partfile) else 0
+
+        # the bytes we already have are part of
+        # the checksum, hash them before continuing
+        if resume_offset:
+            self.host.run_metrics.add_counter("download_resumes")
+            if file_hashers:
+                await self.event_loop.run_in_executor(
+                    None, self.host.update_file_hashers_from_file, partfile, file_hashers)
+
+        request_headers = {"Range": "bytes={0}-".format(resume_offset)} if resume_offset else {}
+
+        # a stalled server fails the attempt instead of
+        # blocking it forever, the retries take over
+        stall_timeout = self.host.HTTP_STALL_TIMEOUT_IN_SEC
+        source_response = await asyncio.wait_for(self.open_url(fromurl, request_headers), stall_timeout)
+        try:
+            if source_response.status not in [200, 206]:
+                await source_response.read_all()
+                # the part file already holds all bytes
+                if source_response.status == 416 and resume_offset:
+                    os.rename(partfile, tofile)
+                    return True
+                return False
+
+            # the server ignored the range request,
+            # so the whole file is coming again
+            if resume_offset and source_response.status != 206:
+                resume_offset = 0
+                if file_hashers:
+                    self.host.reset_file_hashers(file_hashers)
+
+            if self.host.transfer_progress is not None:
+                content_length = source_response.getheader("Content-Length")
+                self.host.transfer_progress.set_transfer_size(
+                    transfer_name, resume_offset + int(content_length) if content_length else None, resume_offset)
+
+            # stream the body to disk and feed
+            # the hashers with the same chunks
+            with open(partfile, "ab" if resume_offset else "wb") as fp:
+                while True:
+                    data_chunk = await asyncio.wait_for(
+                        source_response.read(self.host.DOWNLOAD_CHUNK_SIZE), stall_timeout)
+                    if not data_chunk:
+                        break
+                    if self.host.download_bandwidth_limiter is not None:
+                        bandwidth_wait_time = self.host.download_bandwidth_limiter.reserve(len(data_chunk))
+                        if bandwidth_wait_time > 0:
+                            await asyncio.sleep(bandwidth_wait_time)
+                    await self.event_loop.run_in_executor(
+                        None, self.write_data_chunk, fp, data_chunk, file_hashers)
+                    if self.host.transfer_progress is not None:
+                        self.host.transfer_progress.add_transfer_bytes(transfer_name, len(data_chunk))
+        finally:
+            # an unfinished body closes the connection
+            source_response.close()
+
+        os.rename(partfile, tofile)
+        return True
+
+    def write_data_chunk(self, fp, data_chunk, file_hashers):
+        # runs in the executor, the chunks of one
+        # file are still written and hashed in order
+        fp.write(data_chunk)
+        if file_hashers:
+            for file_hasher in file_hashers.values():
+                file_hasher.update(data_chunk)
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+sukd_bench.py: Benchmarks for the download, hashing and parsing
+paths of sukd.py against a local fake kernel archive.
+
+The script starts a local HTTP server that serves a synthetic
+"releases.json", a "v<version>/CHECKSUMS" file and DEB sized
+payloads, all generated in memory. The server can inject latency,
+cap the bandwidth per connection, truncate responses and answer
+with 5xx errors.
+
+Against that server it runs:
+
+    - the start of sukd.py in its own process up to the first
+      online request, with and without --fast-start
+    - the CHECKSUMS parsing and package index build
+    - open_webfile_get_response for releases.json and CHECKSUMS
+    - the downloads and the checksum verification for every
+      available backend (wget, curl, the build-in downloader
+      and the asyncio engine)
+
+and reports the latency percentiles and the throughput of each.
+
+Example:
+
+        $ python sukd_bench.py
+        $ python sukd_bench.py --rounds 5 --file-size 16 --latency 50 --bandwidth 20m
+        $ python sukd_bench.py --error-rate 0.1 --truncate-rate 0.1 --backends builtin
+        $ python sukd_bench.py --json bench-results.json
+
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import sukd
+
+##########################
+# Fake archive constants #
+##########################
+FAKE_KERNEL_VERSION = "9.9.9"
+FAKE_KERNEL_ABI = "090909"
+FAKE_KERNEL_PACKAGE_BUILD = "202001010000"
+FAKE_KERNEL_ARCHITECTURES = ["amd64", "arm64", "armhf", "ppc64el", "s390x"]
+FAKE_KERNEL_FLAVORS = ["generic", "lowlatency", "generic-lpae", "generic-64k"]
+FAKE_KERNEL_PACKAGE_KINDS = ["headers", "image-unsigned", "modules"]
+FAKE_ARCHIVE_PATH = "/mainline"
+FAKE_RELEASES_JSON_PATH = "/releases.json"
+FAKE_SEND_CHUNK_SIZE = 16 * 1024
+FAKE_PAYLOAD_BLOCK_SIZE = 64 * 1024
+
+#######################
+# Benchmark constants #
+#######################
+BENCHMARK_BACKENDS = ["builtin", "wget", "curl", "async"]
+BENCHMARK_PERCENTILES = [50, 90, 99]
+BENCHMARK_PARSE_ITERATIONS = 200
+BENCHMARK_METADATA_ITERATIONS = 50
+BENCHMARK_STARTUP_ITERATIONS = 10
+
+
+class FakeKernelArchive:
+    files = None
+    deb_files = None
+
+    def __init__(self, file_count, file_size):
+        # path -> bytes, all payloads live in memory
+        self.files = dict()
+        self.deb_files = list()
+
+        releases_json = {"latest_stable": {"version": FAKE_KERNEL_VERSION}}
+        self.files[FAKE_RELEASES_JSON_PATH] = json.dumps(releases_json).encode("utf-8")
+
+        # every payload repeats its own random block, so the
+        # files differ and do not compress like real DEB files
+        payload_random = random.Random(4711)
+        for i in range(0, file_count):
+            deb_file = "linux-{0}-{1}-{2}-bench{3}_{1}-{2}.{4}_amd64.deb".format(
+                FAKE_KERNEL_PACKAGE_KINDS[i % len(FAKE_KERNEL_PACKAGE_KINDS)],
+                FAKE_KERNEL_VERSION, FAKE_KERNEL_ABI, i, FAKE_KERNEL_PACKAGE_BUILD)
+            payload_block = bytes(bytearray(payload_random.getrandbits(8) for j in range(0, FAKE_PAYLOAD_BLOCK_SIZE)))
+            self.deb_files.append(deb_file)
+            self.files[self.get_file_path(deb_file)] = (payload_block * (file_size // FAKE_PAYLOAD_BLOCK_SIZE + 1))[:file_size]
+
+        self.files[self.get_file_path(sukd.CHECKSUMS_FILE)] = self.create_checksums_text().encode("utf-8")
+
+    def get_file_path(self, file_name):
+        return FAKE_ARCHIVE_PATH + "/v" + FAKE_KERNEL_VERSION + "/" + file_name
+
+    def create_checksums_text(self):
+        # the real CHECKSUMS lists every arch and flavor, so the
+        # parser gets a realistic amount of lines to work on
+        checksums_lines = list()
+        for algorithm in ["sha1", "sha256"]:
+            checksums_lines.append("# Checksums-{0}:".format(algorithm.capitalize()))
+            for deb_file in self.deb_files:
+                checksums_lines.append("{0}  {1}".format(
+                    hashlib.new(algorithm, self.files[self.get_file_path(deb_file)]).hexdigest(), deb_file))
+            for kernel_arch in FAKE_KERNEL_ARCHITECTURES:
+                for kernel_flavor in FAKE_KERNEL_FLAVORS:
+                    for kernel_kind in FAKE_KERNEL_PACKAGE_KINDS:
+                        deb_file = "linux-{0}-{1}-{2}-{3}_{1}-{2}.{4}_{5}.deb".format(
+                            kernel_kind, FAKE_KERNEL_VERSION, FAKE_KERNEL_ABI, kernel_flavor,
+                            FAKE_KERNEL_PACKAGE_BUILD, kernel_arch)
+                        checksums_lines.append("{0}  {1}".format(
+                            hashlib.new(algorithm, deb_file.encode("utf-8")).hexdigest(), deb_file))
+            checksums_lines.append("")
+        return "\n".join(checksums_lines)
+
+
+class FaultInjectionSettings:
+    def __init__(self, latency=0.0, bandwidth=None, truncate_rate=0.0, error_rate=0.0):
+        self.latency = latency  # seconds before the response
+        self.bandwidth = bandwidth  # bytes per second and connection, None for no cap
+        self.truncate_rate = truncate_rate  # share of bodies cut off in the middle
+        self.error_rate = error_rate  # share of requests answered with a 503
+        self.fault_random = random.Random(4711)
+        self.fault_lock = threading.Lock()
+
+    def is_hit(self, fault_rate):
+        with self.fault_lock:
+            return self.fault_random.random() < fault_rate
+
+
+class FakeKernelArchiveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and small bodies go out at once
+
+    def log_message(self, *args):
+        pass  # keep the benchmark output readable
+
+    def do_GET(self):
+        fault_settings = self.server.fault_settings
+
+        if fault_settings.latency:
+            time.sleep(fault_settings.latency)
+
+        file_data = self.server.fake_archive.files.get(self.path.split("?")[0])
+
+        if file_data is None:
+            self.send_empty_response(404)
+            return
+
+        if fault_settings.is_hit(fault_settings.error_rate):
+            self.send_empty_response(503)
+            return
+
+        etag = "\"{0}\"".format(hashlib.sha1(file_data).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_empty_response(304)
+            return
+
+        status = 200
+        content_start = 0
+        content_end = len(file_data) - 1
+        range_match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range") or "")
+        if range_match is not None:
+            content_start = int(range_match.group(1))
+            if range_match.group(2):
+                content_end = min(content_end, int(range_match.group(2)))
+            if content_start > content_end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{0}".format(len(file_data)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(content_end - content_start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        if status == 206:
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(content_start, content_end, len(file_data)))
+        self.end_headers()
+
+        # a truncated body ends in the middle and
+        # the connection is closed without warning
+        if fault_settings.is_hit(fault_settings.truncate_rate):
+            content_end = content_start + (content_end - content_start) // 2
+            self.close_connection = True
+
+        self.send_body(file_data, content_start, content_end + 1, fault_settings.bandwidth)
+
+    def send_empty_response(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_body(self, file_data, content_start, content_end, bandwidth):
+        send_start_time = time.time()
+        sent_bytes = 0
+        try:
+            for chunk_start in range(content_start, content_end, FAKE_SEND_CHUNK_SIZE):
+                data_chunk = file_data[chunk_start:min(chunk_start + FAKE_SEND_CHUNK_SIZE, content_end)]
+                self.wfile.write(data_chunk)
+                sent_bytes += len(data_chunk)
+                if bandwidth:
+                    ahead_time = sent_bytes / float(bandwidth) - (time.time() - send_start_time)
+                    if ahead_time > 0:
+                        time.sleep(ahead_time)
+        except socket.error:
+            self.close_connection = True
+
+
+class FakeKernelArchiveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fake_archive, fault_settings):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeKernelArchiveRequestHandler)
+        self.fake_archive = fake_archive
+        self.fault_settings = fault_settings
+
+    def get_base_url(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+    def start(self):
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+
+def get_percentile(sorted_values, percentile):
+    # nearest rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-percentile * len(sorted_values) // 100)))
+    return sorted_values[rank - 1]
+
+
+def summarize_samples(benchmark_name, latencies, byte_count, failure_count):
+    latencies = sorted(latencies)
+    total_seconds = sum(latencies)
+    benchmark_summary = {"benchmark": benchmark_name,
+                         "runs": len(latencies) + failure_count,
+                         "failures": failure_count,
+                         "bytes": byte_count,
+                         "bytes_per_second": int(byte_count / total_seconds) if total_seconds > 0 else 0}
+    for percentile in BENCHMARK_PERCENTILES:
+        benchmark_summary["p{0}_ms".format(percentile)] = round(get_percentile(latencies, percentile) * 1000, 3)
+    return benchmark_summary
+
+
+def print_summary(benchmark_summary):
+    print("{0:<24} {1:>5} runs {2:>4} failed  ".format(
+        benchmark_summary["benchmark"], benchmark_summary["runs"], benchmark_summary["failures"]) +
+        "  ".join("p{0} {1:>9.3f} ms".format(percentile, benchmark_summary["p{0}_ms".format(percentile)])
+                  for percentile in BENCHMARK_PERCENTILES) +
+        ("  {0:>10}/s".format(sukd.format_byte_size(benchmark_summary["bytes_per_second"]))
+         if benchmark_summary["bytes"] else ""))
+
+
+def run_startup_benchmark(base_url, iterations, download_directory):
+    # the "startup" phase of the metrics file is the time from
+    # the first import to the first online request, the rest
+    # of every run only verifies the files of the first one
+    startup_summaries = list()
+    metrics_file = os.path.join(download_directory, "metrics.json")
+    for benchmark_name, startup_arguments in [["startup", ["--no-probe"]],
+                                              ["startup fast", ["--fast-start"]]]:
+        latencies = list()
+        failure_count = 0
+        for i in range(0, iterations):
+            with open(os.devnull, "w") as devnull:
+                return_code = subprocess.call(
+                    [sys.executable, os.path.abspath(sukd.__file__.replace(".pyc", ".py")),
+                     "--download-dir", download_directory, "--archive-url", base_url + FAKE_ARCHIVE_PATH,
+                     "--kernel-version", FAKE_KERNEL_VERSION, "--batch", "amd64/bench0",
+                     "--metrics-file", metrics_file] + startup_arguments,
+                    stdin=devnull, stdout=devnull, stderr=devnull)
+            if return_code != 0:
+                failure_count += 1
+                continue
+            with io.open(metrics_file, "r", encoding="utf-8") as fp:
+                latencies.append(json.load(fp)["phases"]["startup"]["seconds"])
+        startup_summaries.append(summarize_samples(benchmark_name, latencies, 0, failure_count))
+    return startup_summaries
+
+
+def reset_sukd_state():
+    # every phase and round starts with a closed circuit breaker
+    # and empty metrics, so the faults of one phase do not turn
+    # into rejections in the next one
+    sukd.host_circuit_breaker = sukd.HostCircuitBreaker(
+        sukd.CIRCUIT_BREAKER_FAILURE_THRESHOLD, sukd.CIRCUIT_BREAKER_OPEN_IN_SEC)
+    sukd.run_metrics = sukd.RunMetrics()
+
+
+def run_parse_benchmark(checksums_text, iterations):
+    latencies = list()
+    for i in range(0, iterations):
+        start_time = time.time()
+        sukd.parse_kernel_checksums(checksums_text, FAKE_KERNEL_VERSION)
+        latencies.append(time.time() - start_time)
+    return summarize_samples("checksums parse", latencies, 0, 0)
+
+
+def run_metadata_benchmark(base_url, iterations):
+    # without the metadata cache every call
+    # is a full request to the fake archive
+    sukd.kernel_metadata_cache = None
+    metadata_summaries = list()
+    for benchmark_name, metadata_url in [
+            ["releases.json fetch", base_url + FAKE_RELEASES_JSON_PATH],
+            ["CHECKSUMS fetch", base_url + FAKE_ARCHIVE_PATH + "/v" + FAKE_KERNEL_VERSION + "/" + sukd.CHECKSUMS_FILE]]:
+        reset_sukd_state()
+        latencies = list()
+        byte_count = 0
+        failure_count = 0
+        for i in range(0, iterations):
+            start_time = time.time()
+            web_response = sukd.open_webfile_get_response(metadata_url)
+            if web_response[0] != 200 or web_response[1] is None:
+                failure_count += 1
+                continue
+            latencies.append(time.time() - start_time)
+            byte_count += len(web_response[1].encode("utf-8"))
+        metadata_summaries.append(summarize_samples(benchmark_name, latencies, byte_count, failure_count))
+    return metadata_summaries
+
+
+def set_download_backend(download_backend):
+    # the same globals the environment check of sukd sets
+    sukd.downloader_bin_full_path_and_param = None
+    sukd.async_transfer_engine = None
+    if download_backend == "builtin":
+        return True
+    if download_backend == "async":
+        sukd.async_transfer_engine = sukd.create_async_transfer_engine()
+        return sukd.async_transfer_engine is not None
+    downloader_bin_full_path = sukd.find_executable_in_path(download_backend)
+    if downloader_bin_full_path is None:
+        return False
+    sukd.downloader_bin_full_path_and_param = [downloader_bin_full_path,
+                                               sukd.DOWNLOAD_TOOLS[download_backend],
+                                               sukd.DOWNLOAD_TOOLS_LIMIT_RATE_PARAMS[download_backend],
+                                               sukd.DOWNLOAD_TOOLS_STALL_PARAMS[download_backend]]
+    return True
+
+
+def run_download_benchmark(download_backend, base_url, fake_archive, rounds, download_directory):
+    kernel_package_index = sukd.parse_kernel_checksums(
+        fake_archive.create_checksums_text(), FAKE_KERNEL_VERSION)
+    latencies = list()
+    byte_count = 0
+    failure_count = 0
+
+    for i in range(0, rounds):
+        reset_sukd_state()
+        for deb_file in fake_archive.deb_files:
+            destination_full_path = os.path.join(download_directory, deb_file)
+            kernel_file_hashes = kernel_package_index.get_record(deb_file).get_hashes()
+
+            # every run starts from scratch, a
+            # leftover part file would be resumed
+            for stale_file in [destination_full_path, destination_full_path + sukd.PARTIAL_DOWNLOAD_FILE_SUFFIX]:
+                if os.path.isfile(stale_file):
+                    os.unlink(stale_file)
+
+            start_time = time.time()
+            kernel_file_hashers = sukd.create_file_hashers(kernel_file_hashes.keys())
+            file_downloaded = sukd.download_files_concurrently(
+                [[base_url + fake_archive.get_file_path(deb_file), destination_full_path, kernel_file_hashers]],
+                1)[destination_full_path]
+            file_is_valid = file_downloaded and all(
+                kernel_file_hashers[algorithm].hexdigest() == checksum
+                for algorithm, checksum in kernel_file_hashes.items())
+            elapsed_time = time.time() - start_time
+
+            if not file_is_valid:
+                failure_count += 1
+                continue
+            latencies.append(elapsed_time)
+            byte_count += len(fake_archive.files[fake_archive.get_file_path(deb_file)])
+
+    return summarize_samples("download " + download_backend, latencies, byte_count, failure_count)
+
+
+def main(argv):
+    argument_parser = argparse.ArgumentParser(
+        prog="sukd_bench",
+        description="Benchmarks sukd against a local fake kernel archive.")
+    argument_parser.add_argument("--rounds", metavar="N", type=int, default=3,
+                                 help="download every file N times per backend")
+    argument_parser.add_argument("--files", metavar="N", type=int, default=4,
+                                 help="number of DEB payloads")
+    argument_parser.add_argument("--file-size", metavar="MIB", type=float, default=8,
+                                 help="size of every DEB payload in MiB")
+    argument_parser.add_argument("--latency", metavar="MS", type=float, default=0,
+                                 help="delay every response by MS milliseconds")
+    argument_parser.add_argument("--bandwidth", metavar="RATE",
+                                 help="cap every connection to RATE bytes per second, e.g. 500k or 20m")
+    argument_parser.add_argument("--truncate-rate", metavar="SHARE", type=float, default=0.0,
+                                 help="cut off this share of the responses in the middle, e.g. 0.1")
+    argument_parser.add_argument("--error-rate", metavar="SHARE", type=float, default=0.0,
+                                 help="answer this share of the requests with a 503, e.g. 0.1")
+    argument_parser.add_argument("--backends", metavar="BACKEND", nargs="+", default=BENCHMARK_BACKENDS,
+                                 choices=BENCHMARK_BACKENDS, help="download backends to benchmark")
+    argument_parser.add_argument("--json", metavar="FILE",
+                                 help="also write the results as JSON to FILE")
+
+    parsed_args = argument_parser.parse_args(argv)
+
+    bandwidth = None
+    if parsed_args.bandwidth:
+        bandwidth = sukd.parse_byte_rate(parsed_args.bandwidth)
+        if bandwidth is None:
+            argument_parser.error("invalid bandwidth \"{0}\"".format(parsed_args.bandwidth))
+
+    print("Generating the fake kernel archive ...")
+    fake_archive = FakeKernelArchive(parsed_args.files, int(parsed_args.file_size * 1024 * 1024))
+    fault_settings = FaultInjectionSettings(parsed_args.latency / 1000.0, bandwidth,
+                                            parsed_args.truncate_rate, parsed_args.error_rate)
+    fake_archive_server = FakeKernelArchiveServer(fake_archive, fault_settings)
+    fake_archive_server.start()
+    base_url = fake_archive_server.get_base_url()
+
+    # sukd talks to the fake archive only
+    sukd.LATEST_KERNEL_VERSION_JSON_URL = base_url + FAKE_RELEASES_JSON_PATH
+    sukd.LATEST_UPSTREAM_KERNELS_ARCHIVE_URL = base_url + FAKE_ARCHIVE_PATH
+    sukd.kernel_package_cache = None
+    sukd.download_bandwidth_limiter = None
+
+    print("Serving {0} files of {1} from {2}".format(
+        len(fake_archive.deb_files), sukd.format_byte_size(int(parsed_args.file_size * 1024 * 1024)), base_url))
+    print("")
+
+    benchmark_summaries = list()
+    download_directory = tempfile.mkdtemp(prefix="sukd-bench-")
+    try:
+        for benchmark_summary in run_startup_benchmark(
+                base_url, BENCHMARK_STARTUP_ITERATIONS, os.path.join(download_directory, "startup")):
+            benchmark_summaries.append(benchmark_summary)
+            print_summary(benchmark_summary)
+
+        benchmark_summaries.append(run_parse_benchmark(
+            fake_archive.create_checksums_text(), BENCHMARK_PARSE_ITERATIONS))
+        print_summary(benchmark_summaries[-1])
+
+        for benchmark_summary in run_metadata_benchmark(base_url, BENCHMARK_METADATA_ITERATIONS):
+            benchmark_summaries.append(benchmark_summary)
+            print_summary(benchmark_summary)
+
+        for download_backend in parsed_args.backends:
+            if not set_download_backend(download_backend):
+                print("{0:<24} not available, skipped".format("download " + download_backend))
+                continue
+            benchmark_summaries.append(run_download_benchmark(
+                download_backend, base_url, fake_archive, parsed_args.rounds, download_directory))
+            print_summary(benchmark_summaries[-1])
+    finally:
+        shutil.rmtree(download_directory, ignore_errors=True)
+        sukd.http_connection_pool.close_all()
+        if sukd.async_transfer_engine is not None:
+            sukd.async_transfer_engine.close()
+        fake_archive_server.shutdown()
+        fake_archive_server.server_close()
+
+    if parsed_args.json:
+        with io.open(parsed_args.json, "w", encoding="utf-8") as fp:
+            fp.write(sukd.string_to_unicode(json.dumps(
+                {"settings": vars(parsed_args), "results": benchmark_summaries}, indent=2, sort_keys=True)))
+
+    # any failure without injected faults is a regression
+    if not parsed_args.truncate_rate and not parsed_args.error_rate and \
+            any(benchmark_summary["failures"] for benchmark_summary in benchmark_summaries):
+        return 1
+    return 0
+
+
+# entry point, strip-off script name in passed args
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))